@@ -0,0 +1,7 @@
+"""
+Webhook service that triggers the jobs of the build pipeline
+"""
+import time
+
+# When the package started to be imported, for the start-up timings of warmup.py
+IMPORT_STARTED_AT = time.time()
@@ -0,0 +1,205 @@
+"""
+Admission control: shedding the webhook deliveries that the service can't keep up with
+
+Deliveries of the handled events are admitted while fewer than
+ADMISSION_MAX_CONCURRENT of them are being handled, fewer than
+ADMISSION_MAX_QUEUE_DEPTH events wait to be dispatched, and the token
+buckets of their event and of their repo have a token left. Deliveries
+that are turned away are answered with a 503 when the service is
+overloaded, and a 429 when they are over a rate limit, so that they are
+redelivered later rather than accepted and then left behind. The limits
+apply to each server process.
+"""
+from collections import OrderedDict
+import math
+import os
+import threading
+import time
+
+from .metrics import SHED  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Deliveries per second that are admitted for each repo, and how many may come in at once
+# on top of that. With a rate of 0 the deliveries of a repo are not limited.
+RATE_LIMIT_REPO = float(os.environ.get('RATE_LIMIT_REPO', '0'))
+RATE_LIMIT_REPO_BURST = float(os.environ.get('RATE_LIMIT_REPO_BURST', '20'))
+
+# Deliveries per second that are admitted for each of the handled events, and how many may
+# come in at once on top of that. With a rate of 0 the deliveries of an event are not limited.
+RATE_LIMIT_EVENT = float(os.environ.get('RATE_LIMIT_EVENT', '0'))
+RATE_LIMIT_EVENT_BURST = float(os.environ.get('RATE_LIMIT_EVENT_BURST', '50'))
+
+# Most deliveries that are handled at once, beyond which they are answered with a 503. 0 for no limit.
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '0'))
+
+# Most events waiting to be dispatched, beyond which deliveries are answered with a 503. 0 for no limit.
+ADMISSION_MAX_QUEUE_DEPTH = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', '0'))
+
+# Number of repos whose token buckets are kept, the least recently used ones being dropped first
+_MAX_BUCKETS = 10000
+
+# The reasons for shedding a delivery
+REPO_RATE = 'repo_rate'
+EVENT_RATE = 'event_rate'
+CONCURRENCY = 'concurrency'
+QUEUE_DEPTH = 'queue_depth'
+
+
+class TokenBucket(object):
+    """ Tokens that refill at a steady rate, up to a burst.
+
+    Args:
+        rate (float): tokens added per second
+        burst (float): most tokens the bucket holds
+    """
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = now or time.time()
+
+    def take(self, now=None):
+        """ Take a token if there is one.
+
+        Returns:
+            float: 0 if a token was taken, the seconds until there is one otherwise
+        """
+        now = now or time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """ A token bucket per key.
+
+    Args:
+        rate (float): tokens added per second to each bucket
+        burst (float): most tokens each bucket holds
+        max_keys (int): most buckets kept, the least recently used ones being dropped first
+    """
+    def __init__(self, rate, burst, max_keys=_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """ Take a token from the bucket of a key.
+
+        Returns:
+            float: 0 if a token was taken, the seconds until there is one otherwise
+        """
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                # A dropped bucket was idle for the longest, so it had mostly refilled anyway
+                while len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            self._buckets[key] = bucket
+            return bucket.take(now)
+
+
+class Shed(Exception):
+    """ A delivery that is not admitted.
+
+    Args:
+        reason (string): why, one of the reasons above
+        retry_after (int): seconds after which the delivery could be admitted
+    """
+    def __init__(self, reason, retry_after=1):
+        super(Shed, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def status(self):
+        """ The status code to answer with: 429 for a rate limit, 503 when overloaded. """
+        return 429 if self.reason in (REPO_RATE, EVENT_RATE) else 503
+
+
+class AdmissionControl(object):
+    """ Decides which deliveries to handle, and keeps count of the ones being handled.
+
+    Args:
+        repo_limiter (RateLimiter): rate limits per repo, None for none
+        event_limiter (RateLimiter): rate limits per event, None for none
+        max_concurrent (int): most deliveries handled at once, 0 for no limit
+        max_queue_depth (int): most events waiting to be dispatched, 0 for no limit
+        queue_depth (callable): returns the number of events waiting to be dispatched
+    """
+    def __init__(self, repo_limiter=None, event_limiter=None, max_concurrent=0, max_queue_depth=0,
+                 queue_depth=None):
+        self.repo_limiter = repo_limiter
+        self.event_limiter = event_limiter
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth if queue_depth is not None else 0
+        self.queue_depth = queue_depth
+        self.active = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, dispatcher=None):
+        """ Create the admission control from the environment settings, None if there are no limits.
+
+        Args:
+            dispatcher (Dispatcher): the dispatcher whose queue depth is limited
+        """
+        repo_limiter = RateLimiter(RATE_LIMIT_REPO, RATE_LIMIT_REPO_BURST) if RATE_LIMIT_REPO > 0 else None
+        event_limiter = RateLimiter(RATE_LIMIT_EVENT, RATE_LIMIT_EVENT_BURST) if RATE_LIMIT_EVENT > 0 else None
+        queue_depth = dispatcher.queue_depth if dispatcher is not None else None
+        if not (repo_limiter or event_limiter or ADMISSION_MAX_CONCURRENT > 0 or
+                (queue_depth and ADMISSION_MAX_QUEUE_DEPTH > 0)):
+            return None
+        return cls(repo_limiter, event_limiter, ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE_DEPTH, queue_depth)
+
+    def enter(self, event, now=None):
+        """ Admit a delivery of a handled event before its payload is read. Admitted deliveries must leave().
+
+        Raises:
+            Shed if the service is overloaded, or the event is over its rate limit
+        """
+        if self.max_queue_depth and self.queue_depth() >= self.max_queue_depth:
+            self._shed(QUEUE_DEPTH, event)
+        with self._lock:
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                overloaded = True
+            else:
+                overloaded = False
+                self.active += 1
+        if overloaded:
+            self._shed(CONCURRENCY, event)
+
+        wait = self.event_limiter.take(event, now) if self.event_limiter is not None else 0
+        if wait:
+            self.leave()
+            self._shed(EVENT_RATE, event, wait)
+
+    def admit_repo(self, repo, event, now=None):
+        """ Admit a delivery once its repo is known.
+
+        Raises:
+            Shed if the repo is over its rate limit
+        """
+        wait = self.repo_limiter.take(repo, now) if self.repo_limiter is not None else 0
+        if wait:
+            self._shed(REPO_RATE, event, wait)
+
+    def leave(self):
+        """ Record that an admitted delivery has been handled. """
+        with self._lock:
+            self.active -= 1
+
+    @staticmethod
+    def _shed(reason, event, wait=1):
+        """ Count and raise the shedding of a delivery. """
+        LOGGER.debug('Shedding a %s event: %s', event, reason)
+        SHED.inc(reason, event)
+        raise Shed(reason, int(math.ceil(wait)))
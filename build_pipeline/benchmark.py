@@ -0,0 +1,328 @@
+""" Load test the webhook server
+
+Starts the service in-process, with SNS replaced by a stub that answers after a
+fixed latency, and drives it with correctly signed webhooks from a number of
+concurrent clients. The service is configured from the environment as usual,
+so for example
+
+    SERVER_MODE=single DISPATCH_WORKERS=0 python -m build_pipeline.benchmark --requests 2000
+
+measures the single-threaded, synchronous setup. Save the report with --output
+and compare a later run against it with --baseline.
+"""
+import argparse
+import hashlib
+import hmac
+import httplib
+import json
+import math
+import random
+import resource
+import sys
+import threading
+import time
+import uuid
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# The mix of events sent by default. On an org-wide webhook most traffic isn't handled.
+DEFAULT_MIX = 'deployment=1,deployment_status=1,push=6,pull_request=2'
+
+# The metrics compared against a baseline, and whether higher is better
+COMPARED = (
+    ('requests_per_second', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False), ('max_rss_kb', False)
+)
+
+
+def percentile(values, fraction):
+    """ The value below which the fraction of the sorted values fall, by nearest rank. """
+    if not values:
+        return None
+    index = max(int(math.ceil(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def _user(login):
+    """ A user object the size of the ones in GitHub payloads. """
+    user = {'login': login, 'id': 1234567, 'type': 'User', 'site_admin': False}
+    for field in ('avatar', 'gravatar', 'url', 'html', 'followers', 'following', 'gists',
+                  'starred', 'subscriptions', 'organizations', 'repos', 'events', 'received_events'):
+        user['{}_url'.format(field)] = 'https://api.github.com/users/{}/{}'.format(login, field)
+    return user
+
+
+def _repository(full_name):
+    """ A repository object the size of the ones in GitHub payloads. """
+    org, name = full_name.split('/')
+    repo = {
+        'id': 12345678, 'name': name, 'full_name': full_name, 'owner': _user(org), 'private': False,
+        'description': 'The {} repository'.format(name), 'fork': False, 'size': 123456,
+        'default_branch': 'master', 'stargazers_count': 100, 'watchers_count': 100, 'forks_count': 50,
+        'open_issues_count': 25, 'created_at': '2013-01-01T00:00:00Z', 'updated_at': '2015-10-01T00:00:00Z',
+    }
+    for field in ('html', 'keys', 'collaborators', 'teams', 'hooks', 'issue_events', 'events', 'assignees',
+                  'branches', 'tags', 'blobs', 'git_tags', 'git_refs', 'trees', 'statuses', 'languages',
+                  'stargazers', 'contributors', 'subscribers', 'subscription', 'commits', 'git_commits',
+                  'comments', 'issue_comment', 'contents', 'compare', 'merges', 'archive', 'downloads',
+                  'issues', 'pulls', 'milestones', 'notifications', 'labels', 'releases', 'deployments'):
+        repo['{}_url'.format(field)] = 'https://api.github.com/repos/{}/{}'.format(full_name, field)
+    return repo
+
+
+def _deployment(rand, full_name):
+    """ A deployment object. """
+    return {
+        'id': rand.randint(1, 10 ** 8), 'sha': '%040x' % rand.getrandbits(160), 'ref': 'master',
+        'task': 'deploy', 'environment': rand.choice(('sandbox', 'staging')), 'payload': {},
+        'description': None, 'creator': _user('jenkins'), 'created_at': '2015-10-01T00:00:00Z',
+        'url': 'https://api.github.com/repos/{}/deployments/1'.format(full_name),
+    }
+
+
+def make_payload(rand, event, handled_repo, commits=20):
+    """ A webhook payload of a realistic size for an event.
+
+    Args:
+        rand (random.Random): source of the varying fields
+        event (string): GitHub event
+        handled_repo (string): full name of the repo that the service handles
+        commits (int): number of commits in push payloads
+
+    Returns:
+        string: the JSON payload
+    """
+    full_name = handled_repo if rand.random() < 0.8 else 'other-org/other-repo'
+    data = {'repository': _repository(full_name), 'sender': _user('someone')}
+    if event == 'deployment':
+        data['deployment'] = _deployment(rand, full_name)
+    elif event == 'deployment_status':
+        data['deployment'] = _deployment(rand, full_name)
+        data['deployment_status'] = {
+            'id': rand.randint(1, 10 ** 8), 'state': rand.choice(('pending', 'success', 'failure')),
+            'creator': _user('jenkins'), 'description': '', 'target_url': '',
+        }
+    elif event == 'push':
+        data['commits'] = [{
+            'id': '%040x' % rand.getrandbits(160), 'message': 'Change number {}'.format(index),
+            'author': {'name': 'Someone', 'email': 'someone@example.com'},
+            'added': [], 'removed': [], 'modified': ['path/to/file_{}.py'.format(index)],
+        } for index in range(commits)]
+        data['ref'] = 'refs/heads/master'
+    else:
+        data['action'] = 'opened'
+        data['number'] = rand.randint(1, 10000)
+        data[event] = {'id': rand.randint(1, 10 ** 8), 'user': _user('someone'), 'body': 'x' * 2000}
+    return json.dumps(data)
+
+
+def make_requests(count, mix, seed=0, commits=20):
+    """ Signed webhook requests in a reproducible order.
+
+    Args:
+        count (int): number of requests
+        mix (dict): relative weight of each GitHub event
+        seed (int): seed of the random choices
+        commits (int): number of commits in push payloads
+
+    Returns:
+        list: of (event, headers, body) tuples
+    """
+    from .helpers import HANDLED_REPO, WEBHOOK_SECRET_TOKEN  # pylint: disable=relative-import
+
+    rand = random.Random(seed)
+    events = []
+    for event, weight in sorted(mix.items()):
+        events.extend([event] * weight)
+
+    requests = []
+    for _ in range(count):
+        event = rand.choice(events)
+        body = make_payload(rand, event, HANDLED_REPO, commits)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': str(uuid.UUID(int=rand.getrandbits(128))),
+            'X-Hub-Signature': 'sha1=' + hmac.new(WEBHOOK_SECRET_TOKEN, body, hashlib.sha1).hexdigest(),
+            'X-Hub-Signature-256': 'sha256=' + hmac.new(WEBHOOK_SECRET_TOKEN, body, hashlib.sha256).hexdigest(),
+        }
+        requests.append((event, headers, body))
+    return requests
+
+
+class StubSns(object):
+    """ Stand-in for publish_sns_messsage that takes a fixed time to answer. """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, topic_arn, message):
+        time.sleep(self.latency)
+        with self._lock:
+            self.published += 1
+        return str(uuid.uuid4())
+
+
+def drive(port, requests, concurrency, keep_alive=False):
+    """ Send the requests from concurrent clients.
+
+    Args:
+        keep_alive (bool): reuse the connection of each client instead of connecting for every request
+
+    Returns:
+        tuple: the latencies in seconds of the successful requests, number of errors
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    position = [0]
+
+    def client():
+        """ Send requests until there are none left. """
+        # httplib reconnects by itself when the server has closed the connection
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                index = position[0]
+                position[0] += 1
+            if index >= len(requests):
+                conn.close()
+                return
+
+            _event, headers, body = requests[index]
+            start = time.time()
+            try:
+                conn.request('POST', '/', body, headers)
+                response = conn.getresponse()
+                response.read()
+                succeeded = response.status == 200
+            except Exception:  # pylint: disable=broad-except
+                succeeded = False
+            if not keep_alive or not succeeded:
+                conn.close()
+            elapsed = time.time() - start
+            with lock:
+                if succeeded:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return latencies, errors[0]
+
+
+def run_benchmark(requests, concurrency, sns_latency, keep_alive=False):
+    """ Run the requests against an in-process server and measure it.
+
+    Returns:
+        dict: the report
+    """
+    from . import helpers  # pylint: disable=relative-import
+    from .build_pipeline import close_server, create_server  # pylint: disable=relative-import
+
+    stub = StubSns(sns_latency)
+    original = helpers.publish_sns_messsage
+    helpers.publish_sns_messsage = stub
+    try:
+        httpd = create_server(('127.0.0.1', 0))
+        server_thread = threading.Thread(target=httpd.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        start = time.time()
+        latencies, errors = drive(httpd.server_address[1], requests, concurrency, keep_alive)
+        elapsed = time.time() - start
+
+        httpd.shutdown()
+        close_server(httpd)
+    finally:
+        helpers.publish_sns_messsage = original
+
+    latencies.sort()
+    return {
+        'server': httpd.__class__.__name__,
+        'requests': len(requests),
+        'concurrency': concurrency,
+        'keep_alive': keep_alive,
+        'sns_latency_ms': sns_latency * 1000,
+        'mean_payload_bytes': sum(len(body) for _, _, body in requests) // max(len(requests), 1),
+        'errors': errors,
+        'published': stub.published,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': _ms(percentile(latencies, 0.50)),
+        'p95_ms': _ms(percentile(latencies, 0.95)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+        # Includes the client threads, which run in the same process
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _ms(seconds):
+    """ Seconds as rounded milliseconds. """
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def compare(report, baseline):
+    """ Lines describing how the report differs from a baseline report. """
+    lines = []
+    for key, higher_is_better in COMPARED:
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) * 100.0 / old
+        better = change > 0 if higher_is_better else change < 0
+        lines.append('{:<20} {:>12} -> {:>12} {:+7.1f}% {}'.format(
+            key, old, new, change, 'better' if better else 'worse' if change else ''
+        ))
+    return lines
+
+
+def parse_mix(mix):
+    """ Parse a mix such as deployment=1,push=8 into a dict of weights. """
+    weights = {}
+    for item in mix.split(','):
+        event, _, weight = item.partition('=')
+        weights[event.strip()] = int(weight or 1)
+    return weights
+
+
+def main(argv=None):
+    """ Run the benchmark from the command line. """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='number of webhooks to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='relative weights of the GitHub events')
+    parser.add_argument('--sns-latency', type=float, default=0.05, help='seconds that the stub SNS takes to publish')
+    parser.add_argument('--commits', type=int, default=20, help='number of commits in push payloads')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse the connection of each client')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated requests')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--baseline', help='compare with a report written by an earlier run')
+    args = parser.parse_args(argv)
+
+    # Keep the log output of the service from skewing the measurements
+    logging.getLogger('build_pipeline').setLevel(logging.WARNING)
+
+    requests = make_requests(args.requests, parse_mix(args.mix), args.seed, args.commits)
+    report = run_benchmark(requests, args.concurrency, args.sns_latency, args.keep_alive)
+    print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print '\n'.join(compare(report, json.load(baseline_file)))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    return 0 if report['errors'] == 0 else 1
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
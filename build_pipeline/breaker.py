@@ -0,0 +1,123 @@
+"""
+Circuit breaker, to fail fast while a downstream service is failing
+"""
+from collections import deque
+import os
+import threading
+import time
+
+from .metrics import CIRCUIT_REJECTED, CIRCUIT_STATE, CIRCUIT_TRIPS  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Set to 'false' to always call SNS, however often it fails
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', 'true').lower() == 'true'
+
+# Number of the most recent calls that the error rate is taken over
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+
+# Fewest calls in the window for the breaker to open
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '5'))
+
+# Fraction of failed calls in the window at which the breaker opens
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', '0.5'))
+
+# Seconds that the breaker stays open before it lets a call through to probe the service
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', '30'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# The values of the states in the state gauge
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """ Stops calling a service once too many of the recent calls have failed.
+
+    The breaker opens when the error rate of the last calls reaches the
+    threshold, and then rejects the calls. After the reset timeout it lets one
+    call through: the breaker closes again when that call succeeds, and stays
+    open for another timeout when it fails.
+
+    Args:
+        name (string): name of the circuit in the logs and metrics
+        window (int): number of recent calls that the error rate is taken over
+        min_calls (int): fewest calls in the window for the breaker to open
+        error_rate (float): fraction of failed calls at which the breaker opens
+        reset_timeout (float): seconds before a call is let through to probe the service
+    """
+    def __init__(self, name, window=None, min_calls=None, error_rate=None, reset_timeout=None):
+        self.name = name
+        self.min_calls = BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.error_rate = BREAKER_ERROR_RATE if error_rate is None else error_rate
+        self.reset_timeout = BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        self.state = CLOSED
+        self.trips = 0
+        self._results = deque(maxlen=BREAKER_WINDOW if window is None else window)
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], name)
+
+    @classmethod
+    def from_env(cls, name):
+        """ Create a breaker from the environment settings, None if BREAKER_ENABLED is off. """
+        if not BREAKER_ENABLED:
+            return None
+        return cls(name)
+
+    def allow(self, now=None):
+        """ Whether to make a call. A call that is allowed must be followed by record().
+
+        Returns:
+            bool: False when the breaker is open, or another call is already probing the service
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and (now or time.time()) - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        CIRCUIT_REJECTED.inc(self.name)
+        return False
+
+    def record(self, success, now=None):
+        """ Record the outcome of a call that was allowed. """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._results.clear()
+                    self._set_state(CLOSED)
+                else:
+                    self._trip(now)
+                return
+
+            self._results.append(success)
+            if self.state != CLOSED or len(self._results) < self.min_calls:
+                return
+            failures = self._results.count(False)
+            if failures >= self.error_rate * len(self._results):
+                LOGGER.warning(
+                    'Opening the %s circuit: %s of the last %s calls failed', self.name, failures, len(self._results)
+                )
+                self._trip(now)
+
+    def _trip(self, now):
+        """ Open the breaker. Called with the lock held. """
+        self._opened_at = now or time.time()
+        self.trips += 1
+        CIRCUIT_TRIPS.inc(self.name)
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        """ Move to a state. Called with the lock held. """
+        if state != self.state:
+            LOGGER.warning('The %s circuit is %s', self.name, state.replace('_', ' '))
+        self.state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], self.name)
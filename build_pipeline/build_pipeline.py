@@ -7,69 +7,617 @@ Components include:
 * Jenkins servers configured with the GitHub SQS Plugin
 * Jenkins jobs configured to post to the GitHub deployment and deployment status APIs
 """
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+from functools import partial
+import hmac
 import json
 import os
+import signal
+import time
+from urlparse import parse_qs
 
-from .helpers import SnsError, parse_webhook_payload, is_valid_gh_event  # pylint: disable=relative-import
+from . import dedup, helpers  # pylint: disable=relative-import
+from .admission import AdmissionControl, Shed  # pylint: disable=relative-import
+from .breaker import CircuitBreaker  # pylint: disable=relative-import
+from .capture import DeliveryCapture, request_headers  # pylint: disable=relative-import
+from .debounce import DeploymentDebouncer  # pylint: disable=relative-import
+from .deployments import DeploymentIndex  # pylint: disable=relative-import
+from .dedup import DeliveryCache  # pylint: disable=relative-import
+from .dispatch import Dispatcher, DISPATCH_FLUSH_TIMEOUT  # pylint: disable=relative-import
+from .fanout import FanOut  # pylint: disable=relative-import
+from .outbox import Outbox, SnsDeferredError  # pylint: disable=relative-import
+from . import metrics  # pylint: disable=relative-import
+from .metrics import REGISTRY, STAGE_SECONDS, WEBHOOKS  # pylint: disable=relative-import
+from .helpers import (  # pylint: disable=relative-import
+    PayloadTooLargeError, SnsError, extract_webhook_fields, is_handled_event, is_valid_gh_payload,
+    may_concern_handled_repo, new_signature_verifier, parse_webhook_payload, read_chunked_payload, read_payload
+)
+from .logs import configure_logging  # pylint: disable=relative-import
+from .prefork import SERVER_PREFORK, Supervisor, worker_count  # pylint: disable=relative-import
+from .profiling import PROFILE_SIGNAL_REQUESTS, PROFILE_TOKEN, RequestProfiler  # pylint: disable=relative-import
+from .routing import RoutingConfigError, RoutingTable  # pylint: disable=relative-import
+from .servers import (  # pylint: disable=relative-import
+    KEEPALIVE_MAX_REQUESTS, KEEPALIVE_TIMEOUT, create_listener, get_server_class, listening_server
+)
+from .tracing import new_trace  # pylint: disable=relative-import
+from .transports import transport_from_env  # pylint: disable=relative-import
+from .warmup import Warmup  # pylint: disable=relative-import
 
 import logging
 import sys
 LOGGER = logging.getLogger(__name__)
 
-# Send the output to stdout so it will get handled with the Heroku logging service
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+# When the service finished importing, for the start-up timings
+IMPORTED_AT = time.time()
 
-# TODO: this isn't suppressing the logging, not sure why
-logging.getLogger('requests').setLevel(logging.ERROR)
-logging.getLogger('boto').setLevel(logging.ERROR)
+# The outcomes of handling a webhook delivery
+INVALID_REQUEST = 'invalid_request'
+LENGTH_REQUIRED = 'length_required'
+TOO_LARGE = 'too_large'
+IGNORED = 'ignored'
+INVALID_SIGNATURE = 'invalid_signature'
+DUPLICATE = 'duplicate'
+INVALID_PAYLOAD = 'invalid_payload'
+QUEUED = 'queued'
+DROPPED = 'dropped'
+PUBLISHED = 'published'
+DEFERRED = 'deferred'
+SNS_ERROR = 'sns_error'
+RATE_LIMITED = 'rate_limited'
+OVERLOADED = 'overloaded'
+
+# The status codes of the outcomes that aren't answered with a 200. The request
+# may not have been read to the end for these, so the connection is closed as well.
+ERROR_STATUS = {
+    INVALID_REQUEST: 400,
+    LENGTH_REQUIRED: 411,
+    TOO_LARGE: 413,
+    RATE_LIMITED: 429,
+    OVERLOADED: 503,
+}
 
 
 class PipelineHttpRequestHandler(BaseHTTPRequestHandler):
     """
     Handler for the HTTP service.
     """
-    protocol = "HTTP/1.1"
+    protocol_version = "HTTP/1.1"
+
+    # Applies to the socket of the connection: closes idle persistent connections
+    timeout = KEEPALIVE_TIMEOUT
+
+    # Number of requests answered on the connection so far
+    requests_served = 0
+
+    # Set by handle() for each request: whether the connection is closed after it
+    close_connection = 1
+
+    # Whether the current request was answered, which may be before it is published
+    responded = False
+
+    # The payload of the current request, kept for the capture
+    contents = None
+
+    # Seconds GitHub is told to wait before delivering a shed request again
+    retry_after = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serve the metrics and the health of the service. Webhooks are only ever POSTed.
+
+        /healthz answers 200 while the process serves requests, and /ready
+        answers 503 until the process has warmed up. Both describe the warm-up.
+        /deployments serves the newest deployment to each environment.
+        """
+        path, _, query = self.path.partition('?')
+        if path == '/metrics':
+            status, content_type, body = 200, metrics.CONTENT_TYPE, REGISTRY.render()
+        elif path in ('/healthz', '/ready'):
+            warmup = getattr(self.server, 'warmup', None)
+            state = warmup.describe() if warmup is not None else {'state': 'done', 'ready': True, 'timings': {}}
+            status = 200 if path == '/healthz' or state['ready'] else 503
+            content_type, body = 'application/json', json.dumps(state, sort_keys=True)
+        elif path == '/deployments':
+            status, state = self._describe_deployments(parse_qs(query))
+            content_type, body = 'application/json', json.dumps(state, sort_keys=True)
+        else:
+            self.send_error(501, "Unsupported method ('GET')")
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_POST(self):  # pylint: disable=invalid-name
         """
         Respond to the HTTP POST request sent by GitHub WebHooks
         """
-        # Send a response back to the webhook
-        LOGGER.debug("Sending a 200 HTTP response back to the webhook")
-        self.send_response(200)
+        if self.path.partition('?')[0] == '/profile':
+            self._request_profiling()
+            return
+        self.responded = False
+        self.contents = None
+        self.retry_after = None
+        received_at = time.time()
+        event = self.headers.get('X-GitHub-Event')
+        # Don't let arbitrary header values blow up the number of metric label sets
+        event_label = event if is_handled_event(event) else 'other'
+        admission = getattr(self.server, 'admission', None) if is_handled_event(event) else None
+        profiler = getattr(self.server, 'profiler', None)
+        with STAGE_SECONDS.time('total', event_label):
+            if profiler is not None and profiler.sample():
+                outcome = profiler.run(self._handle_delivery, admission, event, event_label, received_at)
+            else:
+                outcome = self._handle_delivery(admission, event, event_label, received_at)
+        self._finish_delivery(outcome, event_label, received_at)
+
+    def _finish_delivery(self, outcome, event_label, received_at):
+        """
+        Count the outcome of the delivery and answer it, unless it was answered before
+        it was published. The delivery is then handed to the capture.
+        """
+        WEBHOOKS.inc(event_label, outcome)
+
+        if not self.responded:
+            status = ERROR_STATUS.get(outcome, 200)
+            self.respond(status, close=status != 200)
+
+        capture = getattr(self.server, 'capture', None)
+        if capture is not None and self.contents is not None:
+            capture.record(request_headers(self.headers), self.contents, received_at, outcome)
+        warmup = getattr(self.server, 'warmup', None)
+        if warmup is not None:
+            warmup.request_done(received_at)
+
+    @staticmethod
+    def _describe_deployments(params):
+        """ The newest deployment to an environment given by the repo and environment
+        parameters, or to every environment of the repo, or of all repos.
+
+        Returns:
+            tuple: the status code and the state to serve
+        """
+        index = helpers.DEPLOYMENT_INDEX
+        if index is None:
+            return 404, {'error': 'The deployment index is turned off'}
+        repo = params.get('repo', [None])[0]
+        environment = params.get('environment', [None])[0]
+        if environment is None:
+            return 200, {'deployments': index.environments(repo)}
+        if repo is None:
+            return 400, {'error': 'The environment must be given along with the repo'}
+        deployment = index.get(repo, environment)
+        if deployment is None:
+            return 404, {'error': 'No deployment of {} to {} is known'.format(repo, environment)}
+        return 200, deployment
+
+    def respond(self, status, close=False):
+        """
+        Send an empty response, closing the connection when asked to
+        or when it has served its share of requests.
+        """
+        LOGGER.debug("Sending a %s HTTP response back to the webhook", status)
+        self.responded = True
+        self.requests_served += 1
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if self.retry_after:
+            self.send_header('Retry-After', str(self.retry_after))
+        if close or self.requests_served >= KEEPALIVE_MAX_REQUESTS:
+            # Also sets close_connection
+            self.send_header('Connection', 'close')
         self.end_headers()
 
+    def _request_profiling(self):
+        """
+        Profile the next requests, as many as the requests parameter says,
+        when asked with PROFILE_TOKEN as the bearer token.
+        """
+        # The body is not read, so the connection can't be used again
+        self.close_connection = 1
+        profiler = getattr(self.server, 'profiler', None)
+        authorization = self.headers.get('Authorization', '')
+        params = parse_qs(self.path.partition('?')[2])
+        if profiler is None or not PROFILE_TOKEN:
+            status, state = 404, {'error': 'Profiling is turned off'}
+        elif not hmac.compare_digest(authorization, 'Bearer ' + PROFILE_TOKEN):
+            status, state = 403, {'error': 'Not allowed'}
+        else:
+            try:
+                count = int(params.get('requests', [PROFILE_SIGNAL_REQUESTS])[0])
+            except ValueError:
+                count = -1
+            if count < 1:
+                status, state = 400, {'error': 'The requests parameter must be a positive number'}
+            else:
+                profiler.request(count)
+                status, state = 200, {'requests': count, 'directory': profiler.directory}
+
+        body = json.dumps(state, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle_delivery(self, admission, event, event_label, received_at):
+        """
+        Handle the webhook, through the admission control if there is one.
+
+        Returns:
+            string: the outcome, for the metrics
+        """
+        if admission is None:
+            return self._handle_webhook(event, event_label, received_at)
+        return self._admit_webhook(admission, event, event_label, received_at)
+
+    def _admit_webhook(self, admission, event, event_label, received_at):
+        """
+        Handle the webhook if the admission control lets it in, and the deliveries
+        of its repo are within their rate limit.
+
+        Returns:
+            string: the outcome, for the metrics
+        """
+        try:
+            admission.enter(event)
+        except Shed as shed:
+            return self._shed(shed)
+        try:
+            return self._handle_webhook(event, event_label, received_at)
+        except Shed as shed:
+            return self._shed(shed)
+        finally:
+            admission.leave()
+
+    def _shed(self, shed):
+        """ Turn away a delivery, telling GitHub when to try again. """
+        self.retry_after = shed.retry_after
+        return RATE_LIMITED if shed.status == 429 else OVERLOADED
+
+    def _handle_webhook(self, event, event_label, received_at):
+        """
+        Validate the webhook and pass it on to the downstream handlers, along with its trace.
+
+        Returns:
+            string: the outcome, for the metrics
+
+        Raises:
+            Shed if the repo of the webhook is over its rate limit
+        """
+        outcome = self._read_webhook(event, event_label)
+        if outcome is not None:
+            return outcome
+        contents = self.contents
+
+        if not may_concern_handled_repo(contents):
+            LOGGER.debug("Ignoring a %s event from an unhandled repo.", event)
+            return IGNORED
+
+        # Don't trigger the downstream jobs again when GitHub redelivers a webhook
+        delivery_cache = getattr(self.server, 'delivery_cache', None)
+        delivery_key = None
+        if delivery_cache is not None:
+            delivery_id = self.headers.get('X-GitHub-Delivery')
+            delivery_key = delivery_cache.key(delivery_id, contents)
+            if delivery_key and delivery_cache.seen(delivery_key):
+                LOGGER.info("Ignoring the redelivery of %s event %s.", event, delivery_id)
+                return DUPLICATE
+
+        data = self._decode_webhook(event_label, contents, received_at)
+        if data is None:
+            return INVALID_PAYLOAD
+
+        admission = getattr(self.server, 'admission', None)
+        if admission is not None:
+            try:
+                admission.admit_repo(data['repository']['full_name'], event)
+            except Shed:
+                # Let the redelivery through
+                if delivery_key:
+                    delivery_cache.forget(delivery_key)
+                raise
+
+        # Let a redelivery of the webhook try again if the event fails to be published
+        on_failure = partial(delivery_cache.forget, delivery_key) if delivery_key else None
+        return self._publish_webhook(event, event_label, data, on_failure)
+
+    def _read_webhook(self, event, event_label):
+        """
+        Read the payload of the webhook into contents, verifying its signature as it is read.
+
+        Returns:
+            string: the outcome if the webhook goes no further, None otherwise
+        """
+        # Prefer the SHA-256 signature when GitHub sends both
+        signature = self.headers.get('X-Hub-Signature-256') or self.headers.get('X-Hub-Signature')
+
+        chunked = 'chunked' in (self.headers.get('Transfer-Encoding') or '').lower()
+        length = self.headers.getheader('content-length')
+        if not chunked:
+            if length is None:
+                LOGGER.error("The POST request has neither a Content-Length nor a chunked body.")
+                return LENGTH_REQUIRED
+            try:
+                length = int(length)
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                LOGGER.error("Could not interpret the POST request.")
+                return INVALID_REQUEST
+
+        # Verify the signature as the payload is read, so that
+        # only payloads that came from GitHub get decoded.
+        # The payloads of events that are never handled are only read
+        # to clear them off the connection.
+        handled = is_handled_event(event)
+        verifier = new_signature_verifier(signature, event) if handled else None
+        try:
+            with STAGE_SECONDS.time('read', event_label):
+                if chunked:
+                    contents = read_chunked_payload(self.rfile, verifier)
+                else:
+                    contents = read_payload(self.rfile, length, verifier)
+        except PayloadTooLargeError as err:
+            LOGGER.error('%s', err)
+            return TOO_LARGE
+        except ValueError as err:
+            LOGGER.error("Could not read the POST request: %s", err)
+            return INVALID_REQUEST
+        # Kept for the capture of the delivery
+        self.contents = contents
+
+        if not handled:
+            LOGGER.debug("%s events do not need to be handled.", event)
+            return IGNORED
+
+        if verifier is None:
+            return INVALID_SIGNATURE
+        with STAGE_SECONDS.time('verify', event_label):
+            if not verifier.verify():
+                return INVALID_SIGNATURE
+        return None
+
+    def _decode_webhook(self, event_label, contents, received_at):
+        """
+        Decode the payload of the webhook, keeping the fields the handlers use along with its trace.
+
+        Returns:
+            dict: the fields of the webhook, None if the payload can't be interpreted
+        """
         # Retrieve the request POST json from the client as a dictionary.
         # If no POST json can be interpreted, don't do anything.
         try:
-            length = int(self.headers.getheader('content-length'))
-            contents = self.rfile.read(length)
-            data = json.loads(contents)
-        except (TypeError, ValueError):
+            with STAGE_SECONDS.time('decode', event_label):
+                data = json.loads(contents)
+        except ValueError:
             LOGGER.error("Could not interpret the POST request.")
-            return
+            return None
 
-        event = self.headers.get('X-GitHub-Event')
-        signature = self.headers.get('X-Hub-Signature')
+        if not is_valid_gh_payload(data):
+            return None
+        data = extract_webhook_fields(data)
+        data['trace'] = new_trace(self.headers.get('X-GitHub-Delivery'), data, received_at)
+        return data
+
+    def _publish_webhook(self, event, event_label, data, on_failure):
+        """
+        Publish the webhook to the downstream handlers, or queue it for the dispatcher.
+
+        Returns:
+            string: the outcome, for the metrics
+        """
+        # Leave the publishing to the background workers when the server has a dispatcher
+        dispatcher = getattr(self.server, 'dispatcher', None)
+        if dispatcher is not None:
+            LOGGER.debug("Queueing GitHub event: %s", event)
+            return QUEUED if dispatcher.submit(event, data, on_failure=on_failure) else DROPPED
+
+        # Don't keep GitHub waiting while the event is published
+        self.respond(200)
+        try:
+            LOGGER.debug("Received GitHub event: %s", event)
+            with STAGE_SECONDS.time('route', event_label):
+                msg_id = parse_webhook_payload(event, data, on_failure=on_failure)
+
+        except SnsDeferredError, err:
+            LOGGER.warning('%s', err)
+            return DEFERRED
+
+        except SnsError, err:
+            LOGGER.error('%s', err)
+            if on_failure:
+                on_failure()
+            return SNS_ERROR
+
+        return PUBLISHED if msg_id else IGNORED
+
+
+def _exit_on_signal(signum, _frame):  # pragma: no cover
+    """ Unwind serve_forever() so that the server gets closed down cleanly. """
+    LOGGER.info('Received signal %s, shutting down', signum)
+    raise SystemExit(0)
 
-        if is_valid_gh_event(signature, event, contents, data):
-            try:
-                LOGGER.debug("Received GitHub event: {}".format(event))
-                parse_webhook_payload(event, data)
 
-            except SnsError, err:
-                LOGGER.error(str(err))
+def _reload_on_signal(signum, _frame):  # pragma: no cover
+    """ Reload the routing config when sent a SIGHUP. """
+    LOGGER.info('Received signal %s, reloading the routing config', signum)
+    reload_routing_table()
 
 
-def run(server_class=HTTPServer, handler_class=PipelineHttpRequestHandler):  # pragma: no cover
-    """ Start up a single-threaded server to handle the requests """
+def _profile_on_signal(httpd, signum, _frame):  # pragma: no cover
+    """ Profile the next PROFILE_SIGNAL_REQUESTS requests when sent a SIGUSR2. """
+    if httpd.profiler is None:
+        LOGGER.info('Received signal %s, but profiling is turned off', signum)
+        return
+    LOGGER.info('Received signal %s, profiling the next requests', signum)
+    httpd.profiler.request(PROFILE_SIGNAL_REQUESTS)
+
+
+def reload_routing_table():
+    """ Load the routing config again, keeping the current routes if the new config can't be used.
+
+    The routing table is swapped in one go, so the requests being handled
+    meanwhile are routed by either the old or the new one.
+
+    Returns:
+        bool: whether the routes were reloaded
+    """
+    try:
+        table = RoutingTable.from_env()
+    except (IOError, RoutingConfigError) as err:
+        LOGGER.error('Keeping the current routes, the routing config could not be loaded: %s', err)
+        return False
+    helpers.ROUTING_TABLE = table
+    return True
+
+
+def create_server(server_address, server_class=None, handler_class=PipelineHttpRequestHandler, listener=None,
+                  worker=None):
+    """ Create a server along with the components configured in the environment.
+
+    The server class defaults to the one for the configured SERVER_MODE. Given
+    a listener, the server accepts connections on that socket instead of
+    listening on the server address. Given the number of a pre-fork worker,
+    the server leaves draining the outbox to the parent process, and keeps
+    a deployment index snapshot of its own.
+    """
+    if server_class is None:
+        server_class = get_server_class()
+
+    if listener is not None:
+        httpd = listening_server(server_class, listener, handler_class)
+    else:
+        httpd = server_class(server_address, handler_class)
+    httpd.dispatcher = Dispatcher.from_env()
+    httpd.delivery_cache = DeliveryCache.from_env()
+    httpd.admission = AdmissionControl.from_env(httpd.dispatcher)
+    httpd.capture = DeliveryCapture.from_env()
+    httpd.profiler = RequestProfiler.from_env()
+    helpers.TRANSPORT = transport_from_env()
+    helpers.SNS_BREAKER = CircuitBreaker.from_env('sns')
+    helpers.DEPLOYMENT_DEBOUNCER = DeploymentDebouncer.from_env()
+    helpers.DEPLOYMENT_INDEX = DeploymentIndex.from_env(worker)
+    helpers.OUTBOX = Outbox.from_env(drain=worker is None)
+    helpers.FANOUT = FanOut.from_env()
+    helpers.ROUTING_TABLE = RoutingTable.from_env()
+    # The server is accepting connections by now, and the warm-up goes on in the background
+    httpd.warmup = Warmup.from_env()
+    httpd.warmup.start(IMPORTED_AT)
+    return httpd
+
+
+def close_server(httpd):
+    """ Close down a server made by create_server, finishing the work that it has taken on. """
+    # Finish the requests already accepted, then publish the events they queued up
+    httpd.server_close()
+    if httpd.dispatcher is not None:
+        httpd.dispatcher.shutdown(timeout=DISPATCH_FLUSH_TIMEOUT)
+    # Don't wait out the debounce window of the deployments being held back
+    if helpers.DEPLOYMENT_DEBOUNCER is not None:
+        helpers.DEPLOYMENT_DEBOUNCER.flush()
+    if helpers.FANOUT is not None:
+        helpers.FANOUT.shutdown(timeout=DISPATCH_FLUSH_TIMEOUT)
+    # Whatever could not be published is retried from the outbox on the next start
+    if helpers.OUTBOX is not None:
+        helpers.OUTBOX.stop()
+    # Saves the last snapshot, after the last jobs have been triggered
+    if helpers.DEPLOYMENT_INDEX is not None:
+        helpers.DEPLOYMENT_INDEX.stop()
+    if httpd.capture is not None:
+        httpd.capture.stop()
+    # Writes out the requests profiled since the last profile
+    if httpd.profiler is not None:
+        httpd.profiler.flush()
+    if httpd.delivery_cache is not None:
+        LOGGER.info('Delivery cache hits: %s, misses: %s', httpd.delivery_cache.hits, httpd.delivery_cache.misses)
+    # Don't leave the stopped components to whatever runs in the process next
+    helpers.TRANSPORT = None
+    helpers.SNS_BREAKER = None
+    helpers.DEPLOYMENT_DEBOUNCER = None
+    helpers.DEPLOYMENT_INDEX = None
+    helpers.OUTBOX = None
+    helpers.FANOUT = None
+    helpers.ROUTING_TABLE = None
+
+
+def check_prefork():
+    """ Make sure that the components configured work across the pre-fork worker processes.
+
+    Raises:
+        ValueError if redeliveries would only be recognized by the worker that handled the first delivery
+    """
+    if dedup.DEDUP_ENABLED and not dedup.DEDUP_REDIS_URL:
+        raise ValueError(
+            'SERVER_PREFORK needs DEDUP_REDIS_URL, so that the worker processes share the delivery cache. '
+            'Set DEDUP_ENABLED to false to serve without detecting redeliveries.'
+        )
+
+
+def serve(httpd):  # pragma: no cover
+    """ Serve requests until SIGTERM, then close down the server cleanly. """
+    # Heroku sends a SIGTERM when stopping or restarting a dyno
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    signal.signal(signal.SIGHUP, _reload_on_signal)
+    signal.signal(signal.SIGUSR2, partial(_profile_on_signal, httpd))
+
+    LOGGER.debug(
+        'Starting %s on port %s in process %s', httpd.__class__.__name__, httpd.server_port, os.getpid()
+    )
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_server(httpd)
+
+
+def run(server_class=None, handler_class=PipelineHttpRequestHandler):  # pragma: no cover
+    """ Start up a server to handle the requests.
+
+    The server class defaults to the one for the configured SERVER_MODE.
+    With SERVER_PREFORK, a server runs in each of the worker processes,
+    and the parent process drains the outbox.
+    """
     port = int(os.environ.get('PORT', '0'))
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+    log_listener = configure_logging()
+    try:
+        if not SERVER_PREFORK:
+            serve(create_server(server_address, server_class, handler_class))
+            return
+
+        check_prefork()
+        listener = create_listener(server_address)
+        LOGGER.debug('Listening on port %s for the worker processes', listener.getsockname()[1])
+        # Each worker creates its own server after the fork, since threads don't survive forking
+        supervisor = Supervisor(
+            worker_count(), partial(_serve_worker, server_address, server_class, handler_class, listener)
+        )
+        # The one drainer of the outbox that the workers write to
+        outbox = Outbox.from_env()
+        try:
+            supervisor.run()
+        finally:
+            listener.close()
+            if outbox is not None:
+                outbox.stop()
+    finally:
+        if log_listener is not None:
+            log_listener.stop()
+
 
-    LOGGER.debug('Starting service on port {0}'.format(httpd.server_port))
-    httpd.serve_forever()
+def _serve_worker(server_address, server_class, handler_class, listener, worker):  # pragma: no cover
+    """ Serve in a worker process, which needs a log listener thread of its own as well. """
+    log_listener = configure_logging()
+    try:
+        serve(create_server(server_address, server_class, handler_class, listener, worker))
+    finally:
+        if log_listener is not None:
+            log_listener.stop()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,265 @@
+"""
+Recording of the webhook deliveries as they were received, for debugging and replay
+
+Deliveries are appended to gzipped segments of JSON lines in the format that
+replay.py reads, by a background thread so that the requests don't wait for
+the disk. A segment is closed once it holds CAPTURE_SEGMENT_BYTES of records,
+and next to each one an index lists the delivery ids it holds and on which lines.
+"""
+import base64
+from datetime import datetime
+import gzip
+import json
+import os
+from Queue import Empty, Full, Queue
+import threading
+import time
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Directory to record the deliveries in. Nothing is recorded when it is not set.
+CAPTURE_DIR = os.environ.get('CAPTURE_DIR')
+
+# Uncompressed bytes of records after which a segment is closed and the next one started
+CAPTURE_SEGMENT_BYTES = int(os.environ.get('CAPTURE_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+
+# Hours that segments are kept for
+CAPTURE_RETENTION_HOURS = float(os.environ.get('CAPTURE_RETENTION_HOURS', '168'))
+
+# Number of deliveries waiting to be written, beyond which deliveries are not recorded
+CAPTURE_QUEUE_SIZE = int(os.environ.get('CAPTURE_QUEUE_SIZE', '10000'))
+
+# Seconds after which the records that have been written are flushed to the segment
+CAPTURE_FLUSH_INTERVAL = float(os.environ.get('CAPTURE_FLUSH_INTERVAL', '1'))
+
+# Seconds between the checks for segments that are past the retention period
+_PRUNE_INTERVAL = 3600
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+INDEX_SUFFIX = '.idx'
+
+
+def request_headers(headers):
+    """ The headers of a request as received, from the mimetools.Message of BaseHTTPRequestHandler. """
+    items = []
+    for line in headers.headers:
+        name, _, value = line.partition(':')
+        if value:
+            items.append((name.strip(), value.strip()))
+    return dict(items)
+
+
+def delivery_record(headers, contents, received_at, outcome=None):
+    """ A delivery as one line of a segment.
+
+    Bodies that are not UTF-8 are recorded as body_base64, so that every byte is kept.
+    """
+    record = {'headers': headers, 'received_at': received_at, 'outcome': outcome}
+    try:
+        record['body'] = contents.decode('utf-8')
+    except UnicodeDecodeError:
+        record['body_base64'] = base64.b64encode(contents)
+    return json.dumps(record, sort_keys=True)
+
+
+def _delivery_id(headers):
+    """ The X-GitHub-Delivery header of a delivery, whatever its case. """
+    for name, value in headers.items():
+        if name.lower() == 'x-github-delivery':
+            return value
+    return None
+
+
+def find_deliveries(directory, delivery_ids):
+    """ Look deliveries up by id in the indexes of the segments in a directory.
+
+    Yields:
+        tuple: the location of each delivery found, and the delivery as a dict
+    """
+    wanted = set(delivery_ids)
+    lines_by_segment = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(INDEX_SUFFIX):
+            continue
+        segment = os.path.join(directory, name[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX)
+        with open(os.path.join(directory, name)) as index:
+            for line in index:
+                delivery_id, _, number = line.rstrip('\n').partition('\t')
+                if delivery_id in wanted and number:
+                    lines_by_segment.setdefault(segment, set()).add(int(number))
+
+    for segment in sorted(lines_by_segment):
+        numbers = lines_by_segment[segment]
+        with gzip.open(segment) as stream:
+            for number, line in enumerate(stream, 1):
+                if number in numbers:
+                    yield '{}:{}'.format(segment, number), json.loads(line)
+                    numbers.discard(number)
+                    if not numbers:
+                        break
+
+
+class _Segment(object):
+    """ A segment being written, along with its index. """
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = gzip.open(path + SEGMENT_SUFFIX, 'ab')
+        self.index = open(path + INDEX_SUFFIX, 'a')
+        self.size = 0
+        self.lines = 0
+
+    def write(self, delivery_id, line):
+        """ Append a record. """
+        self.stream.write(line + '\n')
+        self.size += len(line) + 1
+        self.lines += 1
+        if delivery_id:
+            self.index.write('{}\t{}\n'.format(delivery_id, self.lines))
+
+    def flush(self):
+        """ Make the records written so far readable. """
+        self.stream.flush()
+        self.index.flush()
+
+    def close(self):
+        """ Finish the segment. """
+        self.stream.close()
+        self.index.close()
+
+
+class DeliveryCapture(object):
+    """ Records deliveries to segments in a directory, on a background thread.
+
+    Args:
+        directory (string): directory of the segments
+        segment_bytes (int): uncompressed bytes after which a segment is closed
+        retention_hours (float): hours that segments are kept for
+        queue_size (int): deliveries waiting to be written, beyond which deliveries are dropped
+    """
+    def __init__(self, directory, segment_bytes=None, retention_hours=None, queue_size=None):
+        self.directory = directory
+        self.segment_bytes = CAPTURE_SEGMENT_BYTES if segment_bytes is None else segment_bytes
+        self.retention_hours = CAPTURE_RETENTION_HOURS if retention_hours is None else retention_hours
+        self.queue = Queue(maxsize=CAPTURE_QUEUE_SIZE if queue_size is None else queue_size)
+        self.written = 0
+        self.dropped = 0
+        self._segment = None
+        self._sequence = 0
+        self._writer = None
+
+    @classmethod
+    def from_env(cls):
+        """ Create and start a capture from the environment settings, None if there is no CAPTURE_DIR. """
+        if not CAPTURE_DIR:
+            return None
+        capture = cls(CAPTURE_DIR)
+        capture.start()
+        return capture
+
+    def start(self):
+        """ Start the background writer. """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.prune()
+        self._writer = threading.Thread(target=self._write_forever, name='capture')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def record(self, headers, contents, received_at, outcome=None):
+        """ Queue up a delivery to be recorded, without waiting for it to be written.
+
+        Args:
+            headers (dict): request headers as received
+            contents (string): raw body of the request
+            received_at (float): time the request was received
+            outcome (string): what came of the delivery
+        """
+        try:
+            self.queue.put_nowait((headers, contents, received_at, outcome))
+        except Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                LOGGER.warning('Dropped %s deliveries that the capture could not keep up with', self.dropped)
+
+    def stop(self, timeout=None):
+        """ Write the deliveries that are queued up and close the segment. """
+        if self._writer is None:
+            return
+        self.queue.put(None)
+        self._writer.join(timeout)
+        self._writer = None
+
+    def prune(self, now=None):
+        """ Delete the segments and indexes older than the retention period.
+
+        Returns:
+            int: number of files deleted
+        """
+        cutoff = (now or time.time()) - self.retention_hours * 3600
+        current = self._segment.path if self._segment is not None else None
+        deleted = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith((SEGMENT_SUFFIX, INDEX_SUFFIX)) or (current and path.startswith(current)):
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except OSError:
+                # Pruned by another worker process in the meantime
+                pass
+        return deleted
+
+    def write(self, headers, contents, received_at, outcome=None):
+        """ Write a delivery to the current segment, starting a new one when it is full. """
+        if self._segment is None:
+            self._segment = _Segment(self._segment_path())
+        self._segment.write(_delivery_id(headers), delivery_record(headers, contents, received_at, outcome))
+        self.written += 1
+        if self._segment.size >= self.segment_bytes:
+            self._segment.close()
+            self._segment = None
+            self.prune()
+
+    def _segment_path(self):
+        """ The path of a new segment, without its suffix. Worker processes each write their own. """
+        self._sequence += 1
+        return os.path.join(self.directory, 'deliveries-{}-{}-{:04d}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid(), self._sequence
+        ))
+
+    def _write_forever(self):
+        """ Write the queued deliveries until stopped, flushing them at least every CAPTURE_FLUSH_INTERVAL. """
+        last_flush = last_prune = time.time()
+        unflushed = False
+        while True:
+            try:
+                item = self.queue.get(timeout=CAPTURE_FLUSH_INTERVAL)
+            except Empty:
+                item = False
+
+            if item:
+                try:
+                    self.write(*item)
+                    unflushed = True
+                except (IOError, OSError) as err:
+                    LOGGER.error('Could not record a delivery: %s', err)
+            if item is None:
+                break
+
+            now = time.time()
+            if unflushed and self._segment is not None and now - last_flush >= CAPTURE_FLUSH_INTERVAL:
+                self._segment.flush()
+                unflushed = False
+                last_flush = now
+            # Segments also expire when there is too little traffic to fill them
+            if now - last_prune >= _PRUNE_INTERVAL:
+                self.prune(now)
+                last_prune = now
+
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
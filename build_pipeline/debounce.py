@@ -0,0 +1,113 @@
+"""
+Collapse bursts of deployments so that only the newest one gets provisioned
+"""
+import os
+import threading
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Number of seconds to collect the deployments to an environment before provisioning
+# the newest of them. With 0 every deployment is provisioned right away.
+DEPLOYMENT_DEBOUNCE_SECONDS = float(os.environ.get('DEPLOYMENT_DEBOUNCE_SECONDS', '0'))
+
+
+def _is_newer(deployment, other):
+    """ Whether a deployment was created after the other one. GitHub deployment ids only increase. """
+    try:
+        return int(deployment.get('id')) > int(other.get('id'))
+    except (TypeError, ValueError):
+        # Without ids to go by, the deployment that arrived last wins
+        return False
+
+
+def _describe(deployment):
+    """ Identify a deployment in the log. """
+    return 'deployment {} of {}'.format(deployment.get('id'), deployment.get('sha'))
+
+
+class DeploymentDebouncer(object):
+    """ Hold deployments back for a window of time per repo and environment,
+    then provision only the newest one that arrived in that window.
+
+    Args:
+        window (float): number of seconds that the first deployment to an environment is held back for
+    """
+    def __init__(self, window):
+        self.window = window
+        self.superseded = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """ Create a debouncer from the environment settings, None if deployments aren't debounced. """
+        if DEPLOYMENT_DEBOUNCE_SECONDS <= 0:
+            return None
+        return cls(DEPLOYMENT_DEBOUNCE_SECONDS)
+
+    def submit(self, key, deployment, provision, on_failure=None):
+        """ Hold back a deployment, superseding the one already waiting for the same environment.
+
+        Args:
+            key (tuple): the repo and environment of the deployment
+            deployment (dict): deployment object from the webhook payload
+            provision (callable): called without arguments to provision the deployment
+            on_failure (callable): called without arguments if provisioning the deployment raises
+        """
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                # The window starts with the first deployment, so a steady
+                # stream of deployments can't hold provisioning off forever.
+                timer = threading.Timer(self.window, self._fire, (key,))
+                timer.daemon = True
+                self._pending[key] = (deployment, provision, on_failure, timer)
+                timer.start()
+                return
+
+            waiting, _, _, timer = pending
+            self.superseded += 1
+            if _is_newer(waiting, deployment):
+                LOGGER.info(
+                    'Not provisioning %s to %s: it arrived after the newer %s.',
+                    _describe(deployment), key[1], _describe(waiting)
+                )
+                return
+
+            LOGGER.info(
+                'Not provisioning %s to %s: superseded by %s within %s seconds.',
+                _describe(waiting), key[1], _describe(deployment), self.window
+            )
+            self._pending[key] = (deployment, provision, on_failure, timer)
+
+    def flush(self):
+        """ Provision all of the deployments that are being held back right away. """
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+
+        for deployment, provision, on_failure, timer in pending:
+            timer.cancel()
+            self._provision(deployment, provision, on_failure)
+
+    def _fire(self, key):
+        """ Provision the deployment that is left when the window closes. """
+        with self._lock:
+            pending = self._pending.pop(key, None)
+
+        if pending is not None:
+            deployment, provision, on_failure, _ = pending
+            self._provision(deployment, provision, on_failure)
+
+    @staticmethod
+    def _provision(deployment, provision, on_failure):
+        """ Provision a deployment. The request that delivered it has been answered by
+        now, so any error is logged and handed to the failure callback.
+        """
+        try:
+            provision()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Could not provision %s', _describe(deployment))
+            if on_failure:
+                on_failure()
@@ -0,0 +1,169 @@
+"""
+Detection of webhook deliveries that GitHub has sent before
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Set to 'false' to turn off the detection of redeliveries
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').lower() == 'true'
+
+# Number of seconds that a delivery is remembered for
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', '86400'))
+
+# Maximum number of deliveries remembered in memory
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', '10000'))
+
+# Set to 'true' to recognize deliveries without an X-GitHub-Delivery header by a hash of their payload
+DEDUP_HASH_FALLBACK = os.environ.get('DEDUP_HASH_FALLBACK', 'false').lower() == 'true'
+
+# Redis URL of a cache shared by all of the dynos, for example the REDIS_URL of Heroku Redis.
+# Needs the redis package, which is not installed by default.
+DEDUP_REDIS_URL = os.environ.get('DEDUP_REDIS_URL')
+
+
+def delivery_key(delivery_id, contents=None, hash_fallback=False):
+    """ The key to remember a delivery by.
+
+    Args:
+        delivery_id (string): GUID of the delivery, from the X-GitHub-Delivery request header
+        contents (string): contents of the request
+        hash_fallback (bool): use a hash of the contents when there is no delivery id
+
+    Returns:
+        string: the key
+        None if the delivery can't be identified
+    """
+    if delivery_id:
+        return 'delivery:{}'.format(delivery_id)
+    if hash_fallback and contents is not None:
+        return 'sha1:{}'.format(hashlib.sha1(contents).hexdigest())
+    return None
+
+
+class RedisDeliveryBackend(object):
+    """ Deliveries remembered in Redis, so that every dyno sees the same ones.
+
+    Args:
+        url (string): Redis URL
+        ttl (int): number of seconds that a delivery is remembered for
+        client: Redis client to use instead of connecting to the url
+    """
+    prefix = 'build_pipeline:'
+
+    def __init__(self, url, ttl, client=None):
+        if client is None:
+            try:
+                import redis  # pylint: disable=import-error
+            except ImportError:
+                raise ImportError('The redis package must be installed to use DEDUP_REDIS_URL')
+            client = redis.StrictRedis.from_url(url, socket_timeout=1)
+        self.client = client
+        self.ttl = ttl
+
+    def add(self, key):
+        """ Remember a delivery.
+
+        Returns:
+            bool: False if the delivery was already known
+        """
+        # SET NX is atomic, so only one of the dynos gets to handle the delivery
+        return bool(self.client.set(self.prefix + key, '1', nx=True, ex=self.ttl))
+
+    def discard(self, key):
+        """ Forget a delivery. """
+        self.client.delete(self.prefix + key)
+
+
+class DeliveryCache(object):
+    """ Remember recent deliveries in a bounded LRU cache whose entries expire.
+
+    Args:
+        max_entries (int): maximum number of deliveries to remember
+        ttl (int): number of seconds that a delivery is remembered for
+        backend (RedisDeliveryBackend): optional cache shared with other processes
+        hash_fallback (bool): recognize deliveries without an id by a hash of their payload
+    """
+    def __init__(self, max_entries, ttl, backend=None, hash_fallback=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.hash_fallback = hash_fallback
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """ Create a cache from the environment settings, None if it is turned off. """
+        if not DEDUP_ENABLED:
+            return None
+        backend = RedisDeliveryBackend(DEDUP_REDIS_URL, DEDUP_TTL) if DEDUP_REDIS_URL else None
+        return cls(DEDUP_MAX_ENTRIES, DEDUP_TTL, backend, DEDUP_HASH_FALLBACK)
+
+    def key(self, delivery_id, contents=None):
+        """ The key to remember a delivery by, None if it can't be identified. """
+        return delivery_key(delivery_id, contents, self.hash_fallback)
+
+    def seen(self, key):
+        """ Check whether a delivery has been seen before, and remember it if not.
+
+        Args:
+            key (string): the key of the delivery
+
+        Returns:
+            bool: True if the delivery is a duplicate
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            expires = self._entries.pop(key, None)
+            duplicate = expires is not None and expires > now
+            if not duplicate:
+                expires = now + self.ttl
+            # Most recently used goes to the end
+            self._entries[key] = expires
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        if not duplicate and self.backend is not None:
+            try:
+                duplicate = not self.backend.add(key)
+            except Exception as err:  # pylint: disable=broad-except
+                # Rather handle a redelivery than lose a delivery when the shared cache is down
+                LOGGER.error('Could not check the shared delivery cache: %s', err)
+
+        with self._lock:
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return duplicate
+
+    def forget(self, key):
+        """ Forget a delivery, for example because handling it failed and a redelivery should be handled. """
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self.backend is not None:
+            try:
+                self.backend.discard(key)
+            except Exception as err:  # pylint: disable=broad-except
+                LOGGER.error('Could not update the shared delivery cache: %s', err)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        """ Drop the expired entries from the least recently used end of the cache. """
+        while self._entries:
+            key, expires = next(self._entries.iteritems())
+            if expires > now:
+                break
+            del self._entries[key]
@@ -0,0 +1,284 @@
+"""
+Index of the recent deployments and of the jobs that they have triggered
+
+Every deployment and deployment status event updates the entry of its
+deployment: the sha, environment, last state, when it was first and last
+seen, and the ids of the messages published for it. The index is used to
+skip triggering a job again for the same transition of a deployment, or
+for a deployment that a newer one to the same environment has superseded.
+It also keeps the newest deployment to each environment of each repo, which
+GET /deployments serves without going through the entries.
+"""
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+from .metrics import TRIGGERS_SUPPRESSED  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Maximum number of deployments in the index, beyond which the least recently
+# updated ones are evicted. With 0 there is no index and every event triggers its jobs.
+DEPLOYMENT_INDEX_SIZE = int(os.environ.get('DEPLOYMENT_INDEX_SIZE', '10000'))
+
+# Path of a JSON file to keep a snapshot of the index in, so that it survives
+# restarts. Note that the filesystem of a Heroku dyno is not kept when the dyno restarts.
+DEPLOYMENT_INDEX_SNAPSHOT_PATH = os.environ.get('DEPLOYMENT_INDEX_SNAPSHOT_PATH')
+
+# Seconds between the snapshots, which are only written when the index has changed
+DEPLOYMENT_INDEX_SNAPSHOT_INTERVAL = float(os.environ.get('DEPLOYMENT_INDEX_SNAPSHOT_INTERVAL', '30'))
+
+# The reasons for not triggering a job
+REPEATED = 'repeated'
+SUPERSEDED = 'superseded'
+
+# The transition of a deployment event. Deployment statuses go by their state.
+CREATED = 'created'
+
+
+def _deployment_id(deployment):
+    """ The id of a deployment as an int, None if it has none. GitHub deployment ids only increase. """
+    try:
+        return int(deployment.get('id'))
+    except (TypeError, ValueError):
+        return None
+
+
+class DeploymentIndex(object):
+    """ The most recently updated deployments, by deployment id.
+
+    Args:
+        max_entries (int): maximum number of deployments to keep
+        snapshot_path (string): JSON file to load the index from and save it to
+    """
+    def __init__(self, max_entries, snapshot_path=None):
+        self.max_entries = max_entries
+        self.snapshot_path = snapshot_path
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._latest = {}
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._saver = None
+
+    @classmethod
+    def from_env(cls, worker=None):
+        """ Create and start an index from the environment settings, None if DEPLOYMENT_INDEX_SIZE is 0.
+
+        Args:
+            worker (int): number of the pre-fork worker process that the index is for. Each
+                worker keeps its snapshot in a file of its own, named after its number.
+        """
+        if DEPLOYMENT_INDEX_SIZE <= 0:
+            return None
+        snapshot_path = DEPLOYMENT_INDEX_SNAPSHOT_PATH
+        if snapshot_path and worker is not None:
+            snapshot_path = '{}.{}'.format(snapshot_path, worker)
+        index = cls(DEPLOYMENT_INDEX_SIZE, snapshot_path)
+        index.start()
+        return index
+
+    def observe(self, repo, deployment, state, now=None):
+        """ Record the latest state of a deployment.
+
+        Args:
+            repo (string): full name of the repo
+            deployment (dict): deployment object from the webhook payload
+            state (string): CREATED for a deployment event, the state of a deployment status otherwise
+        """
+        deployment_id = _deployment_id(deployment)
+        if deployment_id is None:
+            return
+        now = now or time.time()
+        with self._lock:
+            entry = self._touch(deployment_id, repo, deployment, now)
+            # A late deployment event doesn't undo the statuses that came before it
+            if state != CREATED or entry['state'] is None:
+                entry['state'] = state
+            entry['updated_at'] = now
+            self._changes += 1
+
+    def claim(self, repo, deployment, transition, job):
+        """ Reserve the triggering of a job by a transition of a deployment.
+
+        A job is triggered once per transition of a deployment, and not at
+        all for a deployment status once a newer deployment to the same
+        environment has come in.
+
+        Args:
+            repo (string): full name of the repo
+            deployment (dict): deployment object from the webhook payload
+            transition (string): CREATED or the state of the deployment status
+            job (string): the job to trigger
+
+        Returns:
+            string: the reason not to trigger the job
+            None if the job is to be triggered, after which confirm or release is called
+        """
+        deployment_id = _deployment_id(deployment)
+        if deployment_id is None:
+            return None
+        with self._lock:
+            entry = self._touch(deployment_id, repo, deployment, time.time())
+            latest = self._latest.get((repo, entry['environment']))
+            if transition != CREATED and latest is not None and latest > deployment_id:
+                reason = SUPERSEDED
+            elif job in entry['triggered'].get(transition, {}):
+                reason = REPEATED
+            else:
+                entry['triggered'].setdefault(transition, {})[job] = None
+                self._changes += 1
+                return None
+        TRIGGERS_SUPPRESSED.inc(reason)
+        LOGGER.info(
+            'Not triggering %s for deployment %s of %s on %s: %s', job, deployment_id, repo, transition, reason
+        )
+        return reason
+
+    def confirm(self, deployment, transition, job, message_id):
+        """ Record the id of the message published for a claimed job. """
+        self._update_triggered(deployment, transition, job, message_id)
+
+    def release(self, deployment, transition, job):
+        """ Give up the claim of a job that could not be triggered, so that a redelivery tries again. """
+        self._update_triggered(deployment, transition, job, None, remove=True)
+
+    def get(self, repo, environment):
+        """ The newest deployment to an environment of a repo.
+
+        Returns:
+            dict: a copy of the entry of the deployment
+            None if no deployment to the environment is known
+        """
+        with self._lock:
+            deployment_id = self._latest.get((repo, environment))
+            if deployment_id is None:
+                return None
+            return json.loads(json.dumps(self._entries[deployment_id]))
+
+    def environments(self, repo=None):
+        """ The newest deployment to each environment, of one repo or of all of them.
+
+        Returns:
+            list: of the entries of the deployments, by repo and environment
+        """
+        with self._lock:
+            entries = [
+                self._entries[deployment_id] for (entry_repo, _), deployment_id in self._latest.items()
+                if repo is None or entry_repo == repo
+            ]
+            entries = json.loads(json.dumps(entries))
+        return sorted(entries, key=lambda entry: (entry['repo'], entry['environment']))
+
+    def start(self):
+        """ Load the snapshot, and start saving snapshots in the background. """
+        if not self.snapshot_path:
+            return
+        self.load(self.snapshot_path)
+        self._saver = threading.Thread(target=self._save_forever, name='deployment-index')
+        self._saver.daemon = True
+        self._saver.start()
+
+    def stop(self, timeout=None):
+        """ Stop the background saving, and save a last snapshot. """
+        self._stop.set()
+        if self._saver is not None:
+            self._saver.join(timeout)
+            self._saver = None
+        if self.snapshot_path:
+            self.save(self.snapshot_path)
+
+    def save(self, path):
+        """ Write the entries to a JSON file, replacing it in one go. """
+        with self._lock:
+            contents = json.dumps(list(self._entries.values()))
+            changes = self._changes
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'w') as snapshot:
+                snapshot.write(contents)
+            os.rename(temporary, path)
+        except (IOError, OSError) as err:
+            LOGGER.error('Could not save the deployment index to %s: %s', path, err)
+            return False
+        with self._lock:
+            self._changes -= changes
+        return True
+
+    def load(self, path):
+        """ Add the entries of a snapshot written by save. """
+        try:
+            with open(path) as snapshot:
+                entries = json.load(snapshot)
+        except IOError:
+            return 0
+        except ValueError as err:
+            LOGGER.error('Ignoring the deployment index in %s: %s', path, err)
+            return 0
+        with self._lock:
+            for entry in entries:
+                self._entries[entry['id']] = entry
+                self._update_latest(entry)
+                self._evict()
+        LOGGER.info('Loaded %s deployments from %s', len(entries), path)
+        return len(entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _touch(self, deployment_id, repo, deployment, now):
+        """ The entry of a deployment, made the most recently used. Called with the lock held. """
+        entry = self._entries.pop(deployment_id, None)
+        if entry is None:
+            entry = {
+                'id': deployment_id, 'repo': repo, 'environment': deployment.get('environment'),
+                'sha': deployment.get('sha'), 'task': deployment.get('task'), 'state': None,
+                'first_seen_at': now, 'updated_at': now, 'triggered': {},
+            }
+        self._entries[deployment_id] = entry
+        self._update_latest(entry)
+        self._evict()
+        return entry
+
+    def _update_latest(self, entry):
+        """ Make a deployment the newest of its environment, unless a newer one is known. Called with the lock held. """
+        key = (entry['repo'], entry['environment'])
+        latest = self._latest.get(key)
+        if latest is None or latest < entry['id']:
+            self._latest[key] = entry['id']
+
+    def _evict(self):
+        """ Drop the least recently used entries beyond the maximum. Called with the lock held. """
+        while len(self._entries) > self.max_entries:
+            deployment_id, entry = self._entries.popitem(last=False)
+            key = (entry['repo'], entry['environment'])
+            if self._latest.get(key) == deployment_id:
+                del self._latest[key]
+            self.evicted += 1
+
+    def _update_triggered(self, deployment, transition, job, message_id, remove=False):
+        """ Set or remove a job in the triggered jobs of a deployment. """
+        deployment_id = _deployment_id(deployment)
+        with self._lock:
+            entry = self._entries.get(deployment_id)
+            if entry is None:
+                return
+            jobs = entry['triggered'].get(transition, {})
+            if remove:
+                jobs.pop(job, None)
+                if not jobs:
+                    entry['triggered'].pop(transition, None)
+            else:
+                entry['triggered'].setdefault(transition, {})[job] = message_id
+            entry['updated_at'] = time.time()
+            self._changes += 1
+
+    def _save_forever(self):
+        """ Save a snapshot every DEPLOYMENT_INDEX_SNAPSHOT_INTERVAL while the index changes. """
+        while not self._stop.wait(DEPLOYMENT_INDEX_SNAPSHOT_INTERVAL):
+            if self._changes:
+                self.save(self.snapshot_path)
@@ -0,0 +1,166 @@
+"""
+Asynchronous dispatch of validated GitHub events to the downstream handlers
+"""
+import os
+import threading
+
+from .helpers import SnsError, is_handled_event, parse_webhook_payload  # pylint: disable=relative-import
+from .metrics import DISPATCHED, STAGE_SECONDS  # pylint: disable=relative-import
+from .outbox import SnsDeferredError  # pylint: disable=relative-import
+from .pool import WorkerPool, PoolFullError  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Number of background threads publishing the events. With 0 the events
+# are handled synchronously on the thread serving the request.
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '4'))
+
+# Number of events that can wait to be published
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', '256'))
+
+# What to do with an event when the queue is full:
+# * block: make the request wait until there is room in the queue
+# * drop_newest: discard the event that did not fit
+# * drop_oldest: discard the event that has been waiting the longest to make room
+DISPATCH_OVERFLOW = os.environ.get('DISPATCH_OVERFLOW', 'block')
+
+# Maximum number of seconds to spend publishing the queued events on shutdown
+DISPATCH_FLUSH_TIMEOUT = float(os.environ.get('DISPATCH_FLUSH_TIMEOUT', '20'))
+
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+# The outcomes of dispatching an event
+PUBLISHED = 'published'
+IGNORED = 'ignored'
+FAILED = 'failed'
+DEFERRED = 'deferred'
+DROPPED = 'dropped'
+
+
+def _event_label(event):
+    """ The GitHub event as a metric label, keeping the number of label values bounded. """
+    return event if is_handled_event(event) else 'other'
+
+
+class Dispatcher(object):
+    """ Queue up GitHub events and publish them from a set of background workers.
+
+    Args:
+        workers (int): number of publisher threads
+        queue_size (int): maximum number of events waiting to be published
+        overflow (string): one of OVERFLOW_POLICIES
+        on_outcome (callable): called with the event, outcome and detail (message id or error)
+            each time an event has been dealt with
+    """
+    def __init__(self, workers, queue_size, overflow='block', on_outcome=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                'Unknown overflow policy {}. Use one of: {}'.format(overflow, ', '.join(OVERFLOW_POLICIES))
+            )
+
+        self.overflow = overflow
+        self.on_outcome = on_outcome
+        self.outcomes = dict.fromkeys((PUBLISHED, IGNORED, FAILED, DEFERRED, DROPPED), 0)
+        self._lock = threading.Lock()
+        self._pool = WorkerPool(workers, queue_size, name='dispatch')
+
+    @classmethod
+    def from_env(cls):
+        """ Create a dispatcher from the environment settings, None if dispatching is synchronous. """
+        if DISPATCH_WORKERS < 1:
+            return None
+        return cls(DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE, DISPATCH_OVERFLOW)
+
+    def submit(self, event, data, on_failure=None):
+        """ Queue up an event to be published.
+
+        Args:
+            event (string): GitHub event
+            data (dict): payload from the webhook
+            on_failure (callable): called without arguments if the event gets dropped or fails to publish
+
+        Returns:
+            bool: False if the event was dropped because the queue was full
+        """
+        block = self.overflow == 'block'
+        try:
+            self._pool.submit(self._dispatch, (event, data, on_failure), block=block)
+            return True
+        except PoolFullError:
+            pass
+
+        if self.overflow == 'drop_newest':
+            self._record(event, DROPPED, 'dispatch queue is full', on_failure)
+            return False
+
+        # drop_oldest: keep evicting until the new event fits
+        while True:
+            evicted = self._pool.evict_oldest()
+            if evicted is not None:
+                _func, (old_event, _data, old_on_failure) = evicted
+                self._record(old_event, DROPPED, 'evicted from the full dispatch queue', old_on_failure)
+            try:
+                self._pool.submit(self._dispatch, (event, data, on_failure), block=False)
+                return True
+            except PoolFullError:
+                continue
+
+    def queue_depth(self):
+        """ The number of events waiting to be published. """
+        return self._pool.queue.qsize()
+
+    def shutdown(self, timeout=None):
+        """ Stop taking new events and publish the ones already queued.
+
+        Args:
+            timeout (float): maximum number of seconds to spend flushing the queue
+
+        Returns:
+            bool: True if all of the queued events were dealt with
+        """
+        flushed = self._pool.shutdown(wait=True, timeout=timeout)
+        if not flushed:
+            LOGGER.error('Gave up flushing the dispatch queue. %s events were left.', self._pool.queue.qsize())
+        LOGGER.info('Dispatch outcomes: %s', self.outcomes)
+        return flushed
+
+    def _dispatch(self, event, data, on_failure=None):
+        """ Run the event through the downstream handlers on a worker thread. """
+        try:
+            with STAGE_SECONDS.time('route', _event_label(event)):
+                msg_id = parse_webhook_payload(event, data, on_failure=on_failure)
+        except SnsDeferredError as err:
+            # The outbox will publish it later
+            self._record(event, DEFERRED, err)
+            return
+        except SnsError as err:
+            self._record(event, FAILED, err, on_failure)
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.exception('Unexpected error publishing the %s event', event)
+            self._record(event, FAILED, err, on_failure)
+            return
+
+        if msg_id:
+            self._record(event, PUBLISHED, msg_id)
+        else:
+            self._record(event, IGNORED, None)
+
+    def _record(self, event, outcome, detail, on_failure=None):
+        """ Count and report what happened to an event. """
+        with self._lock:
+            self.outcomes[outcome] += 1
+        DISPATCHED.inc(_event_label(event), outcome)
+
+        if outcome == DEFERRED:
+            LOGGER.warning('%s event %s: %s', event, outcome, detail)
+        elif outcome in (FAILED, DROPPED):
+            LOGGER.error('%s event %s: %s', event, outcome, detail)
+            if on_failure:
+                on_failure()
+        else:
+            LOGGER.debug('%s event %s: %s', event, outcome, detail)
+
+        if self.on_outcome:
+            self.on_outcome(event, outcome, detail)
@@ -0,0 +1,153 @@
+"""
+Concurrent publishing of the messages of one event to all of its targets
+"""
+from collections import namedtuple
+import os
+import threading
+import time
+
+from .pool import PoolFullError, WorkerPool  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Number of threads publishing the messages of an event to its targets concurrently.
+# With 0 the messages are published one after the other.
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', '8'))
+
+# Seconds that publishing the messages of an event may take in all. Targets
+# that haven't been published to by then are either cancelled, or reported
+# as still running.
+FANOUT_DEADLINE = float(os.environ.get('FANOUT_DEADLINE', '10'))
+
+# The outcome of one call: its key, the value it returned and the error it raised
+CallResult = namedtuple('CallResult', 'key value error')
+
+
+class DeadlineExceeded(Exception):
+    """ A call did not finish before the deadline of the fan-out. """
+    pass
+
+
+class StillRunning(DeadlineExceeded):
+    """ A call was running at the deadline of the fan-out, so it has not failed yet. """
+    pass
+
+
+def run_sequentially(calls, timeout=None):
+    """ Make the calls one after the other, skipping the ones left when the deadline passes.
+
+    Args:
+        calls (list): of (key, callable) pairs, the callables take no arguments
+        timeout (float): seconds that the calls may take in all, defaults to FANOUT_DEADLINE
+
+    Returns:
+        list: of CallResult, in the order of the calls
+    """
+    deadline = time.time() + (FANOUT_DEADLINE if timeout is None else timeout)
+    results = []
+    for key, func in calls:
+        if time.time() >= deadline:
+            results.append(CallResult(key, None, DeadlineExceeded('Not started before the deadline')))
+        else:
+            results.append(_call(key, func))
+    return results
+
+
+def _call(key, func):
+    """ Make a call, capturing what it returns or raises. """
+    try:
+        return CallResult(key, func(), None)
+    except Exception as err:  # pylint: disable=broad-except
+        return CallResult(key, None, err)
+
+
+class FanOut(object):
+    """ Make a number of calls concurrently on a bounded pool of threads.
+
+    The latency of a fan-out is that of its slowest call rather than the sum of
+    them all. When the pool is busy, calls are made on the calling thread instead.
+
+    Args:
+        workers (int): number of threads
+    """
+    def __init__(self, workers):
+        self.pool = WorkerPool(workers, queue_size=workers * 4, name='fanout')
+
+    @classmethod
+    def from_env(cls):
+        """ Create a fan-out from the environment settings, None if the calls are to be made one by one. """
+        if FANOUT_WORKERS < 1:
+            return None
+        return cls(FANOUT_WORKERS)
+
+    def run(self, calls, timeout=None, on_late=None):
+        """ Make the calls concurrently and wait for them, until the deadline.
+
+        Calls that haven't started by the deadline are cancelled, and reported with
+        a DeadlineExceeded error. Calls that are still running carry on in the
+        background, and are reported with a StillRunning error.
+
+        Args:
+            calls (list): of (key, callable) pairs, the callables take no arguments
+            timeout (float): seconds that the calls may take in all, defaults to FANOUT_DEADLINE
+            on_late (callable): called with the final results of the calls, once the ones
+                that were still running at the deadline have finished, if there were any
+
+        Returns:
+            list: of CallResult, in the order of the calls
+        """
+        if len(calls) < 2:
+            return run_sequentially(calls, timeout)
+
+        deadline = time.time() + (FANOUT_DEADLINE if timeout is None else timeout)
+        results = [None] * len(calls)
+        running = set()
+        late = set()
+        finished = threading.Condition()
+
+        def call(index, key, func):
+            """ Make one of the calls and record its result, unless it was cancelled. """
+            with finished:
+                if results[index] is not None:
+                    return
+                running.add(index)
+            result = _call(key, func)
+            with finished:
+                running.discard(index)
+                results[index] = result
+                finished.notify()
+                if index not in late:
+                    return
+                late.discard(index)
+                if late:
+                    return
+                final = list(results)
+            if on_late is not None:
+                on_late(final)
+
+        for index, (key, func) in enumerate(calls):
+            try:
+                self.pool.submit(call, (index, key, func), block=False)
+            except (PoolFullError, RuntimeError):
+                call(index, key, func)
+
+        with finished:
+            while None in results:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                finished.wait(remaining)
+            for index, (key, _) in enumerate(calls):
+                if results[index] is not None:
+                    continue
+                if index in running:
+                    late.add(index)
+                    results[index] = CallResult(key, None, StillRunning('Still running at the deadline'))
+                else:
+                    results[index] = CallResult(key, None, DeadlineExceeded('Cancelled at the deadline'))
+            return list(results)
+
+    def shutdown(self, timeout=None):
+        """ Let the calls that are running finish. """
+        return self.pool.shutdown(wait=True, timeout=timeout)
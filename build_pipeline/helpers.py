@@ -1,13 +1,22 @@
 """
 Helper methods for triggering the next step in the deployment pipeline
 """
+from collections import OrderedDict
+from functools import partial
 import hashlib
 import hmac
 import json
 import os
+import socket
+import threading
+import time
 
-from boto import connect_sns
-from boto.exception import BotoServerError
+from .deployments import CREATED  # pylint: disable=relative-import
+from .fanout import StillRunning, run_sequentially  # pylint: disable=relative-import
+from .logs import Truncated, log_payload  # pylint: disable=relative-import
+from .metrics import STAGE_SECONDS  # pylint: disable=relative-import
+from .routing import DEFAULT_PARAMETERS, DEFAULT_STATES, compile_routes  # pylint: disable=relative-import
+from .tracing import format_time, record_lead_times  # pylint: disable=relative-import
 
 import logging
 LOGGER = logging.getLogger(__name__)
@@ -16,6 +25,15 @@ PIPELINE_REPO_ORG = os.environ.get('PIPELINE_REPO_ORG', 'foo')
 PIPELINE_REPO_NAME = os.environ.get('PIPELINE_REPO_NAME', 'bar')
 HANDLED_REPO = '{org}/{name}'.format(org=PIPELINE_REPO_ORG, name=PIPELINE_REPO_NAME)
 
+# The GitHub events that can trigger downstream jobs. The payloads
+# of any other events don't need to be read, let alone decoded.
+HANDLED_EVENTS = ('deployment', 'deployment_status')
+
+# The fields of the deployment object that the handlers use, along with
+# the ones that the parameters of the routing targets are set from.
+# created_at is kept for the lead times of the traces (see tracing.py).
+DEPLOYMENT_FIELDS = ('id', 'sha', 'task', 'environment', 'created_at')
+
 # The unique ARNs (Amazon Resource Name) for the SNS topics
 PROVISIONING_TOPIC = os.environ.get('PROVISIONING_TOPIC', 'insert_sns_arn_here')
 SITESPEED_TOPIC = os.environ.get('SITESPEED_TOPIC', 'insert_sns_arn_here')
@@ -28,64 +46,374 @@ SITESPEED_JOB = os.environ.get('SITESPEED_JOB', 'sitespeed_job')
 # must be entered as the Secret in the GitHub repo webhook settings.
 WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN', 'insert_webhook_secret_here').encode('utf-8')
 
+# Comma separated list of additional secrets that are accepted while
+# rotating the secret of the webhooks from one value to another.
+WEBHOOK_SECRET_TOKENS = [
+    token.strip().encode('utf-8') for token in os.environ.get('WEBHOOK_SECRET_TOKENS', '').split(',') if token.strip()
+]
+
+# The largest webhook payload accepted, in bytes. GitHub caps payloads at 25 MB.
+MAX_PAYLOAD_SIZE = int(os.environ.get('MAX_PAYLOAD_SIZE', str(25 * 1024 * 1024)))
+
+# Payloads are read and signed in chunks of this many bytes
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+
+# Longest line accepted in the framing of a chunked payload
+_MAX_CHUNK_LINE = 1024
+
+# The hash algorithms that GitHub signs payloads with, by signature prefix
+SIGNATURE_DIGESTS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+
+# HMAC objects that have already been keyed with a secret, by secret and hash algorithm.
+# Copying one of them is cheaper than keying a new HMAC for every payload.
+_KEYED_HMACS = {}
+
+# The AWS region of the SNS topics. When not set the default region of boto is used.
+SNS_REGION = os.environ.get('SNS_REGION')
+
+# Seconds that connecting to SNS, and each read of its response, may take
+SNS_TIMEOUT = float(os.environ.get('SNS_TIMEOUT', '5'))
+
+# Number of times that boto retries a failed publish. The num_retries
+# of the Boto section of a boto config file takes precedence.
+SNS_MAX_RETRIES = int(os.environ.get('SNS_MAX_RETRIES', '1'))
+
+# Set at startup to a DeploymentDebouncer (see debounce.py) to
+# only provision the newest of a burst of deployments.
+DEPLOYMENT_DEBOUNCER = None
+
+# Set at startup to a DeploymentIndex (see deployments.py) to keep track of the
+# deployments, and not trigger a job twice for the same transition of one.
+DEPLOYMENT_INDEX = None
+
+# Set at startup to an Outbox (see outbox.py) to record the
+# messages durably before publishing them.
+OUTBOX = None
+
+# Set at startup to a transport (see transports.py) to publish the
+# messages some other way than to their SNS topics.
+TRANSPORT = None
+
+# Set at startup to a CircuitBreaker (see breaker.py) to stop
+# calling SNS for a while when most of the calls fail.
+SNS_BREAKER = None
+
+# Set at startup to a FanOut (see fanout.py) to publish the messages
+# of an event to all of its targets concurrently.
+FANOUT = None
+
+# Set at startup, and on SIGHUP, to the RoutingTable loaded from ROUTING_CONFIG
+# (see routing.py). Without one the events are routed by the settings above.
+ROUTING_TABLE = None
+
+# Number of deliveries for which the targets that were triggered are remembered, so that
+# the redelivery of a webhook that failed for some of its targets only triggers those.
+TRIGGERED_MAX_DELIVERIES = int(os.environ.get('TRIGGERED_MAX_DELIVERIES', '1024'))
+
+# The targets triggered for each of the latest deliveries, by delivery id
+_TRIGGERED = OrderedDict()
+_TRIGGERED_LOCK = threading.Lock()
+
+# The routing table made from the settings above, by the settings it was made from
+_DEFAULT_ROUTING_TABLES = {}
+
+# Open SNS connections, cached per thread because boto connections are not thread-safe.
+# Reusing a connection keeps its HTTPS connection alive between messages.
+_SNS_CONNECTIONS = threading.local()
+
+# Connections opened ahead of time by prewarm_sns_connections, with the key they were opened for
+_WARM_SNS_CONNECTIONS = []
+_WARM_SNS_CONNECTIONS_LOCK = threading.Lock()
+
 
 class SnsError(Exception):
     """ Error in the communication with SNS. """
     pass
 
 
-def parse_webhook_payload(event, data):
+class CircuitOpenError(SnsError):
+    """ Publishing was not attempted, because the SNS circuit breaker is open. """
+    pass
+
+
+class SnsDeferredError(SnsError):
+    """ Publishing a message failed, but it is in the outbox and will be retried.
+    Also raised while messages are still being published after the FANOUT_DEADLINE.
+    """
+    pass
+
+
+class PayloadTooLargeError(Exception):
+    """ The webhook payload is larger than MAX_PAYLOAD_SIZE. """
+    pass
+
+
+def parse_webhook_payload(event, data, on_failure=None):
     """Parse the WebHook payload and trigger downstream jobs.
 
     Args:
         event (string): GitHub event
-        data (dict): payload from the webhook
+        data (dict): payload from the webhook, along with the trace of the delivery (see tracing.py) if it has one
+        on_failure (callable): called without arguments if triggering the jobs fails after this has
+            returned: when a debounced deployment is provisioned, or a job that was still being
+            triggered at the FANOUT_DEADLINE finishes. Any other failure is raised.
 
     Returns:
         None if no downstream action is required
-        string: MessageId of the published SNS message if a followon action should be taken
+        string: MessageId of the first published SNS message if a followon action should be taken
     """
     try:
         repo = data.get('repository')
         repo_name = repo.get('full_name')
     except (AttributeError, KeyError) as _err:
-        LOGGER.error('Invalid webhook payload: {}'.format(data))
+        LOGGER.error('Invalid webhook payload: %s', Truncated(data))
         return None
 
-    if repo_name != HANDLED_REPO:
-        # We only want to take action on a specific repo, so
-        # even if another repo gets configured to send webhooks
-        # to this app send back a 200 to GitHub
-        LOGGER.debug('Unhandled repo: {}'.format(repo_name))
+    deployment = data.get('deployment') or {}
+    if DEPLOYMENT_INDEX is not None:
+        state = CREATED if event == 'deployment' else (data.get('deployment_status') or {}).get('state')
+        DEPLOYMENT_INDEX.observe(repo_name, deployment, state)
+
+    targets = get_routing_table().match(event, repo_name, data)
+    if not targets:
+        # Even if a repo without routes gets configured to send webhooks
+        # to this app, send back a 200 to GitHub
+        LOGGER.debug('No routes for %s events from %s', event, repo_name)
         return None
 
-    msg_id = None
+    repo_org, _, repo_short_name = repo_name.partition('/')
+    trace = data.get('trace')
 
     # Handle deployment events
     if event == 'deployment':
         LOGGER.debug('Deployment event passed to the handler.')
-        msg_id = handle_deployment_event(
-            PROVISIONING_TOPIC,
-            PIPELINE_REPO_ORG,
-            PIPELINE_REPO_NAME,
-            data.get('deployment')
+        provision = partial(
+            _trigger_targets, event, targets, on_failure, handle_deployment_event, repo_org, repo_short_name,
+            deployment, trace=trace
         )
+        if DEPLOYMENT_DEBOUNCER is not None:
+            # The provisioning jobs are triggered once no newer deployment has come in
+            DEPLOYMENT_DEBOUNCER.submit(
+                (repo_name, deployment.get('environment')), deployment, partial(_provision_debounced, provision),
+                on_failure=on_failure
+            )
+            return None
+        return provision()
+
+    # Handle deployment status events. The routes have already checked the state against their states.
+    LOGGER.debug('Deployment status event passed to the handler.')
+    deployment_status = data.get('deployment_status') or {}
+    return _trigger_targets(
+        event, targets, on_failure, handle_deployment_status_event, repo_org, repo_short_name, deployment,
+        deployment_status, trace=trace, states=(deployment_status.get('state'),)
+    )
+
+
+def _provision_debounced(provision):
+    """ Provision a deployment once its debounce window is over. The jobs that could not be
+    triggered will be retried from the outbox when SnsDeferredError is raised, so that is not a failure.
+    """
+    try:
+        return provision()
+    except SnsDeferredError as err:
+        LOGGER.warning('%s', err)
+        return None
 
-    # Handle deployment status events
-    elif event == 'deployment_status':
-        LOGGER.debug('Deployment status event passed to the handler.')
-        msg_id = handle_deployment_status_event(
-            SITESPEED_TOPIC,
-            PIPELINE_REPO_ORG,
-            PIPELINE_REPO_NAME,
-            data.get('deployment'),
-            data.get('deployment_status')
-        )
 
-    else:
-        LOGGER.debug('{} events do not need to be handled.'.format(event))
+def _trigger_targets(event, targets, on_failure, handler, *args, **kwargs):
+    """ Call the handler of an event for each of the targets it is routed to, concurrently with a FANOUT.
+
+    The handler is called with the arguments, the topic, job and parameters of the target, and the keyword arguments.
+    The handlers that are still running at the FANOUT_DEADLINE may yet trigger their jobs, so the outcome is left
+    to them: on_failure is called if any target has failed once they are done.
+
+    The targets that were triggered are remembered by the delivery id of the trace, so that the redelivery of
+    a webhook that failed only triggers the targets that failed. They are only remembered by this process,
+    for the latest TRIGGERED_MAX_DELIVERIES deliveries, so a redelivery beyond that triggers every target
+    again: each target is triggered at least once.
+
+    Returns:
+        string: the MessageId of the message published for the first target
+
+    Raises:
+        SnsDeferredError if publishing failed for some targets, but all of those will be retried from the outbox,
+            or the handlers of some targets were still running at the deadline
+        SnsError if publishing failed otherwise, with the results of all of the targets as its results attribute
+    """
+    delivery_id = (kwargs.get('trace') or {}).get('delivery_id')
+    triggered = _triggered_targets(delivery_id)
+    calls = [
+        (target, partial(handler, target.topic, *args, job=target.job, parameters=target.parameters, **kwargs))
+        for target in targets if target not in triggered
+    ]
+    if not calls:
+        LOGGER.info('Every job of the %s event of delivery %s has been triggered already', event, delivery_id)
+        return None
+    if len(calls) == 1:
+        # Nothing to gain from a thread, and errors keep their type
+        msg_id = calls[0][1]()
+        _record_triggered(delivery_id, [calls[0][0]])
+        return msg_id
+
+    with STAGE_SECONDS.time('fanout', event):
+        if FANOUT is not None:
+            results = FANOUT.run(calls, on_late=partial(_finished_late, event, on_failure, delivery_id))
+        else:
+            results = run_sequentially(calls)
+    _record_triggered(delivery_id, _succeeded(results))
+
+    failures = [result for result in results if result.error is not None]
+    if failures:
+        for result in failures:
+            if not isinstance(result.error, (SnsError, StillRunning)):
+                LOGGER.error('Could not trigger %s: %r', result.key.job, result.error)
+        deferred = all(isinstance(result.error, (SnsDeferredError, StillRunning)) for result in failures)
+        still_running = any(isinstance(result.error, StillRunning) for result in failures)
+        error_class = SnsDeferredError if deferred or still_running else SnsError
+        err = error_class('Triggered {} of {} jobs. {}'.format(
+            len(results) - len(failures), len(results), ' '.join(
+                '{} on {}: {}'.format(result.key.job, result.key.topic, result.error) for result in failures
+            )
+        ))
+        err.results = results
+        raise err
+
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('Triggered %s', ', '.join(
+            '{} ({})'.format(result.key.job, result.value) for result in results
+        ))
+    return results[0].value
+
+
+def _triggered_targets(delivery_id):
+    """ The targets that have been triggered for a delivery. """
+    if not delivery_id:
+        return frozenset()
+    with _TRIGGERED_LOCK:
+        return _TRIGGERED.get(delivery_id, frozenset())
+
+
+def _record_triggered(delivery_id, targets):
+    """ Remember the targets that were triggered for a delivery, so that a redelivery does not trigger them again. """
+    if not delivery_id or not targets:
+        return
+    with _TRIGGERED_LOCK:
+        _TRIGGERED[delivery_id] = _TRIGGERED.pop(delivery_id, frozenset()).union(targets)
+        while len(_TRIGGERED) > TRIGGERED_MAX_DELIVERIES:
+            _TRIGGERED.popitem(last=False)
+
+
+def _succeeded(results):
+    """ The targets of the results that triggered their jobs, or will from the outbox. """
+    return [
+        result.key for result in results if result.error is None or isinstance(result.error, SnsDeferredError)
+    ]
+
+
+def _finished_late(event, on_failure, delivery_id, results):
+    """ Report the outcome of the targets of an event once the handlers that were
+    still running at the FANOUT_DEADLINE have finished.
+    """
+    _record_triggered(delivery_id, _succeeded(results))
+    failures = [
+        result for result in results if result.error is not None and not isinstance(result.error, SnsDeferredError)
+    ]
+    if not failures:
+        LOGGER.info('Triggered the jobs of the %s event that were still running at the deadline', event)
+        return
+    LOGGER.error('Could not trigger %s for the %s event: %s', ', '.join(
+        result.key.job for result in failures
+    ), event, ' '.join(str(result.error) for result in failures))
+    if on_failure:
+        on_failure()
+
+
+def get_routing_table():
+    """ The routing table loaded from ROUTING_CONFIG, or else the one made from
+    the HANDLED_REPO, topic and job settings.
+
+    Returns:
+        RoutingTable
+    """
+    if ROUTING_TABLE is not None:
+        return ROUTING_TABLE
+
+    # The settings are looked up on every call, so that changes to them take effect
+    settings = (HANDLED_REPO, PROVISIONING_TOPIC, PROVISIONING_JOB, SITESPEED_TOPIC, SITESPEED_JOB)
+    table = _DEFAULT_ROUTING_TABLES.get(settings)
+    if table is None:
+        table = compile_routes([
+            {
+                'repos': [HANDLED_REPO], 'event': 'deployment',
+                'targets': [{'topic': PROVISIONING_TOPIC, 'job': PROVISIONING_JOB}]
+            },
+            {
+                'repos': [HANDLED_REPO], 'event': 'deployment_status', 'states': ['success'],
+                'targets': [{'topic': SITESPEED_TOPIC, 'job': SITESPEED_JOB}]
+            },
+        ])
+        _DEFAULT_ROUTING_TABLES.clear()
+        _DEFAULT_ROUTING_TABLES[settings] = table
+    return table
+
+
+def is_handled_event(event):
+    """ Whether the payload of a GitHub event could trigger a downstream job.
+
+    Args:
+        event (string): GitHub event, from the request header
+
+    Returns:
+        True if the payload needs to be parsed
+        False otherwise
+    """
+    return event in HANDLED_EVENTS
+
+
+def may_concern_handled_repo(contents):
+    """ Rule out payloads from other repos without decoding them.
+
+    Args:
+        contents (string): contents of the request
+
+    Returns:
+        False if the payload is certainly not from a repo with routes
+        True if it might be
+    """
+    return get_routing_table().may_concern(contents)
 
-    return msg_id
+
+def extract_webhook_fields(data):
+    """ Keep only the fields of a decoded payload that the handlers use.
+
+    The payloads of deployment events carry the full repository, sender and
+    deployment objects, which are kept out of the dispatch queue this way.
+
+    Args:
+        data (dict): payload from the webhook
+
+    Returns:
+        dict: with the repository full_name, the DEPLOYMENT_FIELDS of the
+            deployment and the state and created_at of the deployment status
+    """
+    repo = data.get('repository')
+    fields = {'repository': {'full_name': repo.get('full_name') if isinstance(repo, dict) else None}}
+
+    deployment = data.get('deployment')
+    if isinstance(deployment, dict):
+        keys = get_routing_table().deployment_fields.union(DEPLOYMENT_FIELDS)
+        fields['deployment'] = dict((key, deployment[key]) for key in keys if key in deployment)
+
+    deployment_status = data.get('deployment_status')
+    if isinstance(deployment_status, dict):
+        fields['deployment_status'] = {'state': deployment_status.get('state')}
+        if 'created_at' in deployment_status:
+            fields['deployment_status']['created_at'] = deployment_status['created_at']
+
+    return fields
 
 
 def is_valid_gh_event(signature, event, contents, data):
@@ -100,51 +428,217 @@ def is_valid_gh_event(signature, event, contents, data):
         True for valid GitHub events
         False otherwise
     """
-    secret = WEBHOOK_SECRET_TOKEN
+    verifier = new_signature_verifier(signature, event)
+    if not verifier or not is_valid_gh_payload(data):
+        return False
+
+    verifier.update(contents)
+    return verifier.verify()
+
+
+def new_signature_verifier(signature, event):
+    """ Check the GitHub headers of a webhook and prepare to verify the signature of its payload.
+
+    Args:
+        signature (string): GitHub signature, from the X-Hub-Signature-256 or X-Hub-Signature request header
+        event (string): GitHub event, from the request header
+
+    Returns:
+        SignatureVerifier: to feed the payload to
+        None if the headers are not those of a valid GitHub webhook
+    """
     if not signature:
         # This is not a valid webhook from GitHub because
         # those all send an X-Hub-Signature header.
         LOGGER.error('The X-Hub-Signature header was not received in the request.')
-        return False
+        return None
 
     if not event:
         # This is not a valid webhook from GitHub because
         # those all send an X-GitHub-Event header.
         LOGGER.error('The X-GitHub-Event header was not received in the request.')
-        return False
+        return None
 
-    repo = data.get('repository')
+    try:
+        return SignatureVerifier(signature)
+    except ValueError:
+        # A GitHub hash signature starts with sha1= or sha256=, using the key
+        # of your secret token and your payload body.
+        LOGGER.error('Invalid X-Hub-Signature header: %s', signature)
+        return None
+
+
+def is_valid_gh_payload(data):
+    """ Verify that the decoded payload of a webhook has the repository info that GitHub sends.
+
+    Args:
+        data (dict): payload from the webhook
+
+    Returns:
+        True for valid GitHub payloads
+        False otherwise
+    """
+    repo = data.get('repository') if isinstance(data, dict) else None
     if not repo:
         # This is not a valid webhook from GitHub because
         # those all return the repository info in the JSON payload
-        LOGGER.error('Invalid webhook payload: {}'.format(data))
+        LOGGER.error('Invalid webhook payload: %s', Truncated(data))
         return False
+    return True
 
-    sha_name, gh_hash = signature.split('=')
-    if sha_name != 'sha1':
-        # A GitHub hash signature starts with sha1=, using the key
-        # of your secret token and your payload body.
-        LOGGER.error('Invalid X-Hub-Signature header: {}'.format(signature))
-        return False
 
-    computed_hash = hmac.new(secret, msg=contents, digestmod=hashlib.sha1).hexdigest()
-    # Note that compare_digest was backported to Python 2 in 2.7.7,
-    # so that is the minimum version of Python required.
-    if not hmac.compare_digest(gh_hash, computed_hash):
-        msg = '{} {} {}'.format(
-            'The received WebHook payload was not signed with the WEBHOOK_SECRET_TOKEN.',
-            'Received hash: {}'.format(gh_hash),
-            'Computed hash: {}'.format(computed_hash)
+def _webhook_secrets():
+    """ The secrets that webhook payloads may be signed with. """
+    secrets = [WEBHOOK_SECRET_TOKEN]
+    secrets.extend(token for token in WEBHOOK_SECRET_TOKENS if token != WEBHOOK_SECRET_TOKEN)
+    return secrets
+
+
+def _keyed_hmac(secret, digest_name):
+    """ Get a fresh HMAC object keyed with the secret, copied from the cached one. """
+    key = (secret, digest_name)
+    keyed = _KEYED_HMACS.get(key)
+    if keyed is None:
+        keyed = _KEYED_HMACS[key] = hmac.new(secret, digestmod=SIGNATURE_DIGESTS[digest_name])
+    return keyed.copy()
+
+
+class SignatureVerifier(object):
+    """ Verify the signature of a webhook payload as it is read.
+
+    The payload is fed in chunks to an HMAC for each of the accepted secrets,
+    so it does not need to be decoded before it is known to come from GitHub.
+
+    Args:
+        signature (string): GitHub signature, such as sha256=<hex digest>
+
+    Raises:
+        ValueError if the signature is not in a supported format
+    """
+    def __init__(self, signature):
+        sha_name, _, gh_hash = signature.partition('=')
+        if sha_name not in SIGNATURE_DIGESTS or not gh_hash:
+            raise ValueError('Unsupported signature: {}'.format(signature))
+
+        self.gh_hash = gh_hash
+        self._hmacs = [_keyed_hmac(secret, sha_name) for secret in _webhook_secrets()]
+
+    def update(self, chunk):
+        """ Add the next chunk of the payload. """
+        for keyed in self._hmacs:
+            keyed.update(chunk)
+
+    def verify(self):
+        """ Check the signature against the payload read so far.
+
+        Returns:
+            True if the payload was signed with one of the accepted secrets
+            False otherwise
+        """
+        # Note that compare_digest was backported to Python 2 in 2.7.7,
+        # so that is the minimum version of Python required.
+        for keyed in self._hmacs:
+            if hmac.compare_digest(str(self.gh_hash), keyed.hexdigest()):
+                return True
+
+        LOGGER.error(
+            'The received WebHook payload was not signed with the WEBHOOK_SECRET_TOKEN. Received hash: %s',
+            self.gh_hash
         )
-        LOGGER.error(msg)
         return False
 
-    return True
+
+def read_payload(stream, length, verifier=None, max_size=None):
+    """ Read a webhook payload in chunks, feeding them to the signature verifier.
+
+    Args:
+        stream (file): the stream to read the payload from
+        length (int): the size of the payload from the Content-Length header
+        verifier (SignatureVerifier): optional verifier of the payload signature
+        max_size (int): the largest payload accepted, defaults to MAX_PAYLOAD_SIZE
+
+    Returns:
+        string: the payload
+
+    Raises:
+        PayloadTooLargeError before reading anything if the payload is larger than max_size
+        ValueError if the stream ends before the whole payload has been read
+    """
+    if max_size is None:
+        max_size = MAX_PAYLOAD_SIZE
+    if length > max_size:
+        raise PayloadTooLargeError('Payload of {} bytes exceeds the maximum of {} bytes'.format(length, max_size))
+
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        chunk = stream.read(min(remaining, PAYLOAD_CHUNK_SIZE))
+        if not chunk:
+            raise ValueError('The payload ended after {} of {} bytes'.format(length - remaining, length))
+        if verifier is not None:
+            verifier.update(chunk)
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def read_chunked_payload(stream, verifier=None, max_size=None):
+    """ Read a webhook payload sent with Transfer-Encoding: chunked, feeding it to the signature verifier.
+
+    Args:
+        stream (file): the stream to read the payload from
+        verifier (SignatureVerifier): optional verifier of the payload signature
+        max_size (int): the largest payload accepted, defaults to MAX_PAYLOAD_SIZE
+
+    Returns:
+        string: the payload
+
+    Raises:
+        PayloadTooLargeError as soon as the chunks add up to more than max_size
+        ValueError if the chunked encoding is malformed or the stream ends early
+    """
+    if max_size is None:
+        max_size = MAX_PAYLOAD_SIZE
+
+    chunks = []
+    total = 0
+    while True:
+        line = stream.readline(_MAX_CHUNK_LINE)
+        if not line.endswith('\n'):
+            raise ValueError('The payload ended in a chunk size line after {} bytes'.format(total))
+        try:
+            # Chunk extensions after a semicolon carry nothing we need
+            size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError('Invalid chunk size line {!r}'.format(line))
+        if size < 0:
+            raise ValueError('Invalid chunk size line {!r}'.format(line))
+        if size == 0:
+            break
+
+        total += size
+        if total > max_size:
+            raise PayloadTooLargeError('Chunked payload exceeds the maximum of {} bytes'.format(max_size))
+        chunks.append(read_payload(stream, size, verifier, max_size))
+        if stream.readline(_MAX_CHUNK_LINE).strip():
+            raise ValueError('A chunk of the payload is longer than its size of {} bytes'.format(size))
+
+    # Skip the trailer, which ends with an empty line
+    while True:
+        line = stream.readline(_MAX_CHUNK_LINE)
+        if not line.strip():
+            break
+
+    return b''.join(chunks)
 
 
 def publish_sns_messsage(topic_arn, message):
     """ Publish a message to SNS that will trigger jenkins jobs listening via SQS subscription.
 
+    When a TRANSPORT is set, the message is handed to it instead. While the
+    SNS_BREAKER is open, the message is not published at all.
+
     Args:
         topic_arn (string): The arn representing the topic
         message (string): The message to send
@@ -154,17 +648,44 @@ def publish_sns_messsage(topic_arn, message):
         string: The MessageId of the published message
 
     Raises:
+        CircuitOpenError when the circuit breaker is open
         SnsError when publishing was unsuccessful
     """
+    # Dump the json object into a string.
+    # This will handle the parameter strings correctly rather than submitting them with a u' prefix.
+    message = json.dumps(message)
+    LOGGER.debug('Publishing to %s. Message is %s', topic_arn, Truncated(message))
+
+    breaker = SNS_BREAKER
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpenError('The SNS circuit is open, not publishing to {}'.format(topic_arn))
+
+    published = False
     try:
-        # Dump the json object into a string.
-        # This will handle the parameter strings correctly rather than submitting them with a u' prefix.
-        message = json.dumps(message)
-        LOGGER.debug('Publishing to {}. Message is {}'.format(topic_arn, message))
-        conn = connect_sns()
+        if TRANSPORT is not None:
+            message_id = TRANSPORT.publish(topic_arn, message)
+        else:
+            message_id = _publish_to_sns(topic_arn, message)
+        published = True
+        return message_id
+    finally:
+        if breaker is not None:
+            breaker.record(published)
+
+
+def _publish_to_sns(topic_arn, message):
+    """ Publish a message string to an SNS topic.
+
+    Raises:
+        SnsError when publishing was unsuccessful
+    """
+    try:
+        conn = get_sns_connection()
         response = conn.publish(topic=topic_arn, message=message)
 
-    except BotoServerError as err:
+    except boto_errors() as err:
+        # Don't reuse a connection that may be in a bad state
+        evict_sns_connection()
         raise SnsError(err)
 
     # A successful response will be something like this:
@@ -183,10 +704,135 @@ def publish_sns_messsage(topic_arn, message):
     if not message_id:
         raise SnsError('Could not publish message. Response was: {}'.format(response))
 
-    LOGGER.debug('Successfully published MessageId {}'.format(message_id))
+    LOGGER.debug('Successfully published MessageId %s', message_id)
     return message_id
 
 
+def _publish(topic_arn, message):
+    """ Publish a message, through the outbox when there is one.
+
+    Raises:
+        SnsError when publishing was unsuccessful
+    """
+    if OUTBOX is not None:
+        return OUTBOX.publish(topic_arn, message)
+    return publish_sns_messsage(topic_arn=topic_arn, message=message)
+
+
+def _sns_connection_key():
+    """ The region and credentials that an SNS connection is opened with. """
+    secret = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+    return (
+        SNS_REGION,
+        os.environ.get('AWS_ACCESS_KEY_ID'),
+        hashlib.sha1(secret.encode('utf-8')).hexdigest()
+    )
+
+
+def get_sns_connection():
+    """ Get the SNS connection of the current thread, opening it if necessary.
+
+    Connections are cached by region and credentials, so changing either opens a new one.
+
+    Returns:
+        boto.sns.connection.SNSConnection: the connection to publish with
+
+    Raises:
+        SnsError if the configured SNS_REGION does not exist
+    """
+    connections = getattr(_SNS_CONNECTIONS, 'connections', None)
+    if connections is None:
+        connections = _SNS_CONNECTIONS.connections = {}
+
+    key = _sns_connection_key()
+    conn = connections.get(key)
+    if conn is None:
+        conn = _take_warm_sns_connection(key) or _open_sns_connection(key[0])
+        connections[key] = conn
+    return conn
+
+
+def boto_errors():
+    """ The errors of a call to AWS that are worth retrying, importing boto only when one is raised. """
+    from boto.exception import BotoServerError
+    return (BotoServerError, socket.error)
+
+
+def connect_sns():
+    """ Open an SNS connection in the default region. boto is slow to import, so it is imported when first needed. """
+    from boto import connect_sns as connect
+    return connect()
+
+
+def _open_sns_connection(region):
+    """ Open an SNS connection with the timeouts configured.
+
+    Raises:
+        SnsError if the region does not exist
+    """
+    if region:
+        import boto.sns
+        conn = boto.sns.connect_to_region(region)
+        if conn is None:
+            raise SnsError('Unknown SNS region: {}'.format(region))
+    else:
+        conn = connect_sns()
+    # Keep a slow SNS from holding up the publishing threads for long
+    conn.http_connection_kwargs['timeout'] = SNS_TIMEOUT
+    conn.num_retries = SNS_MAX_RETRIES
+    LOGGER.debug('Opened a new SNS connection to %s', conn.host)
+    return conn
+
+
+def _take_warm_sns_connection(key):
+    """ A connection opened by prewarm_sns_connections for the same region and credentials, if one is left. """
+    with _WARM_SNS_CONNECTIONS_LOCK:
+        for index, (warm_key, conn) in enumerate(_WARM_SNS_CONNECTIONS):
+            if warm_key == key:
+                del _WARM_SNS_CONNECTIONS[index]
+                return conn
+    return None
+
+
+def prewarm_sns_connections(count):
+    """ Open SNS connections ahead of the first publish, for the first threads that publish to take.
+
+    Besides importing boto, this looks up the credentials and does the DNS
+    lookup and the TCP and TLS handshakes, so that the first delivery doesn't
+    have to wait for them.
+
+    Args:
+        count (int): number of connections to open
+
+    Raises:
+        SnsError if the region does not exist
+        socket.error if SNS can't be reached
+    """
+    key = _sns_connection_key()
+    for _ in range(count):
+        conn = _open_sns_connection(key[0])
+        http_conn = conn.new_http_connection(conn.host, conn.port, conn.is_secure)
+        http_conn.connect()
+        conn.put_http_connection(conn.host, conn.port, conn.is_secure, http_conn)
+        with _WARM_SNS_CONNECTIONS_LOCK:
+            _WARM_SNS_CONNECTIONS.append((key, conn))
+
+
+def evict_sns_connection():
+    """ Close and forget the SNS connection of the current thread, the next publish opens a new one. """
+    connections = getattr(_SNS_CONNECTIONS, 'connections', {})
+    conn = connections.pop(_sns_connection_key(), None)
+    if conn is not None:
+        conn.close()
+
+
+def reset_sns_connections():
+    """ Forget all of the SNS connections of the current thread, and the ones opened ahead of time. """
+    _SNS_CONNECTIONS.connections = {}
+    with _WARM_SNS_CONNECTIONS_LOCK:
+        del _WARM_SNS_CONNECTIONS[:]
+
+
 def _compose_sns_message(repo_org, repo_name, custom_data=None):
     """ Compose the message to publish to the SNS topic.
 
@@ -214,26 +860,63 @@ def _compose_sns_message(repo_org, repo_name, custom_data=None):
     return custom_data
 
 
-def _compose_custom_data(deployment):
+def _compose_custom_data(deployment, parameters=DEFAULT_PARAMETERS, trace=None, published_at=None):
     """ Compose the metadata to pass to the CI system.
 
     Args:
         deployment (dict): deployment object from the webhook payload
+        parameters (tuple): pairs of the job parameter names and the deployment fields they are set from
+        trace (dict): trace of the delivery (see tracing.py), passed on as the trace_id and
+            received_at parameters along with the published_at time
+        published_at (float): time the message is published, defaults to now
 
     Returns:
         dict: data to include in the message to the CI system
     """
-    return {
+    custom_data = {
         'parameters': [
-            {'name': 'deployment_id', 'type': 'string', 'value': deployment.get('id', '')},
-            {'name': 'sha', 'type': 'string', 'value': deployment.get('sha', '')},
-            {'name': 'task', 'type': 'string', 'value': deployment.get('task', '')},
-            {'name': 'environment', 'type': 'string', 'value': deployment.get('environment', '')}
+            {'name': name, 'type': 'string', 'value': deployment.get(field, '')} for name, field in parameters
         ]
     }
+    if trace is not None:
+        custom_data['parameters'].extend([
+            {'name': 'trace_id', 'type': 'string', 'value': trace['trace_id']},
+            {'name': 'received_at', 'type': 'string', 'value': format_time(trace['received_at'])},
+            {'name': 'published_at', 'type': 'string', 'value': format_time(published_at or time.time())},
+        ])
+    return custom_data
+
 
+def trigger_job(topic, repo_org, repo_name, deployment, job, parameters=DEFAULT_PARAMETERS, event='deployment',
+                trace=None):
+    """ Publish the message that triggers a CI job for a deployment.
 
-def handle_deployment_event(topic, repo_org, repo_name, deployment):
+    Args:
+        topic (string): The arn of the SNS topic that the job listens to
+        repo_org (string): Org of the repo to use in the message
+        repo_name (string): Name of the repo to use in the message
+        deployment (dict): deployment object from the webhook payload
+        job (string): name of the job to trigger
+        parameters (tuple): pairs of the job parameter names and the deployment fields they are set from
+        event (string): GitHub event, for the metrics
+        trace (dict): trace of the delivery, to pass to the job and record the lead times of
+
+    Returns:
+        string: the message ID of the published message
+    """
+    with STAGE_SECONDS.time('compose', event):
+        custom_data = _compose_custom_data(deployment, parameters, trace)
+        custom_data['job'] = job
+        message = _compose_sns_message(repo_org, repo_name, custom_data)
+    with STAGE_SECONDS.time('publish', event):
+        msg_id = _publish(topic, message)
+    if trace is not None:
+        record_lead_times(trace, event, time.time())
+    return msg_id
+
+
+def handle_deployment_event(topic, repo_org, repo_name, deployment, job=None, parameters=DEFAULT_PARAMETERS,
+                            trace=None):
     """Handle the deployment event webhook.
 
     Technical implementation notes:
@@ -249,56 +932,89 @@ def handle_deployment_event(topic, repo_org, repo_name, deployment):
         repo_org (string): Org of the repo to use in the message
         repo_name (string): Name of the repo to use in the message
         deployment (dict): deployment object from the webhook payload
+        job (string): the job to trigger, defaults to the PROVISIONING_JOB
+        parameters (tuple): pairs of the job parameter names and the deployment fields they are set from
+        trace (dict): trace of the delivery (see tracing.py)
 
     Returns:
         string: the message ID of the published message
+        None if the deployment has triggered the job already
     """
     # Start up the pipeline by publishing an SNS message that will trigger the provisioning job.
-    # At the moment we don't need any conditional logic for this. That is, for any
-    # deployment event that is created, trigger the provisioning job.
+    # Which deployment events trigger it is up to the routing table.
     #
     # The provisioning job will need to post a deployment status event with 'state' equal to
     # 'success' in order to trigger the next job in the pipeline.
     LOGGER.info('Received deployment event')
-    LOGGER.debug(deployment)
-    custom_data = _compose_custom_data(deployment)
-    custom_data['job'] = PROVISIONING_JOB
-    message = _compose_sns_message(repo_org, repo_name, custom_data)
-    msg_id = publish_sns_messsage(topic_arn=topic, message=message)
-    return msg_id
+    log_payload(LOGGER, 'Deployment', deployment)
+    return _trigger_once(
+        CREATED, topic, repo_org, repo_name, deployment, job or PROVISIONING_JOB, parameters, 'deployment', trace
+    )
 
 
-def handle_deployment_status_event(topic, repo_org, repo_name, deployment, deployment_status):
+def handle_deployment_status_event(topic, repo_org, repo_name, deployment, deployment_status, job=None,
+                                   parameters=DEFAULT_PARAMETERS, trace=None, states=DEFAULT_STATES):
     """Handle the deployment status event.
 
     This webhook is triggered by jenkins creating a deployment status event
-    after a successful build provisioning the target sandbox.
+    after a successful build provisioning the target sandbox. Only the states
+    given trigger the next job, by default only 'success'.
 
     Args:
         repo_org (string): Org of the repo to use in the message
         repos_name (string): Name of the repo to use in the message
         deployment (dict): deployment object from the webhook payload
         deployment_status (dict): deployment status object from the webhook payload
+        job (string): the job to trigger, defaults to the SITESPEED_JOB
+        parameters (tuple): pairs of the job parameter names and the deployment fields they are set from
+        trace (dict): trace of the delivery (see tracing.py)
+        states (tuple): the states of the deployment status that trigger the job, defaults to DEFAULT_STATES
 
     Returns:
-        None if no action was required or
         string: the message ID of the published message
+        None if the state doesn't trigger the job, the state of the deployment has triggered
+            the job already, or a newer deployment has come in
     """
-    LOGGER.info('Received deployment status event:')
-    LOGGER.debug(deployment_status)
-    LOGGER.debug('For the deployment:')
-    LOGGER.debug(deployment)
+    LOGGER.info('Received deployment status event')
+    log_payload(LOGGER, 'Deployment status', deployment_status)
+    log_payload(LOGGER, 'For the deployment', deployment)
 
     state = deployment_status.get('state')
+    if state not in states:
+        LOGGER.debug('Not triggering %s for a deployment status of %s.', job or SITESPEED_JOB, state)
+        return None
 
-    if state == 'success':
-        custom_data = _compose_custom_data(deployment)
-        custom_data['job'] = SITESPEED_JOB
+    # Continue the next job in the pipeline by publishing an SNS message that will trigger
+    # the sitespeed job.
+    return _trigger_once(
+        deployment_status.get('state'), topic, repo_org, repo_name, deployment, job or SITESPEED_JOB, parameters,
+        'deployment_status', trace
+    )
 
-        # Continue the next job in the pipeline by publishing an SNS message that will trigger
-        # the sitespeed job.
-        message = _compose_sns_message(repo_org, repo_name, custom_data)
-        msg_id = publish_sns_messsage(topic_arn=topic, message=message)
-        return msg_id
 
-    return None
+def _trigger_once(transition, topic, repo_org, repo_name, deployment, job, parameters, event, trace):
+    """ Trigger a job with trigger_job, unless the DEPLOYMENT_INDEX says not to.
+
+    Args:
+        transition (string): 'created' for a deployment, the state of the deployment status otherwise
+
+    Returns:
+        string: the message ID of the published message
+        None if the job is not to be triggered for the transition of the deployment
+    """
+    if DEPLOYMENT_INDEX is None:
+        return trigger_job(topic, repo_org, repo_name, deployment, job, parameters, event, trace)
+
+    index = DEPLOYMENT_INDEX
+    if index.claim('{}/{}'.format(repo_org, repo_name), deployment, transition, job):
+        return None
+    try:
+        msg_id = trigger_job(topic, repo_org, repo_name, deployment, job, parameters, event, trace)
+    except SnsDeferredError:
+        # The outbox publishes the message later, so the job stays triggered
+        raise
+    except Exception:
+        index.release(deployment, transition, job)
+        raise
+    index.confirm(deployment, transition, job, msg_id)
+    return msg_id
@@ -0,0 +1,271 @@
+"""
+Logging setup: levels per module, and the log output written on a background thread
+
+Log calls should pass their arguments %-style, as in LOGGER.debug('Event %s', event),
+so that nothing gets formatted for messages below the level of the logger.
+Payloads are logged through log_payload, which truncates and samples them.
+"""
+import os
+from Queue import Empty, Full, Queue
+import random
+import re
+import sys
+import threading
+
+from .metrics import LOG_RECORDS_DROPPED  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Level of the log output, and the levels of particular loggers as comma separated
+# name=LEVEL pairs, for example build_pipeline.helpers=DEBUG,boto=INFO
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+
+# Set to 'false' to write the log output on the thread that logs, rather than on a background thread
+LOG_ASYNC = os.environ.get('LOG_ASYNC', 'true').lower() == 'true'
+
+# Number of log records waiting to be written, beyond which records are dropped
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# Longest payload logged, in characters
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', '1000'))
+
+# Fraction of the payloads that are logged at the DEBUG level
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '1'))
+
+LOG_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+# Levels of the loggers of the libraries, which are chatty at the DEBUG level. requests
+# logs through urllib3, under its own name when it doesn't bundle a copy of urllib3.
+LIBRARY_LEVELS = (
+    ('boto', logging.ERROR),
+    ('requests', logging.ERROR),
+    ('urllib3', logging.ERROR),
+)
+
+# Types of the log arguments that can't change once the call that logged returns
+_PLAIN_TYPES = (basestring, int, long, float, bool, type(None))
+
+# A conversion specifier of a %-style message, such as %s, %(name)r or %-10.3f
+_CONVERSION = re.compile(
+    r'%(?:\((?P<key>[^)]*)\))?[#0 +-]*(?P<width>\*|\d+)?(?:\.(?P<precision>\*|\d*))?[hlL]?(?P<type>.)'
+)
+
+
+class Truncated(object):
+    """ A value that is only turned into text when a log record is formatted, cut down to size. """
+
+    def __init__(self, value, max_chars=None):
+        self.value = value
+        self.max_chars = LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, basestring) else repr(self.value)
+        if len(text) <= self.max_chars:
+            return text
+        return '{}... ({} more characters)'.format(text[:self.max_chars], len(text) - self.max_chars)
+
+
+def log_payload(logger, message, payload, sample_rate=None):
+    """ Log a payload at the DEBUG level, truncated, and only for a sample of the calls.
+
+    Args:
+        logger (logging.Logger): the logger of the caller
+        message (string): describes the payload
+        payload: the payload
+        sample_rate (float): fraction of the calls that log, defaults to LOG_PAYLOAD_SAMPLE_RATE
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    rate = LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate < 1 and random.random() >= rate:
+        return
+    logger.debug('%s: %s', message, Truncated(payload))
+
+
+def parse_levels(levels):
+    """ Parse LOG_LEVELS into a list of (logger name, level) pairs.
+
+    Raises:
+        ValueError if a level is unknown
+    """
+    parsed = []
+    for item in levels.split(','):
+        name, _, level = item.strip().partition('=')
+        if not name:
+            continue
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError('Unknown log level for {}: {}'.format(name, level))
+        parsed.append((name.strip(), value))
+    return parsed
+
+
+class _Repr(object):
+    """ Stands in for a log argument formatted with %r, with its repr taken when the record was queued. """
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+
+def _frozen_arg(value, conversion):
+    """ A log argument that formats the same as the value does now, even once the value changes. """
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+    if conversion == 's':
+        return '%s' % (value,)
+    if conversion == 'r':
+        return _Repr(repr(value))
+    raise ValueError('Cannot format {} later'.format(conversion))
+
+
+def _frozen_args(msg, args):
+    """ The arguments of a log record, with the ones that may change replaced by their text.
+
+    Raises:
+        ValueError if the message can't be formatted with them on another thread
+    """
+    if not isinstance(msg, basestring):
+        raise ValueError('Not a format string')
+    if not args:
+        return args
+    conversions = [
+        match.groupdict() for match in _CONVERSION.finditer(msg) if match.group('type') != '%'
+    ]
+    if any(conversion['width'] == '*' or conversion['precision'] == '*' for conversion in conversions):
+        raise ValueError('Variable width')
+
+    if isinstance(args, dict):
+        frozen = dict(args)
+        for conversion in conversions:
+            if conversion['key'] not in args:
+                raise ValueError('Missing argument {}'.format(conversion['key']))
+            frozen[conversion['key']] = _frozen_arg(args[conversion['key']], conversion['type'])
+        return frozen
+
+    if len(conversions) != len(args) or any(conversion['key'] is not None for conversion in conversions):
+        raise ValueError('The arguments do not match the message')
+    return tuple(_frozen_arg(arg, conversion['type']) for arg, conversion in zip(args, conversions))
+
+
+class QueueHandler(logging.Handler):
+    """ Hands the log records to a queue, for a QueueListener to write them.
+
+    The message is formatted on the thread of the listener. The arguments that may
+    change once the call that logged returns are turned into text before the record
+    is queued, plain values such as strings and numbers are passed as they are.
+    When the queue is full the record is dropped rather than waited on, and counted.
+
+    Args:
+        queue (Queue.Queue): the queue
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Make a record safe to hand to another thread. """
+        try:
+            record.args = _frozen_args(record.msg, record.args)
+        except ValueError:
+            # Rather format it on this thread than guess how it would be formatted
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """ Writes the log records from a queue with the given handlers, on a background thread.
+
+    Args:
+        queue (Queue.Queue): the queue that a QueueHandler puts the records on
+        handlers (list): of logging.Handler
+    """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        """ Start writing the records. """
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Write the records that are queued up and stop. """
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def handle(self, record):
+        """ Pass a record to the handlers whose level it meets. """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        """ Write the records until the sentinel comes up. """
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            if record is self._sentinel:
+                return
+            self.handle(record)
+
+
+def configure_logging(stream=None, level=None, levels=None, asynchronous=None):
+    """ Set up the log output, by default to stdout so that it gets handled by the Heroku logging service.
+
+    Args:
+        stream (file): where the log output goes
+        level (string): level of the root logger, defaults to LOG_LEVEL
+        levels (string): levels of particular loggers, in the format of LOG_LEVELS
+        asynchronous (bool): write the output on a background thread, defaults to LOG_ASYNC
+
+    Returns:
+        QueueListener: the listener writing the output, to stop when shutting down
+        None if the output is written synchronously
+    """
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL if level is None else level.upper())
+    for name, library_level in LIBRARY_LEVELS:
+        logging.getLogger(name).setLevel(library_level)
+    for name, logger_level in parse_levels(LOG_LEVELS if levels is None else levels):
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = None
+    if LOG_ASYNC if asynchronous is None else asynchronous:
+        listener = QueueListener(Queue(maxsize=LOG_QUEUE_SIZE), output)
+        listener.start()
+
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(output if listener is None else QueueHandler(listener.queue))
+    return listener
@@ -0,0 +1,271 @@
+"""
+Counters and latency histograms, exposed in the Prometheus text format
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Buckets for the lead times of the pipeline, which include the jobs and GitHub taking their time
+LEAD_TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=()):
+    """ Render a label set such as {stage="read",event="deployment"}. """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ) + '}'
+
+
+def _format_value(value):
+    """ Render a sample value. """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ A count per label set that only goes up.
+
+    Args:
+        name (string): metric name
+        documentation (string): help text
+        labels (tuple): names of the labels
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, **kwargs):
+        """ Add to the count of a label set. Takes the label values in order and an optional amount. """
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """ The count of a label set. """
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """ Yield the lines of the metric in the text format. """
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield '{}{} {}'.format(self.name, _format_labels(self.labels, label_values), _format_value(value))
+
+
+class Gauge(object):
+    """ A value per label set that can go up and down.
+
+    Args:
+        name (string): metric name
+        documentation (string): help text
+        labels (tuple): names of the labels
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        """ Set the value of a label set. """
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, **kwargs):
+        """ Add to the value of a label set. Takes the label values in order and an optional amount. """
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, **kwargs):
+        """ Subtract from the value of a label set. Takes the label values in order and an optional amount. """
+        self.inc(*label_values, amount=-kwargs.get('amount', 1))
+
+    def value(self, *label_values):
+        """ The value of a label set. """
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """ Yield the lines of the metric in the text format. """
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield '{}{} {}'.format(self.name, _format_labels(self.labels, label_values), _format_value(value))
+
+
+class Histogram(object):
+    """ Distribution of observations per label set over fixed buckets.
+
+    Args:
+        name (string): metric name
+        documentation (string): help text
+        labels (tuple): names of the labels
+        buckets (tuple): upper bounds of the buckets in increasing order
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """ Record an observation for a label set. """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # Counts per bucket, then the sum and the count of the observations
+                state = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """ Observe how many seconds the body of the with statement takes. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *label_values)
+
+    def count(self, *label_values):
+        """ The number of observations of a label set. """
+        state = self._values.get(label_values)
+        return state[-1] if state else 0
+
+    def samples(self):
+        """ Yield the lines of the metric in the text format. """
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for label_values, state in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, state):
+                cumulative += bucket_count
+                yield '{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labels, label_values, [('le', _format_value(bound))]), cumulative
+                )
+            labels = _format_labels(self.labels, label_values)
+            yield '{}_sum{} {}'.format(self.name, labels, _format_value(state[-2]))
+            yield '{}_count{} {}'.format(self.name, labels, state[-1])
+
+
+class Registry(object):
+    """ A collection of metrics to expose together. """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ Add a metric to the registry and return it. """
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Render all of the metrics in the Prometheus text format. """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+WEBHOOKS = REGISTRY.register(Counter(
+    'build_pipeline_webhooks_total',
+    'Webhook deliveries received, by GitHub event and outcome.',
+    ('event', 'outcome')
+))
+
+DISPATCHED = REGISTRY.register(Counter(
+    'build_pipeline_dispatched_total',
+    'Events run through the downstream handlers, by GitHub event and outcome.',
+    ('event', 'outcome')
+))
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'build_pipeline_stage_seconds',
+    'Time spent in each stage of handling a webhook, by GitHub event.',
+    ('stage', 'event')
+))
+
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    'build_pipeline_circuit_state',
+    'State of each circuit breaker: 0 when closed, 1 when open and 2 when half open.',
+    ('circuit',)
+))
+
+CIRCUIT_TRIPS = REGISTRY.register(Counter(
+    'build_pipeline_circuit_trips_total',
+    'Times that each circuit breaker has opened.',
+    ('circuit',)
+))
+
+CIRCUIT_REJECTED = REGISTRY.register(Counter(
+    'build_pipeline_circuit_rejected_total',
+    'Calls that each circuit breaker failed fast without making them.',
+    ('circuit',)
+))
+
+BOOT_SECONDS = REGISTRY.register(Gauge(
+    'build_pipeline_boot_seconds',
+    'Seconds from the start of the import of the service to each step of starting it.',
+    ('step',)
+))
+
+TRIGGERS_SUPPRESSED = REGISTRY.register(Counter(
+    'build_pipeline_triggers_suppressed_total',
+    'Jobs not triggered because the deployment index had them triggered already, or superseded, by reason.',
+    ('reason',)
+))
+
+LEAD_TIME_SECONDS = REGISTRY.register(Histogram(
+    'build_pipeline_lead_time_seconds',
+    'Time between the hops of a pipeline run: GitHub creating the deployment or status, '
+    'the service receiving it and publishing the message, by hop and GitHub event.',
+    ('hop', 'event'),
+    LEAD_TIME_BUCKETS
+))
+
+SHED = REGISTRY.register(Counter(
+    'build_pipeline_shed_total',
+    'Webhook deliveries turned away by the admission control, by reason and GitHub event.',
+    ('reason', 'event')
+))
+
+OUTBOX_DEAD = REGISTRY.register(Counter(
+    'build_pipeline_outbox_dead_total',
+    'Outbox messages given up on after OUTBOX_MAX_ATTEMPTS attempts to publish them.'
+))
+
+LOG_RECORDS_DROPPED = REGISTRY.register(Counter(
+    'build_pipeline_log_records_dropped_total',
+    'Log records dropped because the queue of the log output was full.'
+))
@@ -0,0 +1,318 @@
+"""
+Durable outbox for the SNS messages, so that none are lost when publishing fails
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import helpers  # pylint: disable=relative-import
+from .helpers import SnsDeferredError, SnsError  # pylint: disable=relative-import
+from .metrics import OUTBOX_DEAD  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Path of the SQLite database that messages are written to before they are published.
+# When it is not set messages are published without an outbox. Note that the filesystem
+# of a Heroku dyno is not kept when the dyno restarts.
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH')
+
+# Seconds to wait before retrying a message for the first time. Each further
+# attempt waits twice as long, up to OUTBOX_RETRY_MAX seconds.
+OUTBOX_RETRY_BASE = float(os.environ.get('OUTBOX_RETRY_BASE', '1'))
+OUTBOX_RETRY_MAX = float(os.environ.get('OUTBOX_RETRY_MAX', '300'))
+
+# Seconds between the checks of the drainer for messages to retry
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '1'))
+
+# Number of attempts after which a message is given up on and marked dead. Dead messages
+# stay in the outbox for inspection, but are not retried. 0 retries messages forever.
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '30'))
+
+# Maximum number of messages that the drainer retries in one go
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+
+# Hours that published messages are kept in the outbox for reference
+OUTBOX_RETENTION_HOURS = float(os.environ.get('OUTBOX_RETENTION_HOURS', '24'))
+
+# Seconds that a message being published is reserved for. If the process dies
+# while publishing, the drainer picks the message up again after that.
+_LEASE_SECONDS = 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    outbox_id TEXT NOT NULL UNIQUE,
+    topic_arn TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    sns_message_id TEXT,
+    published_at REAL,
+    dead_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (published_at, next_attempt_at);
+'''
+
+
+def retry_delay(attempts, base=None, maximum=None):
+    """ Exponential backoff with full jitter.
+
+    Args:
+        attempts (int): number of attempts made so far
+        base (float): seconds before the first retry, defaults to OUTBOX_RETRY_BASE
+        maximum (float): longest delay, defaults to OUTBOX_RETRY_MAX
+
+    Returns:
+        float: seconds to wait before the next attempt
+    """
+    base = OUTBOX_RETRY_BASE if base is None else base
+    maximum = OUTBOX_RETRY_MAX if maximum is None else maximum
+    return random.uniform(0, min(maximum, base * 2 ** max(attempts - 1, 0)))
+
+
+class DeadMessageError(SnsError):
+    """ Publishing a message failed OUTBOX_MAX_ATTEMPTS times, so it is not retried anymore. """
+    pass
+
+
+class Outbox(object):
+    """ SQLite backed outbox of SNS messages.
+
+    Every message is written to the outbox before it is published and marked with its
+    SNS MessageId once it is, so that each message is published at least once.
+    A background drainer retries the messages that could not be published.
+
+    Args:
+        path (string): path of the SQLite database
+        publish (callable): called with the topic arn and message to publish a message,
+            defaults to helpers.publish_sns_messsage
+    """
+    def __init__(self, path, publish=None):
+        self.path = path
+        self._publish_func = publish
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._drainer = None
+
+        conn = self._connection()
+        # WAL lets the drainer read while the request threads write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(outbox)')]
+        if 'dead_at' not in columns:
+            # Outboxes created before messages could be given up on
+            conn.execute('ALTER TABLE outbox ADD COLUMN dead_at REAL')
+
+    @classmethod
+    def from_env(cls, drain=True):
+        """ Create and start an outbox from the environment settings, None if there is no OUTBOX_PATH.
+
+        Args:
+            drain (bool): whether to start the background drainer. The processes that
+                share the outbox leave the draining to one of them.
+        """
+        if not OUTBOX_PATH:
+            return None
+        outbox = cls(OUTBOX_PATH)
+        if drain:
+            outbox.start()
+        return outbox
+
+    def publish(self, topic_arn, message):
+        """ Record a message in the outbox, then try to publish it.
+
+        Args:
+            topic_arn (string): The arn representing the topic
+            message (dict): The message to send
+
+        Returns:
+            string: The MessageId of the published message
+
+        Raises:
+            SnsDeferredError when publishing failed and the message will be retried
+            DeadMessageError when publishing failed and the message will not be retried
+        """
+        now = time.time()
+        outbox_id = str(uuid.uuid4())
+        with self._connection() as conn:
+            row_id = conn.execute(
+                'INSERT INTO outbox (outbox_id, topic_arn, message, created_at, next_attempt_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (outbox_id, topic_arn, json.dumps(message), now, now + _LEASE_SECONDS)
+            ).lastrowid
+
+        try:
+            return self._attempt(row_id, topic_arn, message, 0)
+        except DeadMessageError:
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            raise SnsDeferredError('{} Message {} is in the outbox and will be retried.'.format(err, outbox_id))
+
+    def pending_count(self):
+        """ Number of messages that have not been published yet, and are still being retried. """
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM outbox WHERE published_at IS NULL AND dead_at IS NULL'
+        ).fetchone()[0]
+
+    def dead_count(self):
+        """ Number of messages that were given up on after OUTBOX_MAX_ATTEMPTS attempts. """
+        return self._connection().execute('SELECT COUNT(*) FROM outbox WHERE dead_at IS NOT NULL').fetchone()[0]
+
+    def drain_once(self, now=None):
+        """ Retry the messages that are due.
+
+        Each message is claimed before it is published, so that when several drainers
+        share the database only the one that claimed a message publishes it.
+
+        Args:
+            now (float): the current time
+
+        Returns:
+            int: number of messages published
+        """
+        now = time.time() if now is None else now
+        rows = self._connection().execute(
+            'SELECT id, topic_arn, message, attempts FROM outbox '
+            'WHERE published_at IS NULL AND dead_at IS NULL AND next_attempt_at <= ? ORDER BY id LIMIT ?',
+            (now, OUTBOX_BATCH_SIZE)
+        ).fetchall()
+
+        published = 0
+        for row_id, topic_arn, message, attempts in rows:
+            if not self._claim(row_id, now):
+                # Another drainer got to it first
+                continue
+            try:
+                self._attempt(row_id, topic_arn, json.loads(message), attempts)
+            except SnsError:
+                # SNS is still having trouble, leave the rest for later
+                break
+            except Exception:  # pylint: disable=broad-except
+                # Something is wrong with this message rather than with SNS
+                continue
+
+            if published == 0 and attempts > 0:
+                # A retry went through, so SNS has recovered. Don't make the
+                # messages that piled up during the outage wait out their backoff.
+                with self._connection() as conn:
+                    conn.execute(
+                        'UPDATE outbox SET next_attempt_at = ? '
+                        'WHERE published_at IS NULL AND dead_at IS NULL AND attempts > 0 AND id > ?',
+                        (now, row_id)
+                    )
+            published += 1
+
+        if published:
+            LOGGER.info('Published %s messages from the outbox, %s are left.', published, self.pending_count())
+        return published
+
+    def prune(self, now=None):
+        """ Remove the published messages that are older than the retention period. """
+        now = time.time() if now is None else now
+        with self._connection() as conn:
+            conn.execute(
+                'DELETE FROM outbox WHERE published_at IS NOT NULL AND published_at < ?',
+                (now - OUTBOX_RETENTION_HOURS * 3600,)
+            )
+
+    def start(self):
+        """ Start the background drainer. """
+        self._drainer = threading.Thread(target=self._drain_forever, name='outbox-drainer')
+        self._drainer.daemon = True
+        self._drainer.start()
+        pending = self.pending_count()
+        if pending:
+            LOGGER.info('The outbox has %s messages left to publish.', pending)
+
+    def stop(self, timeout=None):
+        """ Stop the background drainer. Messages left in the outbox are retried on the next start. """
+        self._stop.set()
+        if self._drainer is not None:
+            self._drainer.join(timeout)
+
+    def _drain_forever(self):
+        """ Retry messages until stopped. """
+        last_prune = 0
+        while not self._stop.wait(OUTBOX_POLL_INTERVAL):
+            try:
+                while self.drain_once() == OUTBOX_BATCH_SIZE and not self._stop.is_set():
+                    pass
+                if time.time() - last_prune > 3600:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Error draining the outbox')
+
+    def _claim(self, row_id, now):
+        """ Lease a due message for publishing, unless it has been leased or published since it was selected.
+
+        Returns:
+            bool: whether the message was claimed
+        """
+        with self._connection() as conn:
+            claimed = conn.execute(
+                'UPDATE outbox SET next_attempt_at = ? '
+                'WHERE id = ? AND next_attempt_at <= ? AND published_at IS NULL AND dead_at IS NULL',
+                (now + _LEASE_SECONDS, row_id, now)
+            ).rowcount
+        return claimed == 1
+
+    def _attempt(self, row_id, topic_arn, message, attempts):
+        """ Publish a message and record the outcome of the attempt.
+
+        Any error releases the lease of the message, so that it is retried after its backoff,
+        or marks the message dead once it has been attempted OUTBOX_MAX_ATTEMPTS times.
+
+        Raises:
+            DeadMessageError when the message was given up on, otherwise the error of the attempt
+        """
+        publish = self._publish_func or helpers.publish_sns_messsage
+        try:
+            msg_id = publish(topic_arn=topic_arn, message=message)
+        except Exception as err:
+            attempts += 1
+            if OUTBOX_MAX_ATTEMPTS and attempts >= OUTBOX_MAX_ATTEMPTS:
+                with self._connection() as conn:
+                    conn.execute(
+                        'UPDATE outbox SET attempts = ?, dead_at = ?, last_error = ? WHERE id = ?',
+                        (attempts, time.time(), str(err), row_id)
+                    )
+                OUTBOX_DEAD.inc()
+                LOGGER.error('Giving up on outbox message %s after %s attempts: %s', row_id, attempts, err)
+                raise DeadMessageError('Giving up on outbox message {} after {} attempts: {}'.format(
+                    row_id, attempts, err
+                ))
+
+            delay = retry_delay(attempts)
+            with self._connection() as conn:
+                conn.execute(
+                    'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                    (attempts, time.time() + delay, str(err), row_id)
+                )
+            LOGGER.warning(
+                'Attempt %s to publish outbox message %s failed, retrying in %.1fs: %s', attempts, row_id, delay, err
+            )
+            raise
+
+        with self._connection() as conn:
+            conn.execute(
+                'UPDATE outbox SET attempts = ?, sns_message_id = ?, published_at = ? WHERE id = ?',
+                (attempts + 1, msg_id, time.time(), row_id)
+            )
+        return msg_id
+
+    def _connection(self):
+        """ The SQLite connection of the current thread. """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+            # Durable against the process crashing, which is what the outbox is for
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
@@ -0,0 +1,133 @@
+"""
+A bounded pool of worker threads
+"""
+from Queue import Empty, Full, Queue
+import threading
+import time
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Placed on the work queue to tell a worker thread to exit
+_STOP = object()
+
+
+class PoolFullError(Exception):
+    """ The work queue of the pool is at capacity. """
+    pass
+
+
+class WorkerPool(object):
+    """ A fixed number of daemon threads draining a bounded work queue.
+
+    Args:
+        size (int): number of worker threads
+        queue_size (int): maximum number of queued work items, 0 for unbounded
+        name (string): prefix for the names of the worker threads
+    """
+    def __init__(self, size, queue_size=0, name='worker'):
+        if size < 1:
+            raise ValueError('A worker pool needs at least one thread')
+
+        self.size = size
+        self.queue = Queue(maxsize=queue_size)
+        self._closed = False
+        self._threads = []
+        for index in range(size):
+            thread = threading.Thread(target=self._work, name='{}-{}'.format(name, index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, args=(), block=True, timeout=None):
+        """ Queue up a call of func(*args) to be run by a worker thread.
+
+        Args:
+            func (callable): the work to do
+            args (tuple): positional arguments for func
+            block (bool): wait for room in the queue rather than failing
+            timeout (float): maximum number of seconds to wait when blocking
+
+        Raises:
+            PoolFullError if the queue has no room for the work item
+            RuntimeError if the pool has been shut down
+        """
+        if self._closed:
+            raise RuntimeError('Cannot submit work to a pool that has been shut down')
+
+        try:
+            self.queue.put((func, args), block, timeout)
+        except Full:
+            raise PoolFullError('The work queue is full ({} items)'.format(self.queue.maxsize))
+
+    def evict_oldest(self):
+        """ Take the oldest work item off the queue without running it.
+
+        The stop markers of a shutdown stay on the queue, so that the workers still exit.
+
+        Returns:
+            tuple: the func and args of the work item
+            None if no work is queued
+        """
+        stops = 0
+        evicted = None
+        while evicted is None:
+            try:
+                func, args = self.queue.get_nowait()
+            except Empty:
+                break
+            if func is _STOP:
+                stops += 1
+            else:
+                evicted = (func, args)
+        for _ in range(stops):
+            self.queue.put((_STOP, ()))
+        return evicted
+
+    def shutdown(self, wait=True, timeout=None):
+        """ Stop accepting work and let the workers finish what has been queued.
+
+        Args:
+            wait (bool): block until every queued work item has been run
+            timeout (float): maximum number of seconds to wait, None to wait for as long as it takes
+
+        Returns:
+            bool: False if the workers were still busy when the timeout ran out
+        """
+        if self._closed:
+            return True
+        self._closed = True
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        # The stop markers queue up behind the outstanding work, so
+        # the workers only exit once the queue has been drained.
+        for _ in self._threads:
+            try:
+                self.queue.put((_STOP, ()), True, _remaining(deadline))
+            except Full:
+                return False
+
+        if wait:
+            for thread in self._threads:
+                thread.join(_remaining(deadline))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def _work(self):
+        """ Run queued work items until told to stop. """
+        while True:
+            func, args = self.queue.get()
+            if func is _STOP:
+                return
+
+            try:
+                func(*args)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Unhandled error in a worker thread')
+
+
+def _remaining(deadline):
+    """ Seconds left until the deadline, or None if there is no deadline. """
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
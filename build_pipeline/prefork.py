@@ -0,0 +1,209 @@
+"""
+Pre-fork mode: worker processes sharing one listening socket, under a supervising parent
+
+HMAC verification and JSON decoding are CPU bound, and the GIL keeps the
+threads of one process to one core. In the pre-fork mode the parent opens
+the listening socket and forks the worker processes, which each run a
+server on the socket they inherit. The kernel hands every connection to
+one of them.
+
+The workers share no memory. The delivery cache is shared through its
+DEDUP_REDIS_URL, and the outbox database is drained by the parent alone.
+The debouncing of deployments, the deployment index and the metrics are
+kept by each worker for the deliveries that it handles.
+"""
+import errno
+import multiprocessing
+import os
+import signal
+import time
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Set to 'true' to serve from several worker processes
+SERVER_PREFORK = os.environ.get('SERVER_PREFORK', 'false').lower() == 'true'
+
+# Number of worker processes, defaults to the number of CPUs. Heroku sets
+# WEB_CONCURRENCY to a number suited to the size of the dyno.
+WEB_CONCURRENCY = os.environ.get('WEB_CONCURRENCY')
+
+# Seconds that the workers get to finish their work when stopping, before they are killed.
+# Heroku kills the processes of a dyno 30 seconds after sending them SIGTERM.
+PREFORK_STOP_TIMEOUT = float(os.environ.get('PREFORK_STOP_TIMEOUT', '25'))
+
+# Seconds to wait before restarting a worker that exited soon after it started,
+# so that a worker that can't start up doesn't get restarted in a tight loop
+PREFORK_RESTART_DELAY = float(os.environ.get('PREFORK_RESTART_DELAY', '1'))
+
+# Seconds that a worker has to run for to count as started up
+_MIN_UPTIME = 5
+
+
+def worker_count():
+    """ The number of worker processes: WEB_CONCURRENCY, or else the number of CPUs. """
+    if WEB_CONCURRENCY:
+        return max(int(WEB_CONCURRENCY), 1)
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class Supervisor(object):
+    """ Keeps a number of worker processes running.
+
+    Workers that exit are restarted, until the supervisor is stopped. Then the
+    workers are stopped one at a time, so that the others keep serving while
+    each one finishes the work it has taken on.
+
+    Args:
+        workers (int): number of worker processes
+        target (callable): called in each worker process with the number of the worker,
+            from 0 to workers - 1, and expected to serve until the worker receives SIGTERM.
+            A worker that is restarted keeps its number.
+        stop_timeout (float): seconds to wait for the workers to stop, defaults to PREFORK_STOP_TIMEOUT
+    """
+    def __init__(self, workers, target, stop_timeout=None):
+        self.workers = workers
+        self.target = target
+        self.stop_timeout = PREFORK_STOP_TIMEOUT if stop_timeout is None else stop_timeout
+        self.restarts = 0
+        # The worker number and start time of the worker processes by pid
+        self.children = {}
+        self._stopping = False
+
+    def run(self):  # pragma: no cover
+        """ Start the workers and supervise them until SIGTERM or SIGINT. """
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._forward)
+        signal.signal(signal.SIGUSR2, self._forward)
+
+        self.start()
+        LOGGER.info('Started %s worker processes', self.workers)
+        while not self._stopping:
+            self.reap()
+        self.stop()
+
+    def start(self):
+        """ Start the workers that aren't running. """
+        running = set(number for number, _ in self.children.values())
+        for number in range(self.workers):
+            if number not in running:
+                self._spawn(number)
+
+    def reap(self, block=True):
+        """ Wait for a worker to exit and restart it.
+
+        Args:
+            block (bool): wait until a worker exits, or a signal arrives
+
+        Returns:
+            int: the pid of the worker that exited, None if none did
+        """
+        try:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except OSError as err:
+            if err.errno in (errno.EINTR, errno.ECHILD):
+                return None
+            raise
+        child = self.children.pop(pid, None)
+        if child is None or self._stopping:
+            return pid or None
+
+        number, started = child
+        LOGGER.error('Worker process %s exited with status %s, restarting it', pid, _describe_status(status))
+        if time.time() - started < _MIN_UPTIME:
+            time.sleep(PREFORK_RESTART_DELAY)
+        if not self._stopping:
+            self.restarts += 1
+            self._spawn(number)
+        return pid
+
+    def stop(self):
+        """ Stop the workers one at a time, killing the ones left when the stop timeout runs out.
+
+        Returns:
+            bool: False if any worker had to be killed
+        """
+        self._stopping = True
+        deadline = time.time() + self.stop_timeout
+        for pid in list(self.children):
+            LOGGER.info('Stopping worker process %s', pid)
+            _signal(pid, signal.SIGTERM)
+            self._wait_for(pid, deadline)
+
+        graceful = not self.children
+        for pid in list(self.children):
+            LOGGER.error('Killing worker process %s, which did not stop in time', pid)
+            _signal(pid, signal.SIGKILL)
+            self._wait_for(pid, None)
+        return graceful
+
+    def _forward(self, signum, _frame):  # pragma: no cover
+        """ Signal handler: pass the signal on to the workers. """
+        for pid in self.children:
+            _signal(pid, signum)
+
+    def _request_stop(self, signum, _frame):  # pragma: no cover
+        """ Signal handler: leave the supervising loop to stop the workers. """
+        LOGGER.info('Received signal %s, stopping the worker processes', signum)
+        self._stopping = True
+
+    def _spawn(self, number):
+        """ Fork a worker process. """
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(number)
+        self.children[pid] = (number, time.time())
+
+    def _run_worker(self, number):  # pragma: no cover
+        """ Run the target in the forked worker process, which never returns to the caller. """
+        code = 0
+        try:
+            # Stopping is up to the supervisor, which also receives the SIGINT of a Ctrl-C
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Until the target sets up a handler, rather than be terminated by it
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            self.target(number)
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 0
+        except BaseException:  # pylint: disable=broad-except
+            LOGGER.exception('Worker process %s failed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)  # pylint: disable=protected-access
+
+    def _wait_for(self, pid, deadline):
+        """ Wait for a worker to exit, until the deadline if there is one. """
+        while pid in self.children:
+            try:
+                exited, _ = os.waitpid(pid, os.WNOHANG if deadline is not None else 0)
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                exited = pid
+            if exited:
+                del self.children[pid]
+            elif time.time() >= deadline:
+                return
+            else:
+                time.sleep(0.05)
+
+
+def _signal(pid, signum):
+    """ Send a signal to a process that may have exited already. """
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
+
+
+def _describe_status(status):
+    """ Describe how a process exited from its wait status. """
+    if os.WIFSIGNALED(status):
+        return 'signal {}'.format(os.WTERMSIG(status))
+    return os.WEXITSTATUS(status)
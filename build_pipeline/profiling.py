@@ -0,0 +1,223 @@
+"""
+Profiling of the webhook requests with cProfile, on demand
+
+Profiling is off unless PROFILE_DIR is set. Then one in PROFILE_SAMPLE_RATE
+requests is profiled, and the next requests can be profiled on demand: a
+POST to /profile?requests=K with PROFILE_TOKEN as the bearer token, or a
+SIGUSR2, profiles the next K requests, or PROFILE_SIGNAL_REQUESTS of them.
+
+The stats of every PROFILE_BATCH requests profiled are aggregated and
+written to PROFILE_DIR, as a .prof file that pstats and snakeviz read, and
+a .txt summary of the functions taking the most cumulative time, and of
+the validation, routing and publishing in particular. Only the newest
+PROFILE_MAX_FILES of them are kept. The profiles are written by a background
+thread, so a profiled request only pays for adding its stats to the batch.
+When no request is being profiled, checking whether to profile one is about
+all the overhead there is.
+"""
+import cProfile
+from datetime import datetime
+import os
+import pstats
+from Queue import Queue
+from StringIO import StringIO
+import threading
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Directory to write the profiles to. Nothing is profiled when it is not set.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# Profile one in this many requests, 0 to only profile on demand
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+
+# Number of profiled requests whose stats are aggregated into one profile
+PROFILE_BATCH = int(os.environ.get('PROFILE_BATCH', '10'))
+
+# Number of profiles kept, the oldest ones being deleted first
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '20'))
+
+# Bearer token for POST /profile. Profiling can't be requested over HTTP when it is not set.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+
+# Number of requests profiled after a SIGUSR2
+PROFILE_SIGNAL_REQUESTS = int(os.environ.get('PROFILE_SIGNAL_REQUESTS', '100'))
+
+# Number of functions listed in the summary of a profile
+PROFILE_TOP_FUNCTIONS = 30
+
+# The functions that the summaries single out
+FOCUS_FUNCTIONS = ('is_valid_gh_event', 'parse_webhook_payload', 'publish_sns_messsage')
+
+PROFILE_SUFFIX = '.prof'
+SUMMARY_SUFFIX = '.txt'
+
+
+class RequestProfiler(object):
+    """ Profiles a sample of the requests, and the requests asked for, aggregating their stats.
+
+    Args:
+        directory (string): directory to write the profiles to
+        sample_rate (int): profile one in this many requests, 0 for none
+        batch (int): number of profiled requests aggregated into one profile
+        max_files (int): number of profiles kept
+    """
+    def __init__(self, directory, sample_rate=0, batch=None, max_files=None):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.batch = PROFILE_BATCH if batch is None else batch
+        self.max_files = PROFILE_MAX_FILES if max_files is None else max_files
+        self.remaining = 0
+        self.written = 0
+        self._requests = 0
+        self._stats = None
+        self._profiled = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._batches = Queue()
+        self._writer = None
+
+    @classmethod
+    def from_env(cls):
+        """ Create a profiler from the environment settings, None if there is no PROFILE_DIR. """
+        if not PROFILE_DIR:
+            return None
+        return cls(PROFILE_DIR, PROFILE_SAMPLE_RATE)
+
+    def request(self, count):
+        """ Profile the next requests.
+
+        Args:
+            count (int): number of requests to profile
+        """
+        with self._lock:
+            self.remaining = max(self.remaining, count)
+        LOGGER.info('Profiling the next %s requests', count)
+
+    def sample(self):
+        """ Whether to profile the current request. """
+        if not (self.remaining or self.sample_rate):
+            return False
+        with self._lock:
+            if self.remaining:
+                self.remaining -= 1
+                return True
+            self._requests += 1
+            return self._requests % self.sample_rate == 0
+
+    def run(self, func, *args):
+        """ Call func(*args) with the profiler on, and add its stats to the aggregate. """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._add(profile)
+
+    def flush(self):
+        """ Write the stats aggregated so far, if there are any, after the full batches waiting to be written.
+
+        Returns:
+            string: the path of the profile written, None if there was nothing to write
+        """
+        self.wait()
+        return self._write(*self._take())
+
+    def wait(self):
+        """ Wait for the full batches handed to the background writer to be written. """
+        self._batches.join()
+
+    def _take(self):
+        """ Take the stats aggregated so far, the number of requests they cover and the sequence of their profile. """
+        with self._lock:
+            stats, self._stats = self._stats, None
+            profiled, self._profiled = self._profiled, 0
+            self._sequence += 1
+            return stats, profiled, self._sequence
+
+    def _write(self, stats, profiled, sequence):
+        """ Write a profile and its summary, and delete the oldest profiles beyond the maximum.
+
+        Returns:
+            string: the path of the profile written, None if there was nothing to write
+        """
+        if stats is None:
+            return None
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'profile-{}-{}-{:04d}'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid(), sequence
+        ))
+        try:
+            stats.dump_stats(path + PROFILE_SUFFIX)
+            with open(path + SUMMARY_SUFFIX, 'w') as summary_file:
+                summary_file.write(summarize(stats, profiled))
+        except (IOError, OSError) as err:
+            LOGGER.error('Could not write the profile %s: %s', path, err)
+            return None
+        self.written += 1
+        LOGGER.info('Wrote the profile of %s requests to %s', profiled, path + PROFILE_SUFFIX)
+        self.rotate()
+        return path + PROFILE_SUFFIX
+
+    def rotate(self):
+        """ Delete the oldest profiles beyond the maximum.
+
+        Returns:
+            int: number of profiles deleted
+        """
+        profiles = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(PROFILE_SUFFIX)
+        )
+        deleted = 0
+        for name in profiles[:max(0, len(profiles) - self.max_files)]:
+            base = os.path.join(self.directory, name[:-len(PROFILE_SUFFIX)])
+            for path in (base + PROFILE_SUFFIX, base + SUMMARY_SUFFIX):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Rotated by another worker process in the meantime
+                    pass
+            deleted += 1
+        return deleted
+
+    def _add(self, profile):
+        """ Add the stats of a profiled request to the aggregate, handing it to the writer once the batch is full. """
+        profile.create_stats()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._profiled += 1
+            full = self._profiled >= self.batch
+            if full and self._writer is None:
+                self._writer = threading.Thread(target=self._write_forever, name='profile-writer')
+                self._writer.daemon = True
+                self._writer.start()
+        if full:
+            self._batches.put(self._take())
+
+    def _write_forever(self):
+        """ Write the full batches as they are handed over. """
+        while True:
+            batch = self._batches.get()
+            try:
+                self._write(*batch)
+            finally:
+                self._batches.task_done()
+
+
+def summarize(stats, requests=None):
+    """ The functions of a profile that took the most cumulative time, and the FOCUS_FUNCTIONS among them. """
+    stream = StringIO()
+    stats.stream = stream
+    if requests is not None:
+        stream.write('Profile of {} requests\n\n'.format(requests))
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    for name in FOCUS_FUNCTIONS:
+        stream.write('\n{}\n'.format(name))
+        # The name is matched as a regular expression against the function descriptions
+        stats.print_stats(r'\({}\)$'.format(name))
+    return stream.getvalue()
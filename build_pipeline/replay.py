@@ -0,0 +1,311 @@
+""" Replay recorded webhook deliveries
+
+Reads archives of deliveries, one JSON object per line such as
+
+    {"headers": {"X-GitHub-Event": "deployment", "X-GitHub-Delivery": "...",
+                 "X-Hub-Signature-256": "sha256=..."},
+     "body": "<the raw request body>", "received_at": "2015-10-01T00:00:00Z"}
+
+and runs every delivery through the signature check and the downstream
+handlers, as if GitHub had redelivered it. Directories are read file by file,
+*.jsonl and *.jsonl.gz files as archives and *.json files as single
+deliveries, so the segments recorded by capture.py can be replayed as they
+are. Bodies that are not UTF-8 are given as body_base64. For example
+
+    python -m build_pipeline.replay --since 2015-10-01T12:00:00Z --events deployment archive.jsonl
+
+The archives are streamed, so their size doesn't matter. With --dry-run the
+jobs that would be triggered are counted, but nothing is published. With
+--delivery, only the given deliveries are looked up in the indexes of the
+recorded segments.
+"""
+import argparse
+import base64
+import calendar
+from datetime import datetime
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+
+from . import helpers  # pylint: disable=relative-import
+from .breaker import CircuitBreaker  # pylint: disable=relative-import
+from .capture import SEGMENT_SUFFIX, find_deliveries  # pylint: disable=relative-import
+from .fanout import FanOut  # pylint: disable=relative-import
+from .helpers import (  # pylint: disable=relative-import
+    SnsDeferredError, SnsError, extract_webhook_fields, get_routing_table, is_handled_event, is_valid_gh_event,
+    parse_webhook_payload
+)
+from .logs import configure_logging  # pylint: disable=relative-import
+from .outbox import Outbox  # pylint: disable=relative-import
+from .pool import WorkerPool  # pylint: disable=relative-import
+from .routing import RoutingTable  # pylint: disable=relative-import
+from .tracing import new_trace  # pylint: disable=relative-import
+from .transports import transport_from_env  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Outcomes of replaying a delivery
+TRIGGERED = 'triggered'
+WOULD_TRIGGER = 'would_trigger'
+IGNORED = 'ignored'
+FILTERED = 'filtered'
+INVALID = 'invalid'
+DEFERRED = 'deferred'
+FAILED = 'failed'
+UNREADABLE = 'unreadable'
+
+# Formats of the received_at times and of the --since and --until options, besides seconds since the epoch
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def parse_time(value):
+    """ Seconds since the epoch from a number, or a UTC time in ISO 8601.
+
+    Raises:
+        ValueError if the time can't be interpreted
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except (TypeError, ValueError):
+            continue
+        return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+    raise ValueError('Not a time: {}'.format(value))
+
+
+def archive_files(paths):
+    """ The files to read: the given ones, and the archives and deliveries in the given directories. """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.jsonl', SEGMENT_SUFFIX, '.json')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def _open_archive(path):
+    """ Open an archive for reading, - for stdin. """
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def read_deliveries(paths):
+    """ Stream the deliveries from archives.
+
+    Yields:
+        tuple: the location of the delivery, and the delivery as a dict or None if it can't be read
+    """
+    for path in archive_files(paths):
+        stream = _open_archive(path)
+        try:
+            if path.endswith('.json'):
+                try:
+                    yield path, json.load(stream)
+                except ValueError:
+                    yield path, None
+                continue
+
+            for number, line in _lines(stream, path):
+                if not line.strip():
+                    continue
+                try:
+                    delivery = json.loads(line)
+                except ValueError:
+                    delivery = None
+                yield '{}:{}'.format(path, number), delivery
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
+def _lines(stream, path):
+    """ Number the lines of an archive, up to where a segment that is still being written ends. """
+    number = 0
+    while True:
+        try:
+            line = stream.readline()
+        except (IOError, EOFError) as err:
+            LOGGER.warning('Stopped reading %s at line %s: %s', path, number, err)
+            return
+        if not line:
+            return
+        number += 1
+        yield number, line
+
+
+class Replayer(object):
+    """ Runs deliveries through the signature check and the downstream handlers, and counts the outcomes.
+
+    Args:
+        events (collection): GitHub events to replay, None for all
+        since (float): skip the deliveries received before this time
+        until (float): skip the deliveries received at or after this time
+        dry_run (bool): count the jobs that would be triggered instead of triggering them
+    """
+    def __init__(self, events=None, since=None, until=None, dry_run=False):
+        self.events = frozenset(events) if events else None
+        self.since = since
+        self.until = until
+        self.dry_run = dry_run
+        self.counts = {}
+        self.jobs = 0
+        self._lock = threading.Lock()
+
+    def run(self, deliveries, workers=0):
+        """ Replay deliveries, on a number of threads.
+
+        Args:
+            deliveries (iterable): of (location, delivery) pairs
+            workers (int): number of threads, 0 to replay on the calling thread
+
+        Returns:
+            dict: the number of deliveries by outcome
+        """
+        if workers < 1:
+            for location, delivery in deliveries:
+                self.replay(location, delivery)
+            return self.counts
+
+        # A bounded queue keeps the reading from running ahead of the workers
+        pool = WorkerPool(workers, queue_size=workers * 2, name='replay')
+        try:
+            for location, delivery in deliveries:
+                pool.submit(self.replay, (location, delivery))
+        finally:
+            pool.shutdown(wait=True)
+        return self.counts
+
+    def replay(self, location, delivery):
+        """ Replay one delivery and count its outcome. """
+        try:
+            outcome = self._replay(location, delivery)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Failed to replay the delivery at %s', location)
+            outcome = FAILED
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        return outcome
+
+    def _replay(self, location, delivery):
+        """ Replay one delivery.
+
+        Returns:
+            string: the outcome
+        """
+        if not isinstance(delivery, dict) or not isinstance(delivery.get('headers'), dict):
+            LOGGER.error('Could not read the delivery at %s', location)
+            return UNREADABLE
+
+        headers = dict((name.lower(), value) for name, value in delivery['headers'].items())
+        event = headers.get('x-github-event')
+        if self.events is not None and event not in self.events:
+            return FILTERED
+        if self.since is not None or self.until is not None:
+            try:
+                received_at = parse_time(delivery.get('received_at'))
+            except ValueError:
+                return FILTERED
+            if (self.since is not None and received_at < self.since) or \
+                    (self.until is not None and received_at >= self.until):
+                return FILTERED
+
+        if not is_handled_event(event):
+            return IGNORED
+
+        body = delivery.get('body')
+        contents = body.encode('utf-8') if isinstance(body, unicode) else body
+        try:
+            if 'body_base64' in delivery:
+                contents = base64.b64decode(delivery['body_base64'])
+            data = json.loads(contents)
+        except (TypeError, ValueError):
+            LOGGER.error('The delivery at %s has no valid JSON body', location)
+            return INVALID
+
+        signature = headers.get('x-hub-signature-256') or headers.get('x-hub-signature')
+        if not is_valid_gh_event(signature, event, contents, data):
+            LOGGER.error('The delivery at %s is not a valid GitHub event', location)
+            return INVALID
+        data = extract_webhook_fields(data)
+        # Traced from the replay, which is when the service receives the delivery this time
+        data['trace'] = new_trace(headers.get('x-github-delivery'), data, time.time())
+
+        if self.dry_run:
+            repo_name = (data.get('repository') or {}).get('full_name')
+            targets = get_routing_table().match(event, repo_name, data)
+            with self._lock:
+                self.jobs += len(targets)
+            return WOULD_TRIGGER if targets else IGNORED
+
+        try:
+            result = parse_webhook_payload(event, data)
+        except SnsDeferredError as err:
+            LOGGER.warning('The delivery at %s is in the outbox: %s', location, err)
+            return DEFERRED
+        except SnsError as err:
+            LOGGER.error('Failed to trigger the jobs of the delivery at %s: %s', location, err)
+            return FAILED
+        return TRIGGERED if result else IGNORED
+
+
+def main(argv=None):
+    """ Replay deliveries from the command line. """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='archives or directories of deliveries, - for stdin')
+    parser.add_argument('--workers', type=int, default=8, help='number of deliveries replayed concurrently')
+    parser.add_argument('--events', help='comma separated GitHub events to replay, all by default')
+    parser.add_argument('--since', type=parse_time, help='skip the deliveries received before this time')
+    parser.add_argument('--until', type=parse_time, help='skip the deliveries received at or after this time')
+    parser.add_argument('--dry-run', action='store_true', help='count the jobs that would be triggered')
+    parser.add_argument('--delivery', action='append', help='id of a recorded delivery to replay, may be repeated')
+    args = parser.parse_args(argv)
+
+    events = [event.strip() for event in args.events.split(',')] if args.events else None
+    replayer = Replayer(events, args.since, args.until, args.dry_run)
+
+    helpers.ROUTING_TABLE = RoutingTable.from_env()
+    if not args.dry_run:
+        helpers.TRANSPORT = transport_from_env()
+        helpers.SNS_BREAKER = CircuitBreaker.from_env('sns')
+        helpers.OUTBOX = Outbox.from_env()
+        helpers.FANOUT = FanOut.from_env()
+
+    start = time.time()
+    try:
+        if args.delivery:
+            deliveries = (
+                found for path in args.paths for found in find_deliveries(path, args.delivery)
+            )
+        else:
+            deliveries = read_deliveries(args.paths)
+        counts = replayer.run(deliveries, args.workers)
+    finally:
+        if helpers.FANOUT is not None:
+            helpers.FANOUT.shutdown()
+        if helpers.OUTBOX is not None:
+            helpers.OUTBOX.stop()
+
+    report = dict(counts, seconds=round(time.time() - start, 3))
+    if args.dry_run:
+        report['jobs'] = replayer.jobs
+    print json.dumps(report, indent=2, sort_keys=True)
+    return 1 if counts.get(FAILED) or counts.get(UNREADABLE) else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    configure_logging(sys.stderr, asynchronous=False)
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Routing of GitHub events to the CI jobs that they trigger
+
+Routes are declared in JSON, for example
+
+    {"routes": [
+        {"repos": ["edx/*"], "event": "deployment", "environments": ["sandbox"],
+         "targets": [{"topic": "arn:aws:sns:...:provision", "job": "prov_job"}]},
+        {"repos": ["edx/edx-platform"], "event": "deployment_status", "states": ["success"],
+         "targets": [{"topic": "arn:aws:sns:...:sitespeed", "job": "sitespeed_job",
+                      "parameters": {"deployment_id": "id", "sha": "sha"}}]}
+    ]}
+
+and compiled into a RoutingTable. Repos are matched by name or glob. The
+environments filter applies to the environment of the deployment and the
+states filter to the state of a deployment status. A deployment_status route
+without states is only for successful deployments, as DEFAULT_STATES says.
+The parameters of a target map the names of the job parameters to the
+deployment fields they are set from.
+"""
+from collections import namedtuple
+from fnmatch import fnmatchcase
+import json
+import os
+import re
+import threading
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Path of the JSON routing config, or the JSON itself. Without it the
+# routes are made from the HANDLED_REPO, topic and job settings of helpers.py.
+ROUTING_CONFIG = os.environ.get('ROUTING_CONFIG')
+
+# The events that routes can be declared for
+ROUTED_EVENTS = ('deployment', 'deployment_status')
+
+# The deployment status states that a deployment_status route matches when it doesn't declare its own
+DEFAULT_STATES = ('success',)
+
+# The job parameters that are set when a target doesn't declare its own, and the deployment fields they come from
+DEFAULT_PARAMETERS = (('deployment_id', 'id'), ('sha', 'sha'), ('task', 'task'), ('environment', 'environment'))
+
+# Number of (event, repo) lookups remembered by a routing table
+_MATCH_CACHE_SIZE = 10000
+
+_GLOB_CHARS = '*?['
+
+# The full names in a payload, as JSON strings. The repository of a webhook is one of them.
+_FULL_NAME = re.compile(r'"full_name"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+Target = namedtuple('Target', 'topic job parameters')
+
+
+class RoutingConfigError(ValueError):
+    """ The routing config is not valid. """
+    pass
+
+
+class Route(object):
+    """ A compiled route: the filters of a rule and the targets it triggers.
+
+    Args:
+        index (int): position of the route in the config, matches are returned in this order
+        event (string): GitHub event
+        repos (tuple): names or globs of the repos
+        environments (frozenset): deployment environments to match, None for all
+        states (frozenset): deployment status states to match, None for all
+        targets (tuple): of Target
+    """
+    def __init__(self, index, event, repos, environments, states, targets):
+        self.index = index
+        self.event = event
+        self.repos = repos
+        self.environments = environments
+        self.states = states
+        self.targets = targets
+
+    def accepts(self, data):
+        """ Whether the environment and state of a payload pass the filters of the route. """
+        if self.environments is not None:
+            deployment = data.get('deployment') or {}
+            if deployment.get('environment') not in self.environments:
+                return False
+        if self.states is not None:
+            deployment_status = data.get('deployment_status') or {}
+            if deployment_status.get('state') not in self.states:
+                return False
+        return True
+
+
+class RoutingTable(object):
+    """ Routes indexed for lookup by event and repo.
+
+    Repo names are looked up in a dict, and globs such as org/* under the org
+    they are restricted to, so the cost of a lookup doesn't grow with the
+    number of repos. The routes that apply to an (event, repo) pair are cached.
+
+    Args:
+        routes (list): of Route
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self._exact = {}
+        self._by_org = {}
+        self._globs = {}
+        # The same, regardless of the event, for ruling out payloads
+        self._names = set()
+        self._org_patterns = {}
+        self._patterns = set()
+        fields = set()
+
+        for route in routes:
+            for pattern in route.repos:
+                literal = _literal_prefix(pattern)
+                if literal == pattern:
+                    self._exact.setdefault((route.event, pattern), []).append(route)
+                    self._names.add(pattern)
+                elif '/' in literal:
+                    org = literal.split('/', 1)[0]
+                    self._by_org.setdefault((route.event, org), []).append((pattern, route))
+                    self._org_patterns.setdefault(org, set()).add(pattern)
+                else:
+                    self._globs.setdefault(route.event, []).append((pattern, route))
+                    self._patterns.add(pattern)
+            for target in route.targets:
+                fields.update(field for _, field in target.parameters)
+
+        self.deployment_fields = frozenset(fields)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """ Load the routing table from ROUTING_CONFIG, None if it is not set. """
+        if not ROUTING_CONFIG:
+            return None
+        return load_routing_config(ROUTING_CONFIG)
+
+    def match(self, event, repo_name, data):
+        """ The targets that a webhook triggers.
+
+        Args:
+            event (string): GitHub event
+            repo_name (string): full name of the repo
+            data (dict): payload from the webhook
+
+        Returns:
+            list: of Target, in the order of the config
+        """
+        targets = []
+        for route in self._routes_for(event, repo_name):
+            if route.accepts(data):
+                targets.extend(route.targets)
+        return targets
+
+    def may_concern(self, contents):
+        """ Rule out payloads from repos that no route is for, without decoding them.
+
+        The full names in the payload are picked out with one scan, and each is
+        looked up by name, then by org, and only then matched against the globs
+        that aren't restricted to an org. So the cost is that of the scan, however
+        many repos are routed.
+
+        Args:
+            contents (string): contents of the request
+
+        Returns:
+            False if the payload is certainly not from a routed repo
+            True if it might be
+        """
+        for match in _FULL_NAME.finditer(contents):
+            name = match.group(1)
+            if '\\' in name:
+                # Repo names don't need escaping, but the payload may escape them all the same
+                try:
+                    name = json.loads(name)
+                except ValueError:
+                    continue
+            else:
+                name = name[1:-1]
+            if self._may_route(name):
+                return True
+        return False
+
+    def _may_route(self, repo_name):
+        """ Whether any route is for a repo, whatever the event. """
+        if repo_name in self._names:
+            return True
+        org = repo_name.split('/', 1)[0]
+        patterns = self._org_patterns.get(org, ())
+        return any(fnmatchcase(repo_name, pattern) for pattern in patterns) or any(
+            fnmatchcase(repo_name, pattern) for pattern in self._patterns
+        )
+
+    def _routes_for(self, event, repo_name):
+        """ The routes for an event from a repo, before the environment and state filters. """
+        key = (event, repo_name)
+        routes = self._cache.get(key)
+        if routes is not None:
+            return routes
+
+        # By index, so that a route with several patterns matching the repo is only taken once
+        found = dict((route.index, route) for route in self._exact.get(key, []))
+        org = repo_name.split('/', 1)[0] if repo_name else None
+        for pattern, route in self._by_org.get((event, org), []) + self._globs.get(event, []):
+            if fnmatchcase(repo_name or '', pattern):
+                found[route.index] = route
+        routes = [found[index] for index in sorted(found)]
+
+        with self._cache_lock:
+            if len(self._cache) >= _MATCH_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = routes
+        return routes
+
+
+def _literal_prefix(pattern):
+    """ The part of a repo pattern before its first glob character. """
+    for index, char in enumerate(pattern):
+        if char in _GLOB_CHARS:
+            return pattern[:index]
+    return pattern
+
+
+def _string_list(rule, key, index):
+    """ A list of strings from a rule, None if the rule doesn't have the key. """
+    values = rule.get(key)
+    if values is None:
+        return None
+    if isinstance(values, basestring):
+        values = [values]
+    if not isinstance(values, list) or not all(isinstance(value, basestring) for value in values):
+        raise RoutingConfigError('Route {}: {} must be a list of strings'.format(index, key))
+    return values
+
+
+def _compile_target(target, index):
+    """ Compile the target of a rule. """
+    if not isinstance(target, dict) or not target.get('topic') or not target.get('job'):
+        raise RoutingConfigError('Route {}: every target needs a topic and a job'.format(index))
+
+    parameters = target.get('parameters')
+    if parameters is None:
+        parameters = DEFAULT_PARAMETERS
+    elif isinstance(parameters, dict):
+        parameters = tuple(sorted(parameters.items()))
+    else:
+        raise RoutingConfigError('Route {}: parameters must map parameter names to deployment fields'.format(index))
+    return Target(target['topic'], target['job'], parameters)
+
+
+def compile_routes(rules):
+    """ Compile routing rules into a routing table.
+
+    Args:
+        rules (list): of dicts with the repos, event, targets and the optional
+            environments and states of each route. The states of a
+            deployment_status route default to DEFAULT_STATES.
+
+    Returns:
+        RoutingTable
+
+    Raises:
+        RoutingConfigError if a rule is not valid
+    """
+    if not isinstance(rules, list):
+        raise RoutingConfigError('The routes must be a list')
+
+    routes = []
+    for index, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise RoutingConfigError('Route {} is not an object'.format(index))
+        event = rule.get('event')
+        if event not in ROUTED_EVENTS:
+            raise RoutingConfigError('Route {}: the event must be one of {}'.format(index, ', '.join(ROUTED_EVENTS)))
+        repos = _string_list(rule, 'repos', index)
+        if not repos:
+            raise RoutingConfigError('Route {} has no repos'.format(index))
+        targets = rule.get('targets')
+        if not isinstance(targets, list) or not targets:
+            raise RoutingConfigError('Route {} has no targets'.format(index))
+
+        environments = _string_list(rule, 'environments', index)
+        states = _string_list(rule, 'states', index)
+        if states is None and event == 'deployment_status':
+            states = list(DEFAULT_STATES)
+        routes.append(Route(
+            index, event, tuple(repos),
+            None if environments is None else frozenset(environments),
+            None if states is None else frozenset(states),
+            tuple(_compile_target(target, index) for target in targets)
+        ))
+    return RoutingTable(routes)
+
+
+def load_routing_config(config):
+    """ Load and compile a routing config.
+
+    Args:
+        config (string): path of the JSON config, or the JSON itself
+
+    Returns:
+        RoutingTable
+
+    Raises:
+        RoutingConfigError if the config is not valid
+        IOError if the file can't be read
+    """
+    if config.lstrip()[:1] in ('{', '['):
+        text = config
+    else:
+        with open(config) as config_file:
+            text = config_file.read()
+
+    try:
+        parsed = json.loads(text)
+    except ValueError as err:
+        raise RoutingConfigError('The routing config is not valid JSON: {}'.format(err))
+
+    table = compile_routes(parsed.get('routes') if isinstance(parsed, dict) else parsed)
+    LOGGER.info('Loaded %s routes', len(table.routes))
+    return table
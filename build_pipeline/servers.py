@@ -0,0 +1,604 @@
+"""
+HTTP server implementations for the build pipeline service
+"""
+import asyncore
+from BaseHTTPServer import HTTPServer
+from collections import deque
+import os
+import socket
+from StringIO import StringIO
+import threading
+import time
+
+from . import helpers  # pylint: disable=relative-import
+from .pool import PoolFullError, WorkerPool  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# How to serve requests: 'single' handles one request at a time,
+# 'threaded' hands each connection to a bounded pool of worker threads,
+# 'async' reads and writes every connection on one event loop thread and
+# only hands complete requests to the pool of worker threads.
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded')
+
+# Number of worker threads handling connections in the threaded mode,
+# or handling requests in the async mode
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '8'))
+
+# Number of accepted connections that can wait for a free worker thread.
+# When it is full the server stops accepting and the connections back up
+# in the listen backlog of the socket instead.
+SERVER_QUEUE_SIZE = int(os.environ.get('SERVER_QUEUE_SIZE', '64'))
+
+# Size of the listen backlog of the server socket
+SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', '128'))
+
+# Seconds that a persistent connection may sit idle, or a request may take to
+# arrive, before it is closed. In the threaded mode an idle connection holds on
+# to a worker thread, and in the single mode it holds up the whole server.
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', '5'))
+
+# Number of requests served on a persistent connection before it is closed
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get('KEEPALIVE_MAX_REQUESTS', '100'))
+
+
+class PooledHTTPServer(HTTPServer, object):
+    """ HTTP server that handles connections on a bounded pool of worker threads.
+
+    Unlike SocketServer.ThreadingMixIn this does not start a new thread per
+    connection, so a burst of webhooks cannot exhaust the dyno.
+    """
+    def __init__(self, server_address, handler_class, threads=None, queue_size=None, backlog=None,
+                 bind_and_activate=True):
+        # Read by server_activate() when it starts listening
+        self.request_queue_size = SERVER_BACKLOG if backlog is None else backlog
+        HTTPServer.__init__(self, server_address, handler_class, bind_and_activate)
+        self.pool = WorkerPool(
+            SERVER_THREADS if threads is None else threads,
+            SERVER_QUEUE_SIZE if queue_size is None else queue_size,
+            name='http'
+        )
+
+    def process_request(self, request, client_address):
+        """ Hand the connection to the worker pool, waiting while it is full. """
+        self.pool.submit(self.process_request_thread, (request, client_address))
+
+    def process_request_thread(self, request, client_address):
+        """ Handle a connection on a worker thread. """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """ Stop listening, then let the workers finish the connections already accepted. """
+        HTTPServer.server_close(self)
+        self.pool.shutdown(wait=True)
+
+
+# Longest request head, and longest line in the framing of a chunked body, that the async mode buffers
+_MAX_HEAD_SIZE = 64 * 1024
+_MAX_LINE_SIZE = 1024
+
+_SERVICE_UNAVAILABLE = (
+    'HTTP/1.1 503 Service Unavailable\r\n'
+    'Content-Length: 0\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+)
+
+
+class RequestFramer(object):
+    """ Finds where each HTTP request ends in the bytes received on a connection.
+
+    Only the framing is interpreted here. The request handler parses the complete
+    request again, so that a request which can't be framed is handed over as soon
+    as that is clear, for the handler to answer with the same error it always would.
+
+    Args:
+        max_size (int): the largest body buffered, defaults to helpers.MAX_PAYLOAD_SIZE
+    """
+    def __init__(self, max_size=None):
+        self.max_size = helpers.MAX_PAYLOAD_SIZE if max_size is None else max_size
+        self._buffer = b''
+        # The framing of the current request, see _reset
+        self._parts = []
+        self._state = 'head'
+        self._needed = 0
+        self._body_size = 0
+
+    def _reset(self):
+        """ Start on the next request. """
+        self._parts = []
+        self._state = 'head'
+        self._needed = 0
+        self._body_size = 0
+
+    @property
+    def pending(self):
+        """ Whether part of a request has been received. """
+        return bool(self._buffer or self._parts)
+
+    def feed(self, data):
+        """ Add received bytes.
+
+        Returns:
+            string: the first complete request, None if there isn't one yet. Call
+            again with an empty string for the requests that arrived after it.
+        """
+        self._buffer += data
+        while True:
+            if self._state == 'head':
+                end = self._find_head_end()
+                if end < 0:
+                    return self._complete() if len(self._buffer) > _MAX_HEAD_SIZE else None
+                head = self._take(end)
+                self._start_body(head)
+            elif self._state in ('body', 'chunk_data'):
+                taken = self._take(min(self._needed, len(self._buffer)))
+                self._needed -= len(taken)
+                if self._needed:
+                    return None
+                self._state = 'chunk_end' if self._state == 'chunk_data' else 'done'
+            else:
+                end = self._buffer.find('\n')
+                if end < 0:
+                    return self._complete() if len(self._buffer) > _MAX_LINE_SIZE else None
+                line = self._take(end + 1)
+                self._next_line(line)
+
+            if self._state == 'done':
+                return self._complete()
+
+    def _find_head_end(self):
+        """ The end of the request line and headers in the buffer, -1 if they haven't all arrived. """
+        ends = [
+            index + len(separator) for index, separator in (
+                (self._buffer.find('\r\n\r\n'), '\r\n\r\n'), (self._buffer.find('\n\n'), '\n\n')
+            ) if index >= 0
+        ]
+        return min(ends) if ends else -1
+
+    def _start_body(self, head):
+        """ Work out from the headers how the body is framed. """
+        headers = {}
+        for line in head.splitlines()[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._state = 'chunk_size'
+            return
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            # No body, or one that the handler rejects
+            self._state = 'done'
+            return
+        if length < 0 or length > self.max_size:
+            # The handler rejects the request before reading the body
+            self._state = 'done'
+            return
+        self._state = 'body'
+        self._needed = length
+
+    def _next_line(self, line):
+        """ Follow a line of the framing of a chunked body. """
+        if self._state == 'chunk_end':
+            self._state = 'chunk_size'
+        elif self._state == 'trailer':
+            if not line.strip():
+                self._state = 'done'
+        else:
+            try:
+                size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                self._state = 'done'
+                return
+            self._body_size += size
+            if size <= 0:
+                self._state = 'trailer' if size == 0 else 'done'
+            elif self._body_size > self.max_size:
+                self._state = 'done'
+            else:
+                self._state = 'chunk_data'
+                self._needed = size
+
+    def _take(self, size):
+        """ Move bytes from the buffer to the current request. """
+        taken, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._parts.append(taken)
+        return taken
+
+    def _complete(self):
+        """ Hand over the current request. When it could not be framed, that includes the rest of the buffer. """
+        if self._state != 'done':
+            self._parts.append(self._buffer)
+            self._buffer = b''
+        request = b''.join(self._parts)
+        self._reset()
+        return request
+
+
+class _BufferedConnection(object):
+    """ Stands in for the socket of a request handler: reads a buffered request
+    and sends what the handler writes through the event loop.
+    """
+    closed = False
+
+    def __init__(self, request, channel):
+        self.request = request
+        self.channel = channel
+
+    def makefile(self, mode='r', _bufsize=-1):
+        """ A file to read the request from, or to write the response to. """
+        if 'r' in mode:
+            return StringIO(self.request)
+        return self
+
+    def settimeout(self, _timeout):
+        """ Timeouts are handled by the event loop. """
+        pass
+
+    def write(self, data):
+        """ Send response bytes. """
+        self.channel.server.call_soon(self.channel.push, data)
+
+    def flush(self):
+        """ Writes are not buffered. """
+        pass
+
+    def close(self):
+        """ The connection stays open for the next request. """
+        pass
+
+
+class _Waker(asyncore.file_dispatcher):
+    """ Wakes up the event loop to run calls made from other threads. """
+
+    def __init__(self, server):
+        self._read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read_fd, map=server.socket_map)
+        self.server = server
+
+    def wake(self):
+        """ Make the event loop run the pending calls. """
+        try:
+            os.write(self._write_fd, b'x')
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.run_calls()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class _Channel(asyncore.dispatcher):
+    """ A client connection of the AsyncHTTPServer. """
+
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self.client_address = client_address
+        self.server = server
+        self.framer = RequestFramer()
+        self.requests_served = 0
+        self.last_activity = time.time()
+        self.busy = False
+        self.closing = False
+        self._output = deque()
+
+    def readable(self):
+        # One request at a time per connection, like the other modes
+        return not self.busy and not self.closing
+
+    def writable(self):
+        return bool(self._output)
+
+    def handle_read(self):
+        data = self.recv(helpers.PAYLOAD_CHUNK_SIZE)
+        if data:
+            self.last_activity = time.time()
+            self._next_request(data)
+
+    def _next_request(self, data=b''):
+        """ Hand the next complete request to the worker pool. """
+        request = self.framer.feed(data)
+        if request is None:
+            return
+
+        self.busy = True
+        try:
+            self.server.pool.submit(self._handle, (request,), block=False)
+        except (PoolFullError, RuntimeError):
+            LOGGER.error('No worker thread is free to handle a request from %s', self.client_address[0])
+            # Nothing is running the request, so the connection closes once the 503 is sent
+            self.busy = False
+            self.push(_SERVICE_UNAVAILABLE)
+            self.closing = True
+
+    def _handle(self, request):
+        """ Run the request handler on a worker thread. """
+        close = True
+        try:
+            close = self.server.handle_buffered_request(_BufferedConnection(request, self), self)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Error handling a request from %s', self.client_address[0])
+        finally:
+            self.server.call_soon(self._handled, close)
+
+    def _handled(self, close):
+        """ Carry on with the connection once its request has been handled. """
+        self.busy = False
+        self.last_activity = time.time()
+        if close:
+            self.closing = True
+            if not self._output:
+                self.close()
+        elif not self.closing:
+            # Requests may have been sent before this one was answered
+            self._next_request()
+
+    def push(self, data):
+        """ Queue up bytes to send, from the event loop thread. """
+        if self.connected:
+            self._output.append(data)
+
+    def handle_write(self):
+        data = self._output.popleft()
+        sent = self.send(data)
+        if sent < len(data):
+            self._output.appendleft(data[sent:])
+        elif not self._output and self.closing and not self.busy:
+            self.close()
+
+    def flush_blocking(self):
+        """ Send whatever is left on the way out, without the event loop. """
+        try:
+            self.socket.setblocking(1)
+            while self._output:
+                self.socket.sendall(self._output.popleft())
+        except socket.error:
+            pass
+        self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        LOGGER.exception('Error on the connection from %s', self.client_address[0])
+        self.close()
+
+
+class _Acceptor(asyncore.dispatcher):
+    """ The listening socket of the AsyncHTTPServer. """
+
+    def __init__(self, server, server_address, backlog, bind_and_activate=True):
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        if bind_and_activate:
+            self.set_reuse_addr()
+            self.bind(server_address)
+            self.listen(backlog)
+
+    def use_socket(self, sock):
+        """ Accept connections on a socket that is already listening instead. """
+        self.del_channel()
+        self.socket.close()
+        self.set_socket(sock)
+        self.accepting = True
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            _Channel(sock, client_address, self.server)
+
+    def handle_error(self):
+        LOGGER.exception('Error accepting a connection')
+
+
+def _single_request(handler_class):
+    """ Subclass a request handler to handle one buffered request of a persistent connection. """
+
+    class SingleRequestHandler(handler_class):
+        """ Handles one request, then leaves the connection to the event loop. """
+
+        def __init__(self, request, client_address, server):
+            # The base class handles the request from within its __init__
+            self.requests_served = 0
+            self.close_connection = 1
+            handler_class.__init__(self, request, client_address, server)
+
+        def setup(self):
+            """ Carry the count of the persistent connection over from request to request. """
+            handler_class.setup(self)
+            self.requests_served = self.request.channel.requests_served
+
+        def handle(self):
+            """ Handle the one request. Whether the connection is kept open is up to the event loop. """
+            self.close_connection = 1
+            self.handle_one_request()
+
+    return SingleRequestHandler
+
+
+class AsyncHTTPServer(object):
+    """ HTTP server that handles every connection on one event loop thread.
+
+    Waiting connections cost a file descriptor and a buffer rather than a thread,
+    so slow clients and idle persistent connections can't tie up the workers. Once a
+    request has arrived in full, the request handler runs on the pool of worker
+    threads, with the same results as in the other modes.
+
+    Has the interface of SocketServer.BaseServer that the service uses.
+    """
+    def __init__(self, server_address, handler_class, threads=None, queue_size=None, backlog=None,
+                 bind_and_activate=True):
+        self.RequestHandlerClass = handler_class  # pylint: disable=invalid-name
+        self._single_request_handler = _single_request(handler_class)
+        self.socket_map = {}
+        self._calls = deque()
+        self._waker = _Waker(self)
+        self._acceptor = _Acceptor(
+            self, server_address, SERVER_BACKLOG if backlog is None else backlog, bind_and_activate
+        )
+        self.server_address = self.socket.getsockname() if bind_and_activate else server_address
+        self.server_port = self.server_address[1]
+        self.pool = WorkerPool(
+            SERVER_THREADS if threads is None else threads,
+            SERVER_QUEUE_SIZE if queue_size is None else queue_size,
+            name='http'
+        )
+        self._shutdown_requested = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def _get_socket(self):
+        """ The listening socket. """
+        return self._acceptor.socket
+
+    def _set_socket(self, sock):
+        """ Accept connections on a socket that is already listening instead. """
+        self._acceptor.use_socket(sock)
+
+    # The listening socket, as on SocketServer.BaseServer. listening_server() replaces it.
+    socket = property(_get_socket, _set_socket)
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Run the event loop until shutdown() is called. """
+        self._is_shut_down.clear()
+        try:
+            while not self._shutdown_requested:
+                timeout = self.idle_timeout
+                asyncore.loop(min(poll_interval, timeout or poll_interval), map=self.socket_map, count=1)
+                self._close_idle(timeout)
+        finally:
+            self._shutdown_requested = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """ Stop the event loop and wait for serve_forever() to return. """
+        self._shutdown_requested = True
+        self._waker.wake()
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        """ Stop listening, then finish the requests that have arrived. """
+        self._acceptor.close()
+        self.pool.shutdown(wait=True)
+        self.run_calls()
+        for channel in self.socket_map.values():
+            if isinstance(channel, _Channel):
+                channel.flush_blocking()
+        self._waker.close()
+
+    @property
+    def idle_timeout(self):
+        """ Seconds that a connection may wait for a request, from the request handler class. """
+        return getattr(self.RequestHandlerClass, 'timeout', None)
+
+    def call_soon(self, func, *args):
+        """ Run func(*args) on the event loop thread. Can be called from any thread. """
+        self._calls.append((func, args))
+        self._waker.wake()
+
+    def run_calls(self):
+        """ Run the calls made with call_soon(). """
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+    def handle_buffered_request(self, connection, channel):
+        """ Run the request handler on a request that has been received in full.
+
+        Returns:
+            bool: whether the connection should be closed
+        """
+        handler = self._single_request_handler(connection, channel.client_address, self)
+        channel.requests_served = handler.requests_served
+        return bool(handler.close_connection)
+
+    def _close_idle(self, timeout):
+        """ Close the connections that have been waiting on their client for too long. """
+        if not timeout:
+            return
+        cutoff = time.time() - timeout
+        for channel in self.socket_map.values():
+            if isinstance(channel, _Channel) and not channel.busy and channel.last_activity < cutoff:
+                if channel.framer.pending:
+                    LOGGER.info('Request from %s timed out', channel.client_address[0])
+                channel.close()
+
+
+SERVER_CLASSES = {
+    'single': HTTPServer,
+    'threaded': PooledHTTPServer,
+    'async': AsyncHTTPServer,
+}
+
+
+def create_listener(server_address, backlog=None):
+    """ Open a listening socket, to be shared by the server processes that inherit it.
+
+    Args:
+        server_address (tuple): host and port to listen on
+        backlog (int): size of the listen backlog, defaults to SERVER_BACKLOG
+
+    Returns:
+        socket.socket: the listening socket
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(server_address)
+    listener.listen(SERVER_BACKLOG if backlog is None else backlog)
+    # Every process is woken up by a new connection but only one gets to accept
+    # it, so the others must not block waiting for the next one
+    listener.setblocking(0)
+    return listener
+
+
+def listening_server(server_class, listener, handler_class):
+    """ Create a server that accepts connections on a socket which is already listening.
+
+    Args:
+        server_class (class): one of the SERVER_CLASSES
+        listener (socket.socket): the listening socket, for example from create_listener
+        handler_class (class): the request handler class
+
+    Returns:
+        the server
+    """
+    server_address = listener.getsockname()
+    httpd = server_class(server_address, handler_class, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = listener
+    httpd.server_address = server_address
+    httpd.server_port = server_address[1]
+    return httpd
+
+
+def get_server_class(mode=None):
+    """ Look up the server class for a serving mode.
+
+    Args:
+        mode (string): one of the keys of SERVER_CLASSES, defaults to SERVER_MODE
+
+    Returns:
+        class: the server class to instantiate
+    """
+    mode = mode or SERVER_MODE
+    try:
+        return SERVER_CLASSES[mode]
+    except KeyError:
+        raise ValueError('Unknown SERVER_MODE {}. Use one of: {}'.format(mode, ', '.join(sorted(SERVER_CLASSES))))
@@ -0,0 +1,157 @@
+"""
+Tests for the admission control
+"""
+from BaseHTTPServer import HTTPServer
+import json
+import threading
+from unittest import TestCase
+
+from mock import Mock, patch
+import requests
+
+from ..admission import (
+    CONCURRENCY, EVENT_RATE, QUEUE_DEPTH, REPO_RATE, AdmissionControl, RateLimiter, Shed, TokenBucket
+)
+from ..build_pipeline import PipelineHttpRequestHandler
+from ..dedup import DeliveryCache
+from ..metrics import SHED
+from .utils import sign_payload
+
+
+class TokenBucketTestCase(TestCase):
+    """TestCase class for verifying the token buckets."""
+
+    def test_burst_and_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=1000)
+        self.assertEqual([bucket.take(1000) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.take(1000), 0.5)
+        # A token every half second
+        self.assertEqual(bucket.take(1000.5), 0)
+        # Never more than the burst
+        self.assertEqual([bucket.take(1100) for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_limiter_keys(self):
+        limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+        self.assertEqual(limiter.take('a', 1000), 0)
+        self.assertEqual(limiter.take('a', 1000), 1)
+        # Each key has a bucket of its own
+        self.assertEqual(limiter.take('b', 1000), 0)
+        self.assertEqual(limiter.take('c', 1000), 0)
+        # The bucket of a, used the longest ago, was dropped
+        self.assertEqual(limiter.take('a', 1000), 0)
+
+
+class AdmissionControlTestCase(TestCase):
+    """TestCase class for verifying the admission decisions."""
+
+    def test_concurrency(self):
+        admission = AdmissionControl(max_concurrent=1)
+        before = SHED.value(CONCURRENCY, 'deployment')
+        admission.enter('deployment')
+        with self.assertRaises(Shed) as raised:
+            admission.enter('deployment')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(SHED.value(CONCURRENCY, 'deployment'), before + 1)
+
+        admission.leave()
+        admission.enter('deployment')
+        self.assertEqual(admission.active, 1)
+
+    def test_queue_depth(self):
+        depth = [5]
+        admission = AdmissionControl(max_queue_depth=5, queue_depth=lambda: depth[0])
+        with self.assertRaises(Shed) as raised:
+            admission.enter('deployment')
+        self.assertEqual(raised.exception.reason, QUEUE_DEPTH)
+        self.assertEqual(admission.active, 0)
+        depth[0] = 4
+        admission.enter('deployment')
+
+    def test_event_rate(self):
+        admission = AdmissionControl(event_limiter=RateLimiter(rate=0.25, burst=1))
+        admission.enter('deployment', now=1000)
+        admission.leave()
+        with self.assertRaises(Shed) as raised:
+            admission.enter('deployment', now=1000)
+        self.assertEqual((raised.exception.reason, raised.exception.status), (EVENT_RATE, 429))
+        self.assertEqual(raised.exception.retry_after, 4)
+        # Turned away deliveries don't count as being handled
+        self.assertEqual(admission.active, 0)
+        admission.enter('deployment_status', now=1000)
+
+    def test_repo_rate(self):
+        admission = AdmissionControl(repo_limiter=RateLimiter(rate=1, burst=2))
+        admission.admit_repo('foo/bar', 'deployment', now=1000)
+        admission.admit_repo('foo/bar', 'deployment', now=1000)
+        with self.assertRaises(Shed) as raised:
+            admission.admit_repo('foo/bar', 'deployment', now=1000)
+        self.assertEqual(raised.exception.reason, REPO_RATE)
+        admission.admit_repo('foo/baz', 'deployment', now=1000)
+
+    @patch('build_pipeline.admission.RATE_LIMIT_REPO', 0)
+    @patch('build_pipeline.admission.RATE_LIMIT_EVENT', 0)
+    @patch('build_pipeline.admission.ADMISSION_MAX_CONCURRENT', 0)
+    def test_from_env(self):
+        self.assertIsNone(AdmissionControl.from_env())
+        with patch('build_pipeline.admission.ADMISSION_MAX_CONCURRENT', 10):
+            self.assertEqual(AdmissionControl.from_env().max_concurrent, 10)
+
+
+@patch('build_pipeline.helpers.HANDLED_REPO', 'foo/bar')
+@patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+class SheddingServerTestCase(TestCase):
+    """TestCase class for verifying the responses to the deliveries that are turned away."""
+
+    def setUp(self):
+        super(SheddingServerTestCase, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        # Events are queued before the response goes out
+        self.server.dispatcher = Mock()
+        self.server.dispatcher.submit.return_value = True
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+
+    def _post(self, delivery_id='delivery', event='deployment'):
+        """ Post a signed GitHub event to the server. """
+        contents = json.dumps({'repository': {'full_name': 'foo/bar'}, 'deployment': {'id': 1}})
+        headers = {
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': delivery_id,
+            'X-Hub-Signature-256': sign_payload(contents, 'my_token', 'sha256'),
+        }
+        return requests.post(self.url, headers=headers, data=contents)
+
+    def test_rate_limited(self):
+        self.server.admission = AdmissionControl(event_limiter=RateLimiter(rate=0.1, burst=1))
+        self.assertEqual(self._post('first').status_code, 200)
+        response = self._post('second')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertEqual(response.headers['Connection'], 'close')
+        # Events that are only drained aren't limited
+        self.assertEqual(self._post('third', event='push').status_code, 200)
+        self.assertEqual(self.server.dispatcher.submit.call_count, 1)
+
+    def test_overloaded(self):
+        self.server.admission = AdmissionControl(max_concurrent=1)
+        self.server.admission.active = 1
+        self.assertEqual(self._post().status_code, 503)
+        self.assertFalse(self.server.dispatcher.submit.called)
+
+    @patch('build_pipeline.admission.time.time')
+    def test_repo_rate_limited_redelivery(self, mock_time):
+        mock_time.return_value = 1000
+        self.server.delivery_cache = DeliveryCache(10, 60)
+        self.server.admission = AdmissionControl(repo_limiter=RateLimiter(rate=1, burst=1))
+        self.assertEqual(self._post('first').status_code, 200)
+        self.assertEqual(self._post('second').status_code, 429)
+        self.assertEqual(self.server.admission.active, 0)
+
+        # The redelivery isn't taken for a duplicate once the repo is within its limit again
+        mock_time.return_value = 1001
+        self.assertEqual(self._post('second').status_code, 200)
+        self.assertEqual(self.server.dispatcher.submit.call_count, 2)
@@ -0,0 +1,62 @@
+"""
+Tests for the load test harness
+"""
+import json
+from unittest import TestCase
+
+from mock import patch
+
+from .. import helpers
+from ..benchmark import compare, make_requests, parse_mix, percentile, run_benchmark
+from ..helpers import is_valid_gh_event
+
+
+class BenchmarkTestCase(TestCase):
+    """TestCase class for verifying the benchmark harness."""
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_requests_are_signed_and_reproducible(self):
+        requests = make_requests(10, {'deployment': 1, 'push': 1}, seed=3)
+        self.assertEqual(requests, make_requests(10, {'deployment': 1, 'push': 1}, seed=3))
+        for event, headers, body in requests:
+            self.assertEqual(headers['X-GitHub-Event'], event)
+            self.assertTrue(is_valid_gh_event(headers['X-Hub-Signature-256'], event, body, json.loads(body)))
+
+    @patch('build_pipeline.dispatch.DISPATCH_WORKERS', 0)
+    @patch('build_pipeline.servers.SERVER_MODE', 'threaded')
+    def test_run(self):
+        requests = make_requests(20, parse_mix('deployment=1,deployment_status=1,push=2'))
+        report = run_benchmark(requests, concurrency=4, sns_latency=0)
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['published'], 0)
+        self.assertLessEqual(report['p50_ms'], report['p99_ms'])
+
+        # The components of the service aren't left to the other tests
+        self.assertIsNone(helpers.SNS_BREAKER)
+        self.assertIsNone(helpers.DEPLOYMENT_INDEX)
+
+    @patch('build_pipeline.dispatch.DISPATCH_WORKERS', 0)
+    @patch('build_pipeline.servers.SERVER_MODE', 'threaded')
+    def test_run_keep_alive(self):
+        report = run_benchmark(make_requests(20, parse_mix('deployment=1,push=1')), 4, 0, keep_alive=True)
+        self.assertTrue(report['keep_alive'])
+        self.assertEqual(report['errors'], 0)
+
+    @patch('build_pipeline.servers.SERVER_MODE', 'async')
+    def test_run_async(self):
+        report = run_benchmark(make_requests(20, parse_mix('deployment=1,push=1')), 4, 0, keep_alive=True)
+        self.assertEqual(report['server'], 'AsyncHTTPServer')
+        self.assertEqual(report['errors'], 0)
+
+    def test_compare(self):
+        lines = compare({'requests_per_second': 200, 'p99_ms': 50}, {'requests_per_second': 100, 'p99_ms': 100})
+        self.assertEqual(len(lines), 2)
+        self.assertIn('+100.0% better', lines[0])
+        self.assertIn('-50.0% better', lines[1])
@@ -0,0 +1,62 @@
+"""
+Tests for the circuit breaker
+"""
+from unittest import TestCase
+
+from ..breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from ..metrics import CIRCUIT_STATE, CIRCUIT_TRIPS
+
+
+class CircuitBreakerTestCase(TestCase):
+    """TestCase class for verifying the circuit breaker."""
+
+    def setUp(self):
+        super(CircuitBreakerTestCase, self).setUp()
+        self.breaker = CircuitBreaker('test_breaker', window=10, min_calls=4, error_rate=0.5, reset_timeout=30)
+        self.trips = CIRCUIT_TRIPS.value('test_breaker')
+
+    def call(self, success, now=1000):
+        """ Make a call through the breaker, if it allows one. """
+        if not self.breaker.allow(now):
+            return False
+        self.breaker.record(success, now)
+        return True
+
+    def test_opens_at_the_error_rate(self):
+        for success in (True, False, True):
+            self.call(success)
+        # Too few calls to judge by
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        self.call(False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.call(True, now=1010))
+        self.assertEqual(CIRCUIT_STATE.value('test_breaker'), 1)
+        self.assertEqual(CIRCUIT_TRIPS.value('test_breaker'), self.trips + 1)
+
+    def test_stays_closed_below_the_error_rate(self):
+        for success in (True, True, False, True, True, False, True):
+            self.call(success)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe(self):
+        for _ in range(4):
+            self.call(False)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        # One call probes the service after the reset timeout, the others are still rejected
+        self.assertTrue(self.breaker.allow(now=1030))
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow(now=1030))
+
+        # A failed probe opens the breaker for another timeout
+        self.breaker.record(False, now=1030)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow(now=1059))
+        self.assertEqual(self.breaker.trips, 2)
+
+        # A successful probe closes it
+        self.assertTrue(self.call(True, now=1060))
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.call(False, now=1061))
+        self.assertEqual(self.breaker.state, CLOSED)
@@ -0,0 +1,88 @@
+"""
+Tests for the recording of webhook deliveries
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from ..capture import DeliveryCapture, delivery_record, find_deliveries
+from ..replay import Replayer, read_deliveries
+
+
+class DeliveryCaptureTestCase(TestCase):
+    """TestCase class for verifying the capture of deliveries."""
+
+    def setUp(self):
+        super(DeliveryCaptureTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def capture(self, count, **kwargs):
+        """ Record a number of deliveries and stop the capture. """
+        capture = DeliveryCapture(self.directory, **kwargs)
+        capture.start()
+        for index in range(count):
+            headers = {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'delivery-{}'.format(index)}
+            capture.record(headers, json.dumps({'index': index}), 1443700000 + index, 'ignored')
+        capture.stop()
+        return capture
+
+    def segments(self):
+        """ The names of the segments in the directory. """
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.jsonl.gz'))
+
+    def test_recorded(self):
+        capture = self.capture(3)
+        self.assertEqual(capture.written, 3)
+        self.assertEqual(len(self.segments()), 1)
+
+        with gzip.open(os.path.join(self.directory, self.segments()[0])) as segment:
+            records = [json.loads(line) for line in segment]
+        self.assertEqual(records[2], {
+            'headers': {'X-GitHub-Event': 'push', 'X-GitHub-Delivery': 'delivery-2'},
+            'body': '{"index": 2}', 'received_at': 1443700002, 'outcome': 'ignored'
+        })
+
+    def test_rotation_and_index(self):
+        self.capture(10, segment_bytes=300)
+        self.assertGreater(len(self.segments()), 2)
+
+        found = list(find_deliveries(self.directory, ['delivery-1', 'delivery-8', 'unknown']))
+        self.assertEqual(
+            sorted(json.loads(delivery['body'])['index'] for _, delivery in found), [1, 8]
+        )
+
+        # The segments are replayed as they are
+        counts = Replayer(dry_run=True).run(read_deliveries([self.directory]))
+        self.assertEqual(counts, {'ignored': 10})
+
+    def test_retention(self):
+        self.capture(10, segment_bytes=300)
+        old = self.segments()[0]
+        for name in (old, old.replace('.jsonl.gz', '.idx')):
+            os.utime(os.path.join(self.directory, name), (time.time() - 7200, time.time() - 7200))
+
+        capture = DeliveryCapture(self.directory, retention_hours=1)
+        self.assertEqual(capture.prune(), 2)
+        self.assertNotIn(old, self.segments())
+
+    def test_binary_body(self):
+        record = json.loads(delivery_record({}, '\xff\xfe', 0))
+        self.assertEqual(record['body_base64'], '//4=')
+        self.assertNotIn('body', record)
+
+    def test_full_queue(self):
+        capture = DeliveryCapture(self.directory, queue_size=1)
+        capture.record({}, 'one', 0)
+        capture.record({}, 'two', 0)
+        self.assertEqual(capture.dropped, 1)
+
+    @patch('build_pipeline.capture.CAPTURE_DIR', None)
+    def test_from_env(self):
+        self.assertIsNone(DeliveryCapture.from_env())
@@ -0,0 +1,57 @@
+"""
+Tests for the debouncing of deployments
+"""
+import threading
+from unittest import TestCase
+
+from ..debounce import DeploymentDebouncer
+
+
+class DeploymentDebouncerTestCase(TestCase):
+    """TestCase class for verifying that only the newest deployment gets provisioned."""
+
+    def setUp(self):
+        super(DeploymentDebouncerTestCase, self).setUp()
+        self.provisioned = []
+
+    def _submit(self, debouncer, deployment_id, environment='sandbox'):
+        """ Submit a deployment that records its id when it gets provisioned. """
+        deployment = {'id': deployment_id, 'sha': 'sha{}'.format(deployment_id), 'environment': environment}
+        debouncer.submit(('org/repo', environment), deployment, lambda: self.provisioned.append(deployment_id))
+
+    def test_newest_deployment_wins(self):
+        debouncer = DeploymentDebouncer(60)
+        for deployment_id in (1, 2, 3):
+            self._submit(debouncer, deployment_id)
+        self._submit(debouncer, 10, environment='staging')
+        debouncer.flush()
+        self.assertEqual(sorted(self.provisioned), [3, 10])
+        self.assertEqual(debouncer.superseded, 2)
+
+    def test_out_of_order_deployment(self):
+        debouncer = DeploymentDebouncer(60)
+        self._submit(debouncer, 2)
+        self._submit(debouncer, 1)
+        debouncer.flush()
+        self.assertEqual(self.provisioned, [2])
+
+    def test_provisioned_after_window(self):
+        done = threading.Event()
+        debouncer = DeploymentDebouncer(0.05)
+        debouncer.submit(('org/repo', 'sandbox'), {'id': 1}, done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_error_is_contained(self):
+        debouncer = DeploymentDebouncer(60)
+        debouncer.submit(('org/repo', 'sandbox'), {'id': 1}, lambda: 1 / 0)
+        self._submit(debouncer, 5, environment='staging')
+        debouncer.flush()
+        self.assertEqual(self.provisioned, [5])
+
+    def test_failure_is_reported(self):
+        failures = []
+        debouncer = DeploymentDebouncer(60)
+        debouncer.submit(('org/repo', 'sandbox'), {'id': 1}, lambda: 1 / 0, on_failure=lambda: failures.append(1))
+        debouncer.submit(('org/repo', 'staging'), {'id': 2}, lambda: None, on_failure=lambda: failures.append(2))
+        debouncer.flush()
+        self.assertEqual(failures, [1])
@@ -0,0 +1,79 @@
+"""
+Tests for the detection of redelivered webhooks
+"""
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from ..dedup import DeliveryCache, RedisDeliveryBackend, delivery_key
+
+
+class DeliveryKeyTestCase(TestCase):
+    """TestCase class for verifying how deliveries are identified."""
+
+    def test_delivery_id(self):
+        self.assertEqual(delivery_key('abc-123', 'payload', hash_fallback=True), 'delivery:abc-123')
+
+    def test_hash_fallback(self):
+        self.assertIsNone(delivery_key(None, 'payload'))
+        key = delivery_key(None, 'payload', hash_fallback=True)
+        self.assertTrue(key.startswith('sha1:'))
+        self.assertEqual(key, delivery_key('', 'payload', hash_fallback=True))
+        self.assertNotEqual(key, delivery_key(None, 'other payload', hash_fallback=True))
+
+
+@patch('build_pipeline.dedup.time.time', return_value=1000)
+class DeliveryCacheTestCase(TestCase):
+    """TestCase class for verifying the cache of recent deliveries."""
+
+    def test_duplicates(self, _mock_time):
+        cache = DeliveryCache(10, 60)
+        self.assertFalse(cache.seen('one'))
+        self.assertTrue(cache.seen('one'))
+        self.assertFalse(cache.seen('two'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_expiry(self, mock_time):
+        cache = DeliveryCache(10, 60)
+        cache.seen('one')
+        cache.seen('two')
+        mock_time.return_value = 1030
+        self.assertTrue(cache.seen('one'))
+        mock_time.return_value = 1061
+        self.assertFalse(cache.seen('one'))
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_is_evicted(self, _mock_time):
+        cache = DeliveryCache(2, 60)
+        cache.seen('one')
+        cache.seen('two')
+        cache.seen('one')
+        cache.seen('three')
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.seen('one'))
+        self.assertFalse(cache.seen('two'))
+
+    def test_forget(self, _mock_time):
+        cache = DeliveryCache(10, 60)
+        cache.seen('one')
+        cache.forget('one')
+        self.assertFalse(cache.seen('one'))
+
+    def test_shared_backend(self, _mock_time):
+        client = Mock()
+        client.set.return_value = None
+        cache = DeliveryCache(10, 60, backend=RedisDeliveryBackend(None, 60, client=client))
+
+        # Another dyno already handled the delivery
+        self.assertTrue(cache.seen('one'))
+        client.set.assert_called_once_with('build_pipeline:one', '1', nx=True, ex=60)
+
+        cache.forget('one')
+        client.delete.assert_called_once_with('build_pipeline:one')
+
+    def test_shared_backend_down(self, _mock_time):
+        client = Mock()
+        client.set.side_effect = IOError('Connection refused')
+        cache = DeliveryCache(10, 60, backend=RedisDeliveryBackend(None, 60, client=client))
+        self.assertFalse(cache.seen('one'))
+        self.assertTrue(cache.seen('one'))
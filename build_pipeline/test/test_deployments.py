@@ -0,0 +1,165 @@
+"""
+Tests for the deployment index
+"""
+from BaseHTTPServer import HTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch
+import requests
+
+from ..build_pipeline import PipelineHttpRequestHandler
+from ..deployments import CREATED, REPEATED, SUPERSEDED, DeploymentIndex
+from ..metrics import TRIGGERS_SUPPRESSED
+
+
+def deployment(deployment_id, environment='staging', sha='abc'):
+    """ A deployment object as in the webhook payloads. """
+    return {'id': deployment_id, 'environment': environment, 'sha': sha, 'task': 'deploy'}
+
+
+class DeploymentIndexTestCase(TestCase):
+    """TestCase class for verifying the deployment index."""
+
+    def setUp(self):
+        super(DeploymentIndexTestCase, self).setUp()
+        self.index = DeploymentIndex(10)
+
+    def test_observe(self):
+        self.index.observe('foo/bar', deployment(1), CREATED, now=1000)
+        self.index.observe('foo/bar', deployment(1), 'pending', now=1001)
+        # A late deployment event doesn't undo the status
+        self.index.observe('foo/bar', deployment(1), CREATED, now=1002)
+        entry = self.index.get('foo/bar', 'staging')
+        self.assertEqual(entry['state'], 'pending')
+        self.assertEqual(entry['sha'], 'abc')
+        self.assertEqual((entry['first_seen_at'], entry['updated_at']), (1000, 1002))
+        self.assertIsNone(self.index.get('foo/bar', 'production'))
+
+    def test_repeated_transition(self):
+        before = TRIGGERS_SUPPRESSED.value(REPEATED)
+        self.assertIsNone(self.index.claim('foo/bar', deployment(1), 'success', 'sitespeed'))
+        self.index.confirm(deployment(1), 'success', 'sitespeed', 'msg-1')
+        self.assertEqual(self.index.claim('foo/bar', deployment(1), 'success', 'sitespeed'), REPEATED)
+        # Other jobs and transitions are still triggered
+        self.assertIsNone(self.index.claim('foo/bar', deployment(1), 'success', 'other'))
+        self.assertIsNone(self.index.claim('foo/bar', deployment(1), CREATED, 'provision'))
+        self.assertEqual(self.index.get('foo/bar', 'staging')['triggered']['success'], {
+            'sitespeed': 'msg-1', 'other': None
+        })
+        self.assertEqual(TRIGGERS_SUPPRESSED.value(REPEATED), before + 1)
+
+    def test_released_claim(self):
+        self.assertIsNone(self.index.claim('foo/bar', deployment(1), 'success', 'sitespeed'))
+        self.index.release(deployment(1), 'success', 'sitespeed')
+        # A redelivery gets to try again
+        self.assertIsNone(self.index.claim('foo/bar', deployment(1), 'success', 'sitespeed'))
+
+    def test_superseded(self):
+        self.index.observe('foo/bar', deployment(20), CREATED)
+        self.assertEqual(self.index.claim('foo/bar', deployment(10), 'success', 'sitespeed'), SUPERSEDED)
+        # Deployments to other environments or repos don't supersede it
+        self.assertIsNone(self.index.claim('foo/bar', deployment(11, 'production'), 'success', 'sitespeed'))
+        self.assertIsNone(self.index.claim('foo/baz', deployment(12), 'success', 'sitespeed'))
+        self.assertEqual(self.index.get('foo/bar', 'staging')['id'], 20)
+
+    def test_lru_eviction(self):
+        self.index = DeploymentIndex(3)
+        for deployment_id in (1, 2, 3):
+            self.index.observe('foo/bar', deployment(deployment_id, 'env{}'.format(deployment_id)), CREATED)
+        # Using the first deployment keeps it in the index
+        self.index.observe('foo/bar', deployment(1, 'env1'), 'success')
+        self.index.observe('foo/bar', deployment(4, 'env4'), CREATED)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.evicted, 1)
+        self.assertEqual(
+            [entry['environment'] for entry in self.index.environments('foo/bar')], ['env1', 'env3', 'env4']
+        )
+
+    def test_without_id(self):
+        self.index.observe('foo/bar', {'environment': 'staging'}, CREATED)
+        self.assertIsNone(self.index.claim('foo/bar', {}, 'success', 'sitespeed'))
+        self.assertEqual(len(self.index), 0)
+
+
+class SnapshotTestCase(TestCase):
+    """TestCase class for verifying the snapshots of the deployment index."""
+
+    def setUp(self):
+        super(SnapshotTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'deployments.json')
+
+    def test_restart(self):
+        index = DeploymentIndex(10, self.path)
+        index.start()
+        index.claim('foo/bar', deployment(1), 'success', 'sitespeed')
+        index.confirm(deployment(1), 'success', 'sitespeed', 'msg-1')
+        index.stop()
+
+        restarted = DeploymentIndex(10, self.path)
+        restarted.start()
+        self.addCleanup(restarted.stop)
+        self.assertEqual(restarted.claim('foo/bar', deployment(1), 'success', 'sitespeed'), REPEATED)
+        self.assertEqual(os.listdir(self.directory), ['deployments.json'])
+
+    def test_snapshot_of_each_worker(self):
+        with patch('build_pipeline.deployments.DEPLOYMENT_INDEX_SNAPSHOT_PATH', self.path):
+            index = DeploymentIndex.from_env(worker=1)
+            index.observe('foo/bar', deployment(1), CREATED)
+            index.stop()
+            self.assertEqual(os.listdir(self.directory), ['deployments.json.1'])
+
+            index = DeploymentIndex.from_env()
+            self.addCleanup(index.stop)
+            self.assertEqual(index.snapshot_path, self.path)
+
+    def test_unreadable_snapshot(self):
+        with open(self.path, 'w') as snapshot:
+            snapshot.write('{not json')
+        self.assertEqual(DeploymentIndex(10).load(self.path), 0)
+
+
+class DeploymentsEndpointTestCase(TestCase):
+    """TestCase class for verifying the endpoint that serves the deployment index."""
+
+    def setUp(self):
+        super(DeploymentsEndpointTestCase, self).setUp()
+        self.index = DeploymentIndex(10)
+        patcher = patch('build_pipeline.helpers.DEPLOYMENT_INDEX', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = HTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}/deployments".format(port=self.server.server_address[1])
+
+    def test_environment(self):
+        self.index.observe('foo/bar', deployment(1), 'success')
+        response = requests.get(self.url, params={'repo': 'foo/bar', 'environment': 'staging'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], 'success')
+
+        response = requests.get(self.url, params={'repo': 'foo/bar', 'environment': 'production'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_all_environments(self):
+        self.index.observe('foo/bar', deployment(1), CREATED)
+        self.index.observe('foo/baz', deployment(2, 'production'), CREATED)
+        response = requests.get(self.url)
+        self.assertEqual([entry['id'] for entry in response.json()['deployments']], [1, 2])
+        response = requests.get(self.url, params={'repo': 'foo/baz'})
+        self.assertEqual(json.loads(response.content)['deployments'][0]['environment'], 'production')
+
+    def test_turned_off(self):
+        with patch('build_pipeline.helpers.DEPLOYMENT_INDEX', None):
+            self.assertEqual(requests.get(self.url).status_code, 404)
@@ -0,0 +1,103 @@
+"""
+Tests for the asynchronous event dispatch
+"""
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from ..dispatch import Dispatcher, PUBLISHED, IGNORED, FAILED, DEFERRED, DROPPED
+from ..helpers import SnsError
+from ..outbox import SnsDeferredError
+
+
+class DispatcherTestCase(TestCase):
+    """TestCase class for verifying the dispatch of events to the publisher workers."""
+
+    def setUp(self):
+        super(DispatcherTestCase, self).setUp()
+        self.results = []
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _record(self, event, outcome, detail):
+        """ Collect the outcome reports. """
+        self.results.append((event, outcome, detail))
+
+    def _block(self, event, _data, on_failure=None):  # pylint: disable=unused-argument
+        """ Hold up the worker until the test releases it. """
+        self.release.wait()
+        return 'id-{}'.format(event)
+
+    @patch('build_pipeline.dispatch.parse_webhook_payload')
+    def test_outcomes(self, mock_parse):
+        mock_parse.side_effect = ['msg_id', None, SnsError('boom')]
+        dispatcher = Dispatcher(1, 10, on_outcome=self._record)
+        for event in ('deployment', 'push', 'deployment_status'):
+            dispatcher.submit(event, {})
+        self.assertTrue(dispatcher.shutdown())
+
+        self.assertEqual(
+            [(event, outcome) for event, outcome, _ in self.results],
+            [('deployment', PUBLISHED), ('push', IGNORED), ('deployment_status', FAILED)]
+        )
+        self.assertEqual(self.results[0][2], 'msg_id')
+        self.assertEqual(dispatcher.outcomes[PUBLISHED], 1)
+
+    @patch('build_pipeline.dispatch.parse_webhook_payload')
+    def test_drop_newest(self, mock_parse):
+        mock_parse.side_effect = self._block
+        dispatcher = Dispatcher(1, 1, overflow='drop_newest', on_outcome=self._record)
+        dispatcher.submit('first', {})
+        while mock_parse.call_count == 0:
+            pass
+        self.assertTrue(dispatcher.submit('second', {}))
+        self.assertFalse(dispatcher.submit('third', {}))
+        self.release.set()
+        dispatcher.shutdown()
+
+        self.assertIn(('third', DROPPED), [(event, outcome) for event, outcome, _ in self.results])
+        self.assertEqual(dispatcher.outcomes, {PUBLISHED: 2, IGNORED: 0, FAILED: 0, DEFERRED: 0, DROPPED: 1})
+
+    @patch('build_pipeline.dispatch.parse_webhook_payload')
+    def test_drop_oldest(self, mock_parse):
+        mock_parse.side_effect = self._block
+        dispatcher = Dispatcher(1, 1, overflow='drop_oldest', on_outcome=self._record)
+        dispatcher.submit('first', {})
+        while mock_parse.call_count == 0:
+            pass
+        self.assertTrue(dispatcher.submit('second', {}))
+        self.assertTrue(dispatcher.submit('third', {}))
+        self.release.set()
+        dispatcher.shutdown()
+
+        self.assertEqual(
+            sorted((event, outcome) for event, outcome, _ in self.results),
+            [('first', PUBLISHED), ('second', DROPPED), ('third', PUBLISHED)]
+        )
+
+    @patch('build_pipeline.dispatch.parse_webhook_payload')
+    def test_on_failure(self, mock_parse):
+        mock_parse.side_effect = ['msg_id', SnsError('boom'), KeyError('repository')]
+        failures = []
+        dispatcher = Dispatcher(1, 10)
+        dispatcher.submit('deployment', {}, on_failure=lambda: failures.append('first'))
+        dispatcher.submit('deployment', {}, on_failure=lambda: failures.append('second'))
+        dispatcher.submit('deployment', {}, on_failure=lambda: failures.append('third'))
+        dispatcher.shutdown()
+        # Unexpected errors count as failures too
+        self.assertEqual(failures, ['second', 'third'])
+        self.assertEqual(dispatcher.outcomes[FAILED], 2)
+
+    @patch('build_pipeline.dispatch.parse_webhook_payload')
+    def test_deferred(self, mock_parse):
+        mock_parse.side_effect = SnsDeferredError('boom')
+        failures = []
+        dispatcher = Dispatcher(1, 10, on_outcome=self._record)
+        dispatcher.submit('deployment', {}, on_failure=lambda: failures.append('deployment'))
+        dispatcher.shutdown()
+        self.assertEqual(self.results[0][1], DEFERRED)
+        self.assertEqual(failures, [])
+
+    def test_unknown_overflow_policy(self):
+        self.assertRaises(ValueError, Dispatcher, 1, 1, overflow='bogus')
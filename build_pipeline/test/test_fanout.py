@@ -0,0 +1,87 @@
+"""
+Tests for the concurrent publishing to the targets of an event
+"""
+import threading
+import time
+from unittest import TestCase
+
+from ..fanout import DeadlineExceeded, FanOut, StillRunning, run_sequentially
+
+
+def _sleep_and_return(seconds, value):
+    """ A call that takes a while. """
+    def call():
+        """ Sleep, then return the value. """
+        time.sleep(seconds)
+        return value
+    return call
+
+
+def _fail():
+    """ A call that fails. """
+    raise ValueError('failed')
+
+
+class FanOutTestCase(TestCase):
+    """TestCase class for verifying the fan-out of calls."""
+
+    def setUp(self):
+        super(FanOutTestCase, self).setUp()
+        self.fanout = FanOut(4)
+        self.addCleanup(self.fanout.shutdown)
+
+    def test_concurrent(self):
+        start = time.time()
+        results = self.fanout.run([(key, _sleep_and_return(0.3, key.upper())) for key in ('a', 'b', 'c')])
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual([(result.key, result.value, result.error) for result in results], [
+            ('a', 'A', None), ('b', 'B', None), ('c', 'C', None)
+        ])
+
+    def test_partial_failure(self):
+        results = self.fanout.run([('a', _sleep_and_return(0, 'A')), ('b', _fail)])
+        self.assertEqual(results[0].value, 'A')
+        self.assertIsNone(results[1].value)
+        self.assertIsInstance(results[1].error, ValueError)
+
+    def test_deadline(self):
+        late = []
+        start = time.time()
+        results = self.fanout.run(
+            [('fast', _sleep_and_return(0, 1)), ('slow', _sleep_and_return(0.5, 2))], timeout=0.2, on_late=late.append
+        )
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(results[0].value, 1)
+        self.assertIsInstance(results[1].error, StillRunning)
+
+        # The outcome of the slow call is reported once it has finished
+        self.assertEqual(late, [])
+        self.fanout.shutdown()
+        self.assertEqual([[result.value for result in final] for final in late], [[1, 2]])
+
+    def test_cancelled_at_deadline(self):
+        release = threading.Event()
+        called = []
+        fanout = FanOut(1)
+        self.addCleanup(fanout.shutdown)
+        results = fanout.run([('slow', release.wait), ('queued', lambda: called.append('queued'))], timeout=0.1)
+        release.set()
+        fanout.shutdown()
+
+        # The call that had not started is not made at all
+        self.assertIsInstance(results[0].error, StillRunning)
+        self.assertIsInstance(results[1].error, DeadlineExceeded)
+        self.assertNotIsInstance(results[1].error, StillRunning)
+        self.assertEqual(called, [])
+
+    def test_pool_busy(self):
+        # Calls that don't fit in the pool are made on the calling thread
+        fanout = FanOut(1)
+        self.addCleanup(fanout.shutdown)
+        results = fanout.run([(index, _sleep_and_return(0.01, index)) for index in range(10)])
+        self.assertEqual([result.value for result in results], range(10))
+
+    def test_sequential_deadline(self):
+        results = run_sequentially([('slow', _sleep_and_return(0.2, 1)), ('skipped', _sleep_and_return(0, 2))], 0.1)
+        self.assertEqual(results[0].value, 1)
+        self.assertIsInstance(results[1].error, DeadlineExceeded)
@@ -1,22 +1,46 @@
 """
 Tests for the helper methods
 """
+from collections import OrderedDict
 import hashlib
 import hmac
+from functools import partial
 import json
+from StringIO import StringIO
+import threading
+import time
 from unittest import TestCase
 
-from mock import patch
+from boto.exception import BotoServerError
+from mock import Mock, patch
 from moto import mock_sns
 
-from .utils import create_topic
+from .utils import create_topic, sign_payload
 from ..helpers import publish_sns_messsage, SnsError, parse_webhook_payload, is_valid_gh_event
-from ..helpers import _compose_sns_message
+from ..helpers import (
+    _compose_custom_data, _compose_sns_message, get_sns_connection, prewarm_sns_connections, reset_sns_connections
+)
+from ..helpers import PayloadTooLargeError, SignatureVerifier, read_chunked_payload, read_payload
+from ..helpers import extract_webhook_fields, handle_deployment_status_event, is_handled_event, may_concern_handled_repo
+from ..breaker import CircuitBreaker
+from ..debounce import DeploymentDebouncer
+from ..dedup import DeliveryCache
+from ..deployments import DeploymentIndex
+from ..fanout import FanOut
+from ..helpers import CircuitOpenError
+from ..helpers import SnsDeferredError
+from ..routing import compile_routes
+from ..tracing import new_trace
 
 
 @mock_sns
 class SNSTestCase(TestCase):
     """TestCase class for verifying helper methods that use SNS."""
+    def setUp(self):
+        super(SNSTestCase, self).setUp()
+        # Don't reuse connections opened outside of the mocked SNS
+        reset_sns_connections()
+        self.addCleanup(reset_sns_connections)
 
     def test_nonexistent_sns_topic_arn(self):
         # There are no topics yet in the mocked SNS, so using
@@ -31,6 +55,74 @@ class SNSTestCase(TestCase):
         self.assertIsNotNone(msg_id)
 
 
+@patch('build_pipeline.helpers.connect_sns')
+class SNSConnectionTestCase(TestCase):
+    """TestCase class for verifying the reuse of SNS connections."""
+    def setUp(self):
+        super(SNSConnectionTestCase, self).setUp()
+        reset_sns_connections()
+        self.addCleanup(reset_sns_connections)
+
+    def test_connection_is_reused(self, mock_connect):
+        mock_connect.return_value.publish.return_value = {
+            'PublishResponse': {'PublishResult': {'MessageId': 'foo'}}
+        }
+        publish_sns_messsage(topic_arn='arn', message='one')
+        publish_sns_messsage(topic_arn='arn', message='two')
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(mock_connect.return_value.publish.call_count, 2)
+
+    def test_new_connection_for_new_credentials(self, mock_connect):
+        mock_connect.side_effect = lambda: Mock(http_connection_kwargs={})
+        with patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'one'}):
+            first = get_sns_connection()
+            self.assertIs(get_sns_connection(), first)
+        with patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'two'}):
+            self.assertIsNot(get_sns_connection(), first)
+
+    def test_prewarmed_connections(self, mock_connect):
+        mock_connect.side_effect = lambda: Mock(http_connection_kwargs={})
+        prewarm_sns_connections(2)
+        self.assertEqual(mock_connect.call_count, 2)
+
+        # Taken by the first threads that publish, already connected
+        conn = get_sns_connection()
+        self.assertTrue(conn.new_http_connection.return_value.connect.called)
+        conn.put_http_connection.assert_called_once_with(
+            conn.host, conn.port, conn.is_secure, conn.new_http_connection.return_value
+        )
+        self.assertEqual(mock_connect.call_count, 2)
+
+    def test_connection_is_evicted_after_error(self, mock_connect):
+        mock_connect.return_value.publish.side_effect = BotoServerError(500, 'Internal Error')
+        self.assertRaises(SnsError, publish_sns_messsage, 'arn', 'msg')
+        self.assertRaises(SnsError, publish_sns_messsage, 'arn', 'msg')
+        self.assertEqual(mock_connect.call_count, 2)
+
+    @patch('build_pipeline.helpers.SNS_REGION', 'not-a-region')
+    def test_unknown_region(self, _mock_connect):
+        self.assertRaises(SnsError, get_sns_connection)
+
+    @patch('build_pipeline.helpers.SNS_TIMEOUT', 2.5)
+    @patch('build_pipeline.helpers.SNS_MAX_RETRIES', 0)
+    def test_timeouts(self, mock_connect):
+        mock_connect.return_value.http_connection_kwargs = {'timeout': 70}
+        conn = get_sns_connection()
+        self.assertEqual(conn.http_connection_kwargs['timeout'], 2.5)
+        self.assertEqual(conn.num_retries, 0)
+
+    def test_circuit_breaker(self, mock_connect):
+        mock_connect.return_value.publish.side_effect = BotoServerError(500, 'Internal Error')
+        breaker = CircuitBreaker('test', window=4, min_calls=2, error_rate=0.5, reset_timeout=60)
+        with patch('build_pipeline.helpers.SNS_BREAKER', breaker):
+            self.assertRaises(SnsError, publish_sns_messsage, 'arn', 'msg')
+            self.assertRaises(SnsError, publish_sns_messsage, 'arn', 'msg')
+            # Fails fast once the breaker is open
+            self.assertRaises(CircuitOpenError, publish_sns_messsage, 'arn', 'msg')
+        self.assertEqual(mock_connect.return_value.publish.call_count, 2)
+        self.assertEqual(breaker.trips, 1)
+
+
 class ComposeTestCase(TestCase):
     """TestCase class for verifying the method that composes the message."""
     def test_compose_message_default_format(self):
@@ -57,6 +149,16 @@ class ComposeTestCase(TestCase):
             }
         )
 
+    def test_compose_custom_data_with_trace(self):
+        trace = {'trace_id': '1-abc', 'received_at': 1443700800.5}
+        custom_data = _compose_custom_data({'id': 1}, (('deployment_id', 'id'),), trace, published_at=1443700801)
+        self.assertEqual(custom_data['parameters'], [
+            {'name': 'deployment_id', 'type': 'string', 'value': 1},
+            {'name': 'trace_id', 'type': 'string', 'value': '1-abc'},
+            {'name': 'received_at', 'type': 'string', 'value': '2015-10-01T12:00:00.500Z'},
+            {'name': 'published_at', 'type': 'string', 'value': '2015-10-01T12:00:01.000Z'},
+        ])
+
 
 class ParsePayloadTestCase(TestCase):
     """TestCase class for verifying the helper method for parsing the payload."""
@@ -74,6 +176,199 @@ class ParsePayloadTestCase(TestCase):
         result = parse_webhook_payload('deployment', self.payload)
         self.assertEqual(result, 'foo')
 
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_unsuccessful_status_not_published(self, mock_publish):
+        mock_publish.return_value = 'foo'
+        handle = partial(handle_deployment_status_event, 'topic', 'org', 'repo', self.payload['deployment'])
+        for state in ('pending', 'failure', 'error'):
+            self.assertIsNone(handle({'state': state}))
+        self.assertFalse(mock_publish.called)
+
+        self.assertEqual(handle({'state': 'success'}), 'foo')
+        self.assertEqual(handle({'state': 'failure'}, states=('failure',)), 'foo')
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_webhook_payload_debounced(self, mock_publish):
+        debouncer = Mock()
+        with patch('build_pipeline.helpers.DEPLOYMENT_DEBOUNCER', debouncer):
+            result = parse_webhook_payload('deployment', self.payload)
+        self.assertEqual(result, None)
+        self.assertFalse(mock_publish.called)
+
+        key, deployment, provision = debouncer.submit.call_args[0]
+        self.assertEqual(key, ('org/repo', None))
+        self.assertEqual(deployment, {'id': '1234'})
+        mock_publish.return_value = 'foo'
+        self.assertEqual(provision(), 'foo')
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_debounced_failure_can_be_redelivered(self, mock_publish):
+        mock_publish.side_effect = [SnsError('Unable to publish'), SnsDeferredError('Deferred')]
+        delivery_cache = DeliveryCache(10, 60)
+        self.assertFalse(delivery_cache.seen('delivery:first'))
+        debouncer = DeploymentDebouncer(60)
+        with patch('build_pipeline.helpers.DEPLOYMENT_DEBOUNCER', debouncer):
+            on_failure = partial(delivery_cache.forget, 'delivery:first')
+            self.assertEqual(parse_webhook_payload('deployment', self.payload, on_failure=on_failure), None)
+
+            # The delivery has been answered by the time that the provisioning fails
+            debouncer.flush()
+            self.assertFalse(delivery_cache.seen('delivery:first'))
+
+            # The jobs that the outbox will retry aren't triggered again by a redelivery
+            self.assertEqual(parse_webhook_payload('deployment', self.payload, on_failure=on_failure), None)
+            debouncer.flush()
+            self.assertTrue(delivery_cache.seen('delivery:first'))
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_webhook_payload_indexed(self, mock_publish):
+        mock_publish.side_effect = ['first', 'second', 'third']
+        status = dict(self.payload, deployment_status={'state': 'success'})
+        with patch('build_pipeline.helpers.DEPLOYMENT_INDEX', DeploymentIndex(10)) as index:
+            self.assertEqual(parse_webhook_payload('deployment', self.payload), 'first')
+            self.assertEqual(parse_webhook_payload('deployment_status', status), 'second')
+            # Another success of the same deployment doesn't trigger the job again
+            self.assertEqual(parse_webhook_payload('deployment_status', status), None)
+
+            # Nor does the success of a deployment that a newer one has superseded
+            newer = {'repository': {'full_name': 'org/repo'}, 'deployment': {'id': '1235'}}
+            self.assertEqual(parse_webhook_payload('deployment', newer), 'third')
+            self.assertEqual(parse_webhook_payload('deployment_status', dict(status, deployment={'id': '1233'})), None)
+
+        self.assertEqual(mock_publish.call_count, 3)
+        self.assertEqual(index.get('org/repo', None)['id'], 1235)
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_webhook_payload_through_outbox(self, mock_publish):
+        outbox = Mock()
+        outbox.publish.return_value = 'bar'
+        with patch('build_pipeline.helpers.OUTBOX', outbox):
+            result = parse_webhook_payload('deployment', self.payload)
+        self.assertEqual(result, 'bar')
+        self.assertFalse(mock_publish.called)
+
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_webhook_payload_routed(self, mock_publish):
+        mock_publish.side_effect = ['first', 'second']
+        table = compile_routes([{
+            'repos': ['org/*'], 'event': 'deployment',
+            'targets': [
+                {'topic': 'topic1', 'job': 'job1'},
+                {'topic': 'topic2', 'job': 'job2', 'parameters': {'ref': 'ref'}},
+            ]
+        }])
+        self.payload['deployment']['ref'] = 'master'
+        with patch('build_pipeline.helpers.ROUTING_TABLE', table):
+            result = parse_webhook_payload('deployment', self.payload)
+        self.assertEqual(result, 'first')
+
+        topics = [call[1]['topic_arn'] for call in mock_publish.call_args_list]
+        self.assertEqual(topics, ['topic1', 'topic2'])
+        message = mock_publish.call_args[1]['message']
+        self.assertEqual(message['job'], 'job2')
+        self.assertEqual(message['parameters'], [{'name': 'ref', 'type': 'string', 'value': 'master'}])
+
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_webhook_payload_partial_failure(self, mock_publish):
+        mock_publish.side_effect = lambda topic_arn, message: self._publish_or_fail(topic_arn, SnsError)
+        table = compile_routes([{
+            'repos': ['org/repo'], 'event': 'deployment',
+            'targets': [{'topic': 'ok', 'job': 'job1'}, {'topic': 'failing', 'job': 'job2'}]
+        }])
+        with patch('build_pipeline.helpers.ROUTING_TABLE', table), \
+                patch('build_pipeline.helpers.FANOUT', FanOut(2)) as fanout:
+            self.addCleanup(fanout.shutdown)
+            with self.assertRaises(SnsError) as context:
+                parse_webhook_payload('deployment', self.payload)
+
+        self.assertNotIsInstance(context.exception, SnsDeferredError)
+        self.assertIn('Triggered 1 of 2 jobs', str(context.exception))
+        self.assertEqual(
+            [(result.key.topic, result.value) for result in context.exception.results],
+            [('ok', 'msg-ok'), ('failing', None)]
+        )
+
+        # When the failed messages are in the outbox, they will still get published
+        mock_publish.side_effect = lambda topic_arn, message: self._publish_or_fail(topic_arn, SnsDeferredError)
+        with patch('build_pipeline.helpers.ROUTING_TABLE', table):
+            self.assertRaises(SnsDeferredError, parse_webhook_payload, 'deployment', self.payload)
+
+    @patch('build_pipeline.helpers._TRIGGERED', OrderedDict())
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_redelivery_after_partial_failure(self, mock_publish):
+        mock_publish.side_effect = lambda topic_arn, message: self._publish_or_fail(topic_arn, SnsError)
+        table = compile_routes([{
+            'repos': ['org/repo'], 'event': 'deployment',
+            'targets': [{'topic': 'ok', 'job': 'job1'}, {'topic': 'failing', 'job': 'job2'}]
+        }])
+        payload = dict(self.payload, trace=new_trace('first', self.payload, time.time()))
+        with patch('build_pipeline.helpers.ROUTING_TABLE', table), \
+                patch('build_pipeline.helpers.FANOUT', FanOut(2)) as fanout:
+            self.addCleanup(fanout.shutdown)
+            self.assertRaises(SnsError, parse_webhook_payload, 'deployment', payload)
+
+            # The redelivery only triggers the job that failed
+            mock_publish.reset_mock()
+            mock_publish.side_effect = lambda topic_arn, message: 'msg-' + topic_arn
+            self.assertEqual(parse_webhook_payload('deployment', payload), 'msg-failing')
+            self.assertEqual([call[1]['topic_arn'] for call in mock_publish.call_args_list], ['failing'])
+
+            # Nothing is left to trigger for that delivery, unlike for another one
+            mock_publish.reset_mock()
+            self.assertIsNone(parse_webhook_payload('deployment', payload))
+            self.assertFalse(mock_publish.called)
+            other = dict(self.payload, trace=new_trace('second', self.payload, time.time()))
+            self.assertEqual(parse_webhook_payload('deployment', other), 'msg-ok')
+            self.assertEqual(mock_publish.call_count, 2)
+
+    @patch('build_pipeline.fanout.FANOUT_DEADLINE', 0.1)
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_slow_publish_then_redelivery(self, mock_publish):
+        table = compile_routes([{
+            'repos': ['org/repo'], 'event': 'deployment',
+            'targets': [{'topic': 'fast', 'job': 'job1'}, {'topic': 'slow', 'job': 'job2'}]
+        }])
+        delivery_cache = DeliveryCache(10, 60)
+        on_failure = partial(delivery_cache.forget, 'delivery:first')
+        for slow_outcome, redelivered in (('msg-slow', False), (SnsError('failed'), True)):
+            release = threading.Event()
+            mock_publish.side_effect = partial(self._publish_slowly, release, slow_outcome)
+            self.assertFalse(delivery_cache.seen('delivery:first'))
+            with patch('build_pipeline.helpers.ROUTING_TABLE', table), \
+                    patch('build_pipeline.helpers.FANOUT', FanOut(2)) as fanout:
+                self.addCleanup(fanout.shutdown)
+                # The slow job has not failed yet, so it isn't reported as a failure
+                with self.assertRaises(SnsDeferredError):
+                    parse_webhook_payload('deployment', self.payload, on_failure=on_failure)
+                self.assertTrue(delivery_cache.seen('delivery:first'))
+
+                # A redelivery is let through only once publishing has failed in the end
+                release.set()
+                fanout.shutdown()
+            self.assertEqual(delivery_cache.seen('delivery:first'), not redelivered)
+            delivery_cache.forget('delivery:first')
+
+    @staticmethod
+    def _publish_slowly(release, slow_outcome, topic_arn, message):  # pylint: disable=unused-argument
+        """ Stands in for publishing, which takes until released for the topic called slow. """
+        if topic_arn != 'slow':
+            return 'msg-' + topic_arn
+        release.wait()
+        if isinstance(slow_outcome, Exception):
+            raise slow_outcome
+        return slow_outcome
+
+    @staticmethod
+    def _publish_or_fail(topic_arn, error_class):
+        """ Stands in for publishing, failing for the topic called failing. """
+        if topic_arn == 'failing':
+            raise error_class('failed')
+        return 'msg-' + topic_arn
+
     @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
     def test_webhook_payload_unhandled_event(self):
         result = parse_webhook_payload('foo', self.payload)
@@ -89,6 +384,43 @@ class ParsePayloadTestCase(TestCase):
         self.assertEqual(result, None)
 
 
+class PayloadFilterTestCase(TestCase):
+    """TestCase class for verifying the filtering of payloads before they are decoded."""
+    def test_handled_events(self):
+        self.assertTrue(is_handled_event('deployment'))
+        self.assertTrue(is_handled_event('deployment_status'))
+        self.assertFalse(is_handled_event('push'))
+        self.assertFalse(is_handled_event(None))
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'org/repo')
+    def test_handled_repo(self):
+        self.assertTrue(may_concern_handled_repo('{"repository": {"full_name": "org/repo"}}'))
+        self.assertTrue(may_concern_handled_repo('{"repository": {"full_name": "org\\/repo"}}'))
+        self.assertFalse(may_concern_handled_repo('{"repository": {"full_name": "org/repo2"}}'))
+        self.assertFalse(may_concern_handled_repo('{"repository": {"full_name": "org/other"}}'))
+
+    def test_extract_fields(self):
+        data = {
+            'repository': {'full_name': 'org/repo', 'owner': {'login': 'org'}},
+            'deployment': {'id': 1, 'sha': 'abc', 'task': 'deploy', 'environment': 'sandbox', 'payload': {}},
+            'deployment_status': {'state': 'success', 'creator': {}},
+            'sender': {'login': 'someone'},
+        }
+        self.assertEqual(extract_webhook_fields(data), {
+            'repository': {'full_name': 'org/repo'},
+            'deployment': {'id': 1, 'sha': 'abc', 'task': 'deploy', 'environment': 'sandbox'},
+            'deployment_status': {'state': 'success'},
+        })
+
+        # Along with the fields that the routes set job parameters from
+        table = compile_routes([{
+            'repos': ['org/repo'], 'event': 'deployment',
+            'targets': [{'topic': 'topic', 'job': 'job', 'parameters': {'payload': 'payload'}}]
+        }])
+        with patch('build_pipeline.helpers.ROUTING_TABLE', table):
+            self.assertEqual(extract_webhook_fields(data)['deployment']['payload'], {})
+
+
 class GitHubEventTestCase(TestCase):
     """TestCase class for verifying GitHub events."""
     def test_no_signature(self):
@@ -121,3 +453,62 @@ class GitHubEventTestCase(TestCase):
         my_hash = hmac.new('my_token', msg=contents, digestmod=hashlib.sha1).hexdigest()
         result = is_valid_gh_event('sha1={}'.format(my_hash), 'my_event', contents, data)
         self.assertTrue(result)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_good_sha256_signature(self):
+        data = {'repository': {'full_name': 'hello'}}
+        contents = json.dumps(data)
+        result = is_valid_gh_event(sign_payload(contents, 'my_token', 'sha256'), 'my_event', contents, data)
+        self.assertTrue(result)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'new_token')
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKENS', ['old_token'])
+    def test_rotated_secrets(self):
+        data = {'repository': {'full_name': 'hello'}}
+        contents = json.dumps(data)
+        for secret in ('old_token', 'new_token'):
+            self.assertTrue(is_valid_gh_event(sign_payload(contents, secret), 'my_event', contents, data))
+        self.assertFalse(is_valid_gh_event(sign_payload(contents, 'other_token'), 'my_event', contents, data))
+
+
+@patch('build_pipeline.helpers.PAYLOAD_CHUNK_SIZE', 4)
+class ReadPayloadTestCase(TestCase):
+    """TestCase class for verifying the streaming of webhook payloads."""
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_signed_in_chunks(self):
+        contents = '{"repository": {"full_name": "hello"}}'
+        verifier = SignatureVerifier(sign_payload(contents, 'my_token', 'sha256'))
+        self.assertEqual(read_payload(StringIO(contents + 'trailing'), len(contents), verifier), contents)
+        self.assertTrue(verifier.verify())
+
+    def test_too_large(self):
+        stream = StringIO('0123456789')
+        self.assertRaises(PayloadTooLargeError, read_payload, stream, 10, max_size=9)
+        self.assertEqual(stream.tell(), 0)
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, read_payload, StringIO('0123'), 10)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_chunked(self):
+        contents = '{"repository": {"full_name": "hello"}}'
+        verifier = SignatureVerifier(sign_payload(contents, 'my_token', 'sha256'))
+        stream = StringIO('a;name=value\r\n{}\r\n{:x}\r\n{}\r\n0\r\nX-Trailer: 1\r\n\r\nnext'.format(
+            contents[:10], len(contents) - 10, contents[10:]
+        ))
+        self.assertEqual(read_chunked_payload(stream, verifier), contents)
+        self.assertTrue(verifier.verify())
+        self.assertEqual(stream.read(), 'next')
+
+    def test_chunked_too_large(self):
+        stream = StringIO('5\r\n01234\r\n5\r\n56789\r\n0\r\n\r\n')
+        self.assertRaises(PayloadTooLargeError, read_chunked_payload, stream, max_size=9)
+
+    def test_chunked_malformed(self):
+        self.assertRaises(ValueError, read_chunked_payload, StringIO('zz\r\n'))
+        self.assertRaises(ValueError, read_chunked_payload, StringIO('5\r\n0123'))
+        self.assertRaises(ValueError, read_chunked_payload, StringIO('2\r\n0123\r\n0\r\n\r\n'))
+
+    def test_unsupported_signature(self):
+        self.assertRaises(ValueError, SignatureVerifier, 'md5=abc')
+        self.assertRaises(ValueError, SignatureVerifier, 'sha1')
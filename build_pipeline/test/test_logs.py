@@ -0,0 +1,125 @@
+"""
+Tests for the logging setup
+"""
+from cStringIO import StringIO
+import logging
+from Queue import Queue
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from ..logs import QueueHandler, QueueListener, Truncated, configure_logging, log_payload, parse_levels
+from ..metrics import LOG_RECORDS_DROPPED
+
+
+class LogsTestCase(TestCase):
+    """TestCase class for verifying the logging setup."""
+
+    def setUp(self):
+        super(LogsTestCase, self).setUp()
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, 'handlers', list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        self.logger = logging.getLogger('build_pipeline.test_logs')
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+    def test_truncated(self):
+        self.assertEqual(str(Truncated('x' * 10, 20)), 'x' * 10)
+        self.assertEqual(str(Truncated('x' * 30, 20)), 'x' * 20 + '... (10 more characters)')
+        self.assertEqual(str(Truncated({'id': 1})), "{'id': 1}")
+
+    def test_log_payload(self):
+        logger = Mock()
+        logger.isEnabledFor.return_value = False
+        log_payload(logger, 'Deployment', {'id': 1})
+        self.assertFalse(logger.debug.called)
+
+        logger.isEnabledFor.return_value = True
+        with patch('build_pipeline.logs.random.random', return_value=0.5):
+            log_payload(logger, 'Deployment', {'id': 1}, sample_rate=0.1)
+            self.assertFalse(logger.debug.called)
+            log_payload(logger, 'Deployment', {'id': 1}, sample_rate=0.9)
+        self.assertEqual(str(logger.debug.call_args[0][2]), "{'id': 1}")
+
+    def test_parse_levels(self):
+        self.assertEqual(
+            parse_levels('build_pipeline.helpers=debug, boto=INFO,'),
+            [('build_pipeline.helpers', logging.DEBUG), ('boto', logging.INFO)]
+        )
+        self.assertRaises(ValueError, parse_levels, 'boto=LOUD')
+
+    def test_queue_listener(self):
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+        listener = QueueListener(Queue(), handler)
+        listener.start()
+
+        self.logger.addHandler(QueueHandler(listener.queue))
+        self.addCleanup(setattr, self.logger, 'handlers', [])
+        self.logger.setLevel(logging.DEBUG)
+        payload = {'id': 1}
+        self.logger.info('Deployment %s', payload)
+        # The message is taken before the payload changes
+        payload['id'] = 2
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('Failed')
+        listener.stop()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[:2], ["INFO:Deployment {'id': 1}", 'ERROR:Failed'])
+        self.assertIn('ValueError: boom', lines[-1])
+
+    def test_formatted_by_listener(self):
+        queue = Queue()
+        self.logger.addHandler(QueueHandler(queue))
+        self.addCleanup(setattr, self.logger, 'handlers', [])
+        payload = {'id': 1}
+        self.logger.warning('Deployment %s of %s in %.1fs', 1234, u'org/repo', 0.25)
+        self.logger.warning('Deployment %r, %-8s!', payload, payload)
+        self.logger.warning('Deployment %(id)s of %(repo)s', {'id': 1234, 'repo': 'org/repo'})
+        self.logger.warning('Deployment %s', payload)
+        self.logger.warning('Deployment %*d', 6, 1234)
+        self.logger.warning(payload)
+        payload['id'] = 2
+
+        records = [queue.get_nowait() for _ in range(queue.qsize())]
+        # Plain values are left for the listener to format
+        self.assertEqual(records[0].args, (1234, u'org/repo', 0.25))
+        self.assertEqual(records[2].args, {'id': 1234, 'repo': 'org/repo'})
+        self.assertEqual([record.getMessage() for record in records], [
+            'Deployment 1234 of org/repo in 0.2s',
+            "Deployment {'id': 1}, {'id': 1}!",
+            'Deployment 1234 of org/repo',
+            "Deployment {'id': 1}",
+            'Deployment   1234',
+            "{'id': 1}",
+        ])
+
+    def test_full_queue(self):
+        dropped = LOG_RECORDS_DROPPED.value()
+        handler = QueueHandler(Queue(maxsize=1))
+        self.logger.addHandler(handler)
+        self.addCleanup(setattr, self.logger, 'handlers', [])
+        self.logger.warning('one')
+        self.logger.warning('two')
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(LOG_RECORDS_DROPPED.value(), dropped + 1)
+
+    def test_configure_logging(self):
+        stream = StringIO()
+        listener = configure_logging(stream, level='info', levels='build_pipeline.test_logs=WARNING')
+        self.logger.info('hidden')
+        self.logger.warning('shown')
+        logging.getLogger('build_pipeline.other').info('also shown')
+        logging.getLogger('boto').warning('library noise')
+        listener.stop()
+
+        self.assertEqual(
+            stream.getvalue().splitlines(),
+            ['WARNING:build_pipeline.test_logs:shown', 'INFO:build_pipeline.other:also shown']
+        )
+        self.assertIsNone(configure_logging(stream, asynchronous=False))
+        self.assertIsInstance(logging.getLogger().handlers[0], logging.StreamHandler)
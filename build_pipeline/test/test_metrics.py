@@ -0,0 +1,55 @@
+"""
+Tests for the metrics
+"""
+from unittest import TestCase
+
+from ..metrics import Counter, Gauge, Histogram, Registry
+
+
+class MetricsTestCase(TestCase):
+    """TestCase class for verifying the Prometheus text format of the metrics."""
+
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.register(Counter('requests_total', 'Requests.', ('event', 'outcome')))
+        counter.inc('deployment', 'published')
+        counter.inc('deployment', 'published')
+        counter.inc('other', 'ignored', amount=5)
+        self.assertEqual(counter.value('deployment', 'published'), 2)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{event="deployment",outcome="published"} 2',
+            'requests_total{event="other",outcome="ignored"} 5',
+        ]) + '\n')
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ('stage',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'read')
+        self.assertEqual(list(histogram.samples()), [
+            'latency_seconds_bucket{stage="read",le="0.1"} 2',
+            'latency_seconds_bucket{stage="read",le="1"} 3',
+            'latency_seconds_bucket{stage="read",le="+Inf"} 4',
+            'latency_seconds_sum{stage="read"} 3.65',
+            'latency_seconds_count{stage="read"} 4',
+        ])
+
+    def test_timer(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ('stage',))
+        with histogram.time('decode'):
+            pass
+        self.assertEqual(histogram.count('decode'), 1)
+
+    def test_gauge(self):
+        gauge = Gauge('queue_depth', 'Depth.', ('queue',))
+        gauge.set(5, 'dispatch')
+        gauge.inc('dispatch')
+        gauge.dec('dispatch', amount=3)
+        self.assertEqual(gauge.value('dispatch'), 3)
+        self.assertEqual(list(gauge.samples()), ['queue_depth{queue="dispatch"} 3'])
+
+    def test_label_escaping(self):
+        counter = Counter('requests_total', 'Requests.', ('event',))
+        counter.inc('a"b\\c')
+        self.assertEqual(list(counter.samples()), ['requests_total{event="a\\"b\\\\c"} 1'])
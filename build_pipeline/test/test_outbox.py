@@ -0,0 +1,169 @@
+"""
+Tests for the durable outbox of SNS messages
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from ..helpers import SnsError
+from ..metrics import OUTBOX_DEAD
+from ..outbox import DeadMessageError, Outbox, SnsDeferredError, retry_delay
+
+
+class OutboxTestCase(TestCase):
+    """TestCase class for verifying the outbox."""
+
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'outbox.db')
+        self.publish = Mock(return_value='msg_id')
+        self.outbox = Outbox(self.path, publish=self.publish)
+
+    def test_published_right_away(self):
+        self.assertEqual(self.outbox.publish('arn', {'job': 'foo'}), 'msg_id')
+        self.publish.assert_called_once_with(topic_arn='arn', message={'job': 'foo'})
+        self.assertEqual(self.outbox.pending_count(), 0)
+
+    @patch('build_pipeline.outbox.retry_delay', return_value=10)
+    def test_failed_message_is_retried(self, _mock_delay):
+        self.publish.side_effect = SnsError('boom')
+        self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'foo'})
+        self.assertEqual(self.outbox.pending_count(), 1)
+
+        # Not due yet
+        self.publish.side_effect = None
+        self.assertEqual(self.outbox.drain_once(), 0)
+
+        # The message survives a restart of the service
+        outbox = Outbox(self.path, publish=self.publish)
+        self.assertEqual(outbox.drain_once(now=9999999999), 1)
+        self.assertEqual(outbox.pending_count(), 0)
+        self.publish.assert_called_with(topic_arn='arn', message={'job': 'foo'})
+
+    @patch('build_pipeline.outbox.retry_delay', return_value=10)
+    def test_drained_in_bulk_after_recovery(self, _mock_delay):
+        self.publish.side_effect = SnsError('boom')
+        for _ in range(3):
+            self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'foo'})
+        self.publish.side_effect = None
+
+        with patch('build_pipeline.outbox.OUTBOX_BATCH_SIZE', 1):
+            # Only the first message is due, the others are released once it goes through
+            self.assertEqual(self.outbox.drain_once(now=self._due_at(1)), 1)
+            self.assertEqual(self.outbox.drain_once(now=self._due_at(1)), 1)
+            self.assertEqual(self.outbox.drain_once(now=self._due_at(1)), 1)
+        self.assertEqual(self.outbox.pending_count(), 0)
+
+    def test_drain_stops_while_sns_is_down(self):
+        self.publish.side_effect = SnsError('boom')
+        for _ in range(3):
+            self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'foo'})
+        self.publish.reset_mock()
+        self.assertEqual(self.outbox.drain_once(now=9999999999), 0)
+        self.assertEqual(self.publish.call_count, 1)
+
+    @patch('build_pipeline.outbox.retry_delay', return_value=10)
+    def test_unexpected_error_is_retried(self, _mock_delay):
+        self.publish.side_effect = [ValueError('boom'), TypeError('boom'), 'msg_id']
+        self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'foo'})
+
+        # The lease was released, so the message is retried after its backoff
+        self.assertEqual(self.outbox.drain_once(now=self._due_at(1)), 0)
+        self.assertEqual(self.outbox.drain_once(now=self._due_at(1)), 1)
+        self.assertEqual(self.outbox.pending_count(), 0)
+
+    @patch('build_pipeline.outbox.OUTBOX_MAX_ATTEMPTS', 2)
+    @patch('build_pipeline.outbox.retry_delay', return_value=10)
+    def test_given_up_after_max_attempts(self, _mock_delay):
+        dead = OUTBOX_DEAD.value()
+        self.publish.side_effect = [SnsError('boom'), SnsError('boom'), SnsError('boom'), ValueError('boom')]
+        self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'foo'})
+        self.assertRaises(SnsDeferredError, self.outbox.publish, 'arn', {'job': 'bar'})
+
+        # SNS is still down, so the drain stops after giving up on the first message
+        self.assertEqual(self.outbox.drain_once(now=9999999999), 0)
+        self.assertEqual(self.outbox.pending_count(), 1)
+
+        # Errors other than SnsError count towards the attempts as well
+        self.assertEqual(self.outbox.drain_once(now=9999999999), 0)
+        self.assertEqual(self.outbox.pending_count(), 0)
+        self.assertEqual(self.outbox.dead_count(), 2)
+        self.assertEqual(OUTBOX_DEAD.value(), dead + 2)
+
+        # Dead messages are not retried
+        self.publish.reset_mock()
+        self.assertEqual(self.outbox.drain_once(now=9999999999), 0)
+        self.assertFalse(self.publish.called)
+
+    @patch('build_pipeline.outbox.OUTBOX_MAX_ATTEMPTS', 1)
+    def test_given_up_right_away(self):
+        self.publish.side_effect = SnsError('boom')
+        self.assertRaises(DeadMessageError, self.outbox.publish, 'arn', {'job': 'foo'})
+        self.assertEqual(self.outbox.dead_count(), 1)
+
+    def test_outbox_without_dead_column(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('DROP TABLE outbox')
+        conn.execute(
+            'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, outbox_id TEXT NOT NULL UNIQUE, '
+            'topic_arn TEXT NOT NULL, message TEXT NOT NULL, created_at REAL NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, last_error TEXT, '
+            'sns_message_id TEXT, published_at REAL)'
+        )
+        conn.commit()
+        conn.close()
+        outbox = Outbox(self.path, publish=self.publish)
+        self.assertEqual(outbox.publish('arn', {'job': 'foo'}), 'msg_id')
+        self.assertEqual(outbox.dead_count(), 0)
+
+    @patch('build_pipeline.outbox.retry_delay', return_value=10)
+    def test_shared_database(self, _mock_delay):
+        failing = Outbox(self.path, publish=Mock(side_effect=SnsError('boom')))
+        for job in ('first', 'second'):
+            self.assertRaises(SnsDeferredError, failing.publish, 'arn', {'job': job})
+
+        # Another drainer runs while this one is publishing the first message,
+        # after both have selected the same due messages
+        other_publish = Mock(return_value='other_msg_id')
+        other = Outbox(self.path, publish=other_publish)
+        self.publish.side_effect = lambda topic_arn, message: other.drain_once(now=9999999999) and 'msg_id'
+        self.assertEqual(self.outbox.drain_once(now=9999999999), 1)
+
+        # Each message is published once, by the drainer that claimed it
+        self.publish.assert_called_once_with(topic_arn='arn', message={'job': 'first'})
+        other_publish.assert_called_once_with(topic_arn='arn', message={'job': 'second'})
+        self.assertEqual(self.outbox.pending_count(), 0)
+
+    def test_drainer_left_to_another_process(self):
+        with patch('build_pipeline.outbox.OUTBOX_PATH', self.path):
+            outbox = Outbox.from_env(drain=False)
+        self.assertIsNone(outbox._drainer)  # pylint: disable=protected-access
+
+    def test_prune(self):
+        self.outbox.publish('arn', {'job': 'foo'})
+        self.outbox.prune(now=9999999999)
+        count = self.outbox._connection().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]  # pylint: disable=protected-access
+        self.assertEqual(count, 0)
+
+    def _due_at(self, row_id):
+        """ When the message with the row id is due to be retried. """
+        return self.outbox._connection().execute(  # pylint: disable=protected-access
+            'SELECT next_attempt_at FROM outbox WHERE id = ?', (row_id,)
+        ).fetchone()[0]
+
+
+class RetryDelayTestCase(TestCase):
+    """TestCase class for verifying the backoff between retries."""
+
+    def test_exponential_backoff(self):
+        for attempts, limit in ((1, 1), (2, 2), (3, 4), (10, 60)):
+            for _ in range(20):
+                delay = retry_delay(attempts, base=1, maximum=60)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, limit)
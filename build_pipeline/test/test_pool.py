@@ -0,0 +1,81 @@
+"""
+Tests for the worker pool
+"""
+import threading
+from unittest import TestCase
+
+from ..pool import WorkerPool, PoolFullError
+
+
+class WorkerPoolTestCase(TestCase):
+    """TestCase class for verifying the bounded worker pool."""
+
+    def test_runs_submitted_work(self):
+        results = []
+        pool = WorkerPool(2)
+        for value in range(10):
+            pool.submit(results.append, (value,))
+        pool.shutdown(wait=True)
+        self.assertEqual(sorted(results), range(10))
+
+    def test_full_queue(self):
+        release = threading.Event()
+        pool = WorkerPool(1, queue_size=1)
+        self.addCleanup(pool.shutdown)
+        self.addCleanup(release.set)
+
+        started = threading.Event()
+
+        def block():
+            """ Keep the only worker busy. """
+            started.set()
+            release.wait()
+
+        pool.submit(block)
+        started.wait()
+        pool.submit(block)
+        self.assertRaises(PoolFullError, pool.submit, block, block=False)
+
+    def test_evict_oldest(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        started = threading.Event()
+        results = []
+
+        def block():
+            """ Keep the only worker busy. """
+            started.set()
+            release.wait()
+
+        pool = WorkerPool(1)
+        pool.submit(block)
+        started.wait()
+        pool.submit(results.append, ('first',))
+        pool.submit(results.append, ('second',))
+        self.assertEqual(pool.evict_oldest(), (results.append, ('first',)))
+
+        # The stop marker of the shutdown is left for the worker
+        self.assertFalse(pool.shutdown(wait=False))
+        self.assertEqual(pool.evict_oldest(), (results.append, ('second',)))
+        self.assertIsNone(pool.evict_oldest())
+        release.set()
+        worker = pool._threads[0]  # pylint: disable=protected-access
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(results, [])
+
+    def test_submit_after_shutdown(self):
+        pool = WorkerPool(1)
+        pool.shutdown()
+        self.assertRaises(RuntimeError, pool.submit, len, ('abc',))
+
+    def test_errors_do_not_kill_workers(self):
+        results = []
+        pool = WorkerPool(1)
+        pool.submit(int, ('not a number',))
+        pool.submit(results.append, (1,))
+        pool.shutdown(wait=True)
+        self.assertEqual(results, [1])
+
+    def test_needs_a_thread(self):
+        self.assertRaises(ValueError, WorkerPool, 0)
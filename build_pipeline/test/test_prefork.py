@@ -0,0 +1,93 @@
+"""
+Tests for the pre-fork mode
+"""
+import os
+import signal
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from ..prefork import Supervisor, worker_count
+
+
+def _serve_forever(_worker):
+    """ Stands in for a worker that serves until SIGTERM. """
+    while True:
+        time.sleep(1)
+
+
+def _ignore_sigterm(worker):
+    """ Stands in for a worker that doesn't stop when asked to. """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _serve_forever(worker)
+
+
+def _is_running(pid):
+    """ Whether a process exists. """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class WorkerCountTestCase(TestCase):
+    """TestCase class for verifying the number of worker processes."""
+
+    @patch('build_pipeline.prefork.WEB_CONCURRENCY', None)
+    @patch('build_pipeline.prefork.multiprocessing.cpu_count')
+    def test_cpu_count(self, mock_cpu_count):
+        mock_cpu_count.return_value = 4
+        self.assertEqual(worker_count(), 4)
+
+    @patch('build_pipeline.prefork.WEB_CONCURRENCY', '3')
+    def test_web_concurrency(self):
+        self.assertEqual(worker_count(), 3)
+
+
+@patch('build_pipeline.prefork.PREFORK_RESTART_DELAY', 0)
+class SupervisorTestCase(TestCase):
+    """TestCase class for verifying the supervision of the worker processes."""
+
+    def _start(self, target, workers=2, stop_timeout=5):
+        """ Start a supervisor that gets stopped after the test. """
+        supervisor = Supervisor(workers, target, stop_timeout)
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+        return supervisor
+
+    def test_restart_crashed_worker(self):
+        supervisor = self._start(_serve_forever)
+        self.assertEqual(len(supervisor.children), 2)
+
+        crashed = list(supervisor.children)[0]
+        number = supervisor.children[crashed][0]
+        os.kill(crashed, signal.SIGKILL)
+        self.assertEqual(supervisor.reap(), crashed)
+        self.assertEqual(supervisor.restarts, 1)
+        self.assertEqual(len(supervisor.children), 2)
+        self.assertNotIn(crashed, supervisor.children)
+
+        # The restarted worker takes over the number of the one that crashed
+        self.assertEqual(sorted(number for number, _ in supervisor.children.values()), [0, 1])
+        self.assertIn(number, [number for number, _ in supervisor.children.values()])
+
+    def test_stop(self):
+        supervisor = self._start(_serve_forever)
+        pids = list(supervisor.children)
+        self.assertTrue(supervisor.stop())
+        self.assertEqual(supervisor.children, {})
+        self.assertFalse(any(_is_running(pid) for pid in pids))
+
+        # Workers that exit while stopping are not restarted
+        self.assertIsNone(supervisor.reap(block=False))
+        self.assertEqual(supervisor.restarts, 0)
+
+    def test_kill_after_timeout(self):
+        supervisor = self._start(_ignore_sigterm, workers=1, stop_timeout=0.5)
+        # Give the worker time to ignore SIGTERM
+        time.sleep(0.2)
+        pid = list(supervisor.children)[0]
+        self.assertFalse(supervisor.stop())
+        self.assertFalse(_is_running(pid))
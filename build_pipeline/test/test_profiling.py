@@ -0,0 +1,168 @@
+"""
+Tests for the profiling of the webhook requests
+"""
+from BaseHTTPServer import HTTPServer
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch
+import requests
+
+from ..build_pipeline import PipelineHttpRequestHandler
+from ..helpers import parse_webhook_payload
+from ..profiling import RequestProfiler, PROFILE_SUFFIX, SUMMARY_SUFFIX
+
+
+def _handle(body):
+    """ Stand-in for handling a delivery, through one of the functions that the summaries single out. """
+    data = json.loads(body)
+    parse_webhook_payload('push', data)
+    return data
+
+
+class RequestProfilerTestCase(TestCase):
+    """TestCase class for verifying the sampling, aggregation and rotation of the profiles."""
+
+    def setUp(self):
+        super(RequestProfilerTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def files(self, suffix=PROFILE_SUFFIX):
+        """ The names of the profiles written, or of their summaries. """
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    @patch('build_pipeline.profiling.PROFILE_DIR', None)
+    def test_off_by_default(self):
+        self.assertIsNone(RequestProfiler.from_env())
+
+    def test_sampling(self):
+        profiler = RequestProfiler(self.directory, sample_rate=3)
+        self.assertEqual([profiler.sample() for _ in range(6)], [False, False, True, False, False, True])
+
+        # Not sampling at all
+        profiler = RequestProfiler(self.directory)
+        self.assertFalse(any(profiler.sample() for _ in range(10)))
+
+    def test_requested(self):
+        profiler = RequestProfiler(self.directory, sample_rate=100)
+        profiler.request(2)
+        self.assertEqual([profiler.sample() for _ in range(3)], [True, True, False])
+
+    def test_batch(self):
+        profiler = RequestProfiler(self.directory, batch=2)
+        self.assertEqual(profiler.run(_handle, '{"action": "created"}'), {'action': 'created'})
+        self.assertEqual(self.files(), [])
+
+        profiler.run(_handle, '{}')
+        profiler.wait()
+        self.assertEqual(len(self.files()), 1)
+        self.assertEqual(len(self.files(SUMMARY_SUFFIX)), 1)
+        stats = pstats.Stats(os.path.join(self.directory, self.files()[0]))
+        calls = dict(
+            (function, stat[1]) for (_, _, function), stat in stats.stats.items()  # pylint: disable=no-member
+        )
+        self.assertEqual(calls['parse_webhook_payload'], 2)
+
+        with open(os.path.join(self.directory, self.files(SUMMARY_SUFFIX)[0])) as summary_file:
+            summary = summary_file.read()
+        self.assertIn('Profile of 2 requests', summary)
+        self.assertIn('(parse_webhook_payload)', summary)
+
+    def test_flush(self):
+        profiler = RequestProfiler(self.directory, batch=10)
+        self.assertIsNone(profiler.flush())
+        profiler.run(_handle, '{}')
+        self.assertTrue(profiler.flush().endswith(PROFILE_SUFFIX))
+        self.assertEqual(profiler.written, 1)
+
+    def test_written_in_background(self):
+        profiler = RequestProfiler(self.directory, batch=1)
+        writers = []
+        write = profiler._write  # pylint: disable=protected-access
+
+        def _record_writer(*batch):
+            """ Note the thread writing the profile. """
+            writers.append(threading.current_thread())
+            return write(*batch)
+
+        with patch.object(profiler, '_write', side_effect=_record_writer):
+            profiler.run(_handle, '{}')
+            profiler.wait()
+        self.assertEqual(len(writers), 1)
+        self.assertNotEqual(writers[0], threading.current_thread())
+        self.assertEqual(len(self.files()), 1)
+
+    def test_error_is_profiled(self):
+        profiler = RequestProfiler(self.directory, batch=1)
+        with self.assertRaises(ValueError):
+            profiler.run(_handle, 'not json')
+        profiler.wait()
+        self.assertEqual(len(self.files()), 1)
+
+    def test_rotation(self):
+        profiler = RequestProfiler(self.directory, batch=1, max_files=2)
+        for _ in range(4):
+            profiler.run(_handle, '{}')
+        profiler.wait()
+        self.assertEqual(profiler.written, 4)
+        profiles = self.files()
+        self.assertEqual(len(profiles), 2)
+        # The newest profiles are kept, along with their summaries
+        self.assertTrue(profiles[-1].endswith('-0004' + PROFILE_SUFFIX))
+        self.assertEqual(len(self.files(SUMMARY_SUFFIX)), 2)
+
+
+class ProfileEndpointTestCase(TestCase):
+    """TestCase class for verifying that the profiling of requests can be asked for."""
+
+    def setUp(self):
+        super(ProfileEndpointTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = HTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        self.server.profiler = RequestProfiler(self.directory, batch=1)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}/profile".format(port=self.server.server_address[1])
+
+    @patch('build_pipeline.build_pipeline.PROFILE_TOKEN', None)
+    def test_without_token(self):
+        response = requests.post(self.url, headers={'Authorization': 'Bearer '})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.server.profiler.remaining, 0)
+
+    @patch('build_pipeline.build_pipeline.PROFILE_TOKEN', 'secret')
+    def test_wrong_token(self):
+        response = requests.post(self.url + '?requests=5', headers={'Authorization': 'Bearer guess'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.server.profiler.remaining, 0)
+
+    @patch('build_pipeline.build_pipeline.PROFILE_TOKEN', 'secret')
+    def test_bad_count(self):
+        response = requests.post(self.url + '?requests=none', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 400)
+
+    @patch('build_pipeline.build_pipeline.PROFILE_TOKEN', 'secret')
+    def test_profile_requests(self):
+        response = requests.post(self.url + '?requests=1', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['requests'], 1)
+        self.assertEqual(self.server.profiler.remaining, 1)
+
+        # The next delivery is profiled
+        response = requests.post(
+            self.url.replace('/profile', '/'), data='{}', headers={'X-GitHub-Event': 'push'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.profiler.remaining, 0)
+        self.server.profiler.wait()
+        self.assertEqual(self.server.profiler.written, 1)
@@ -0,0 +1,106 @@
+"""
+Tests for the replay of recorded webhook deliveries
+"""
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from ..benchmark import make_requests
+from ..helpers import SnsError
+from ..replay import Replayer, main, parse_time, read_deliveries
+
+
+class ReplayTestCase(TestCase):
+    """TestCase class for verifying the replay of deliveries."""
+
+    def setUp(self):
+        super(ReplayTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.deliveries = [
+            {'headers': headers, 'body': body, 'received_at': 1443700000 + index}
+            for index, (_event, headers, body) in enumerate(make_requests(40, {'deployment': 1, 'push': 1}, seed=5))
+        ]
+        self.archive = self.write_archive('deliveries.jsonl', self.deliveries)
+
+    def write_archive(self, name, deliveries, extra_lines=()):
+        """ Write deliveries to an archive in the temporary directory. """
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as archive:
+            for delivery in deliveries:
+                archive.write(json.dumps(delivery) + '\n')
+            for line in extra_lines:
+                archive.write(line + '\n')
+        return path
+
+    def count_events(self, event):
+        """ The number of deliveries of an event in the archive. """
+        return len([delivery for delivery in self.deliveries if delivery['headers']['X-GitHub-Event'] == event])
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time(1443700000), 1443700000)
+        self.assertEqual(parse_time('1443700000.5'), 1443700000.5)
+        self.assertEqual(parse_time('2015-10-01T12:00:00Z'), 1443700800)
+        self.assertEqual(parse_time('2015-10-01'), 1443657600)
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+
+    @patch('build_pipeline.helpers.publish_sns_messsage', return_value='msg_id')
+    def test_replay(self, mock_publish):
+        counts = Replayer().run(read_deliveries([self.archive]), workers=4)
+        self.assertEqual(sum(counts.values()), 40)
+        self.assertEqual(counts['ignored'] + counts['triggered'], 40)
+        self.assertGreater(counts['triggered'], 0)
+        self.assertEqual(mock_publish.call_count, counts['triggered'])
+
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    def test_dry_run(self, mock_publish):
+        replayer = Replayer(dry_run=True)
+        counts = replayer.run(read_deliveries([self.archive]))
+        self.assertFalse(mock_publish.called)
+        self.assertEqual(counts['would_trigger'], replayer.jobs)
+        self.assertEqual(counts['ignored'] + counts['would_trigger'], 40)
+
+    def test_filters(self):
+        counts = Replayer(events=['push'], dry_run=True).run(read_deliveries([self.archive]))
+        self.assertEqual(counts['filtered'], self.count_events('deployment'))
+        self.assertEqual(counts['ignored'], self.count_events('push'))
+
+        counts = Replayer(since=1443700010, until=1443700020, dry_run=True).run(read_deliveries([self.archive]))
+        self.assertEqual(counts['filtered'], 30)
+
+    @patch('build_pipeline.helpers.publish_sns_messsage', side_effect=SnsError('boom'))
+    def test_invalid_and_failed(self, _mock_publish):
+        deployment = [
+            delivery for delivery in self.deliveries if delivery['headers']['X-GitHub-Event'] == 'deployment'
+        ][0]
+        tampered = dict(deployment, body=deployment['body'].replace('"sha"', '"sha" '))
+        archive = self.write_archive('bad.jsonl', [deployment, tampered], ['not json', '{"body": "no headers"}'])
+
+        counts = Replayer().run(read_deliveries([archive]))
+        self.assertEqual(counts['invalid'], 1)
+        self.assertEqual(counts['unreadable'], 2)
+        self.assertEqual(counts.get('failed', 0) + counts.get('ignored', 0), 1)
+
+    def test_directory(self):
+        with open(os.path.join(self.tmp_dir, 'single.json'), 'w') as delivery_file:
+            json.dump(self.deliveries[0], delivery_file, indent=2)
+        with open(os.path.join(self.tmp_dir, 'notes.txt'), 'w') as notes_file:
+            notes_file.write('not an archive')
+
+        deliveries = list(read_deliveries([self.tmp_dir]))
+        self.assertEqual(len(deliveries), 41)
+        self.assertEqual(deliveries[0][0], self.archive + ':1')
+        self.assertEqual(deliveries[-1][1], self.deliveries[0])
+
+    @patch('build_pipeline.helpers.publish_sns_messsage')
+    @patch('build_pipeline.helpers.ROUTING_TABLE')
+    def test_main(self, _mock_table, mock_publish):
+        with patch('sys.stdout') as mock_stdout:
+            self.assertEqual(main(['--dry-run', '--events', 'deployment', '--workers', '2', self.archive]), 0)
+        report = json.loads(''.join(call[0][0] for call in mock_stdout.write.call_args_list))
+        self.assertEqual(report['filtered'], self.count_events('push'))
+        self.assertFalse(mock_publish.called)
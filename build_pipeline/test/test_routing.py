@@ -0,0 +1,116 @@
+"""
+Tests for the routing of GitHub events to CI jobs
+"""
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ..routing import DEFAULT_PARAMETERS, RoutingConfigError, Target, compile_routes, load_routing_config
+
+
+class RoutingTableTestCase(TestCase):
+    """TestCase class for verifying the matching of the routing table."""
+
+    def setUp(self):
+        super(RoutingTableTestCase, self).setUp()
+        self.table = compile_routes([
+            {'repos': ['org/*'], 'event': 'deployment', 'environments': ['sandbox'],
+             'targets': [{'topic': 'provision', 'job': 'prov_job'}]},
+            {'repos': ['org/repo', 'org/re*'], 'event': 'deployment',
+             'targets': [{'topic': 'notify', 'job': 'notify_job', 'parameters': {'ref': 'ref'}}]},
+            {'repos': ['team-*/shared'], 'event': 'deployment_status', 'states': ['success', 'failure'],
+             'targets': [{'topic': 'sitespeed', 'job': 'sitespeed_job'}, {'topic': 'report', 'job': 'report_job'}]},
+        ])
+
+    def _jobs(self, event, repo_name, data):
+        """ The jobs that the table routes an event to. """
+        return [target.job for target in self.table.match(event, repo_name, data)]
+
+    def test_match_in_config_order(self):
+        data = {'deployment': {'environment': 'sandbox'}}
+        self.assertEqual(self._jobs('deployment', 'org/repo', data), ['prov_job', 'notify_job'])
+        self.assertEqual(self._jobs('deployment', 'org/other', data), ['prov_job'])
+        self.assertEqual(self._jobs('deployment', 'other/repo', data), [])
+        # Cached, with the filters still applied
+        self.assertEqual(self._jobs('deployment', 'org/repo', {'deployment': {'environment': 'stage'}}), ['notify_job'])
+
+    def test_state_filter(self):
+        self.assertEqual(
+            self._jobs('deployment_status', 'team-a/shared', {'deployment_status': {'state': 'failure'}}),
+            ['sitespeed_job', 'report_job']
+        )
+        pending, success = {'deployment_status': {'state': 'pending'}}, {'deployment_status': {'state': 'success'}}
+        self.assertEqual(self._jobs('deployment_status', 'team-a/shared', pending), [])
+        self.assertEqual(self._jobs('deployment_status', 'other/shared', success), [])
+
+    def test_default_states(self):
+        self.table = compile_routes([
+            {'repos': ['org/repo'], 'event': 'deployment_status', 'targets': [{'topic': 'sitespeed', 'job': 'job'}]}
+        ])
+        for state, jobs in (('success', ['job']), ('pending', []), ('error', []), ('failure', [])):
+            self.assertEqual(self._jobs('deployment_status', 'org/repo', {'deployment_status': {'state': state}}), jobs)
+
+    def test_targets(self):
+        targets = self.table.match('deployment', 'org/repo', {'deployment': {'environment': 'sandbox'}})
+        self.assertEqual(targets, [
+            Target('provision', 'prov_job', DEFAULT_PARAMETERS),
+            Target('notify', 'notify_job', (('ref', 'ref'),)),
+        ])
+        self.assertIn('ref', self.table.deployment_fields)
+
+    def test_may_concern(self):
+        self.assertTrue(self.table.may_concern('{"full_name": "org/anything"}'))
+        self.assertTrue(self.table.may_concern('{"full_name": "org\\/anything"}'))
+        self.assertFalse(self.table.may_concern('{"full_name": "other/repo"}'))
+        self.assertFalse(self.table.may_concern('{"full_name": "myorg/repo"}'))
+        self.assertTrue(self.table.may_concern('{"full_name": "team-a/shared"}'))
+
+        self.assertFalse(self.table.may_concern('{"name": "org/repo"}'))
+
+        # Any of the full names in the payload may be the repository's
+        self.assertTrue(self.table.may_concern(
+            '{"deployment": {"payload": {"full_name": "other/repo"}}, "repository": {"full_name": "org/repo"}}'
+        ))
+
+        # A glob that starts with a wildcard is matched against the names
+        table = compile_routes([
+            {'repos': ['*/shared'], 'event': 'deployment', 'targets': [{'topic': 't', 'job': 'j'}]}
+        ])
+        self.assertTrue(table.may_concern('{"full_name": "other/shared"}'))
+        self.assertFalse(table.may_concern('{"full_name": "other/repo"}'))
+
+    def test_invalid_config(self):
+        invalid = (
+            {},
+            [{'repos': ['org/repo'], 'event': 'push', 'targets': [{'topic': 't', 'job': 'j'}]}],
+            [{'repos': [], 'event': 'deployment', 'targets': [{'topic': 't', 'job': 'j'}]}],
+            [{'repos': ['org/repo'], 'event': 'deployment', 'targets': []}],
+            [{'repos': ['org/repo'], 'event': 'deployment', 'targets': [{'topic': 't'}]}],
+            [{'repos': ['org/repo'], 'event': 'deployment', 'states': [1], 'targets': [{'topic': 't', 'job': 'j'}]}],
+            [{'repos': ['org/repo'], 'event': 'deployment', 'targets': [{'topic': 't', 'job': 'j', 'parameters': []}]}],
+        )
+        for rules in invalid:
+            self.assertRaises(RoutingConfigError, compile_routes, rules)
+
+
+class LoadRoutingConfigTestCase(TestCase):
+    """TestCase class for verifying the loading of the routing config."""
+    config = {'routes': [{'repos': 'org/repo', 'event': 'deployment', 'targets': [{'topic': 't', 'job': 'j'}]}]}
+
+    def test_inline(self):
+        table = load_routing_config(json.dumps(self.config))
+        self.assertEqual(len(table.match('deployment', 'org/repo', {})), 1)
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'routes.json')
+        with open(path, 'w') as config_file:
+            json.dump(self.config, config_file)
+        self.assertEqual(len(load_routing_config(path).routes), 1)
+
+        with open(path, 'w') as config_file:
+            config_file.write('{"routes": [')
+        self.assertRaises(RoutingConfigError, load_routing_config, path)
@@ -10,7 +10,9 @@ from moto import mock_sns
 import requests
 import threading
 
-from ..build_pipeline import PipelineHttpRequestHandler, parse_webhook_payload
+from .. import helpers
+from ..build_pipeline import PipelineHttpRequestHandler, check_prefork, parse_webhook_payload, reload_routing_table
+from ..helpers import reset_sns_connections
 from .utils import create_topic
 
 
@@ -78,6 +80,8 @@ class PipelineHandlerTestCase(TestCase):
     def setUp(self):
         super(PipelineHandlerTestCase, self).setUp()
         self.handler = PipelineHttpRequestHandler
+        reset_sns_connections()
+        self.addCleanup(reset_sns_connections)
 
     def test_untriggered_repo(self):
         result = parse_webhook_payload('foo', {'repository': {'full_name': 'foo/untriggered'}})
@@ -113,3 +117,36 @@ class PipelineHandlerTestCase(TestCase):
             )
             msg = 'Expected MessageID {} to be a 36 digit string'.format(result)
             self.assertEqual(len(result), 36, msg)
+
+
+class ReloadRoutingTestCase(TestCase):
+    """TestCase class for verifying the reloading of the routing config."""
+
+    @patch('build_pipeline.helpers.ROUTING_TABLE', None)
+    def test_reload(self):
+        config = {'routes': [{'repos': ['org/repo'], 'event': 'deployment', 'targets': [{'topic': 't', 'job': 'j'}]}]}
+        with patch('build_pipeline.routing.ROUTING_CONFIG', json.dumps(config)):
+            self.assertTrue(reload_routing_table())
+        table = helpers.ROUTING_TABLE
+        self.assertEqual(len(table.routes), 1)
+
+        # A config that can't be loaded leaves the routes as they were
+        with patch('build_pipeline.routing.ROUTING_CONFIG', '/nonexistent/routes.json'):
+            self.assertFalse(reload_routing_table())
+        self.assertIs(helpers.ROUTING_TABLE, table)
+
+
+class CheckPreforkTestCase(TestCase):
+    """TestCase class for verifying which settings the pre-fork mode can serve with."""
+
+    @patch('build_pipeline.dedup.DEDUP_ENABLED', True)
+    def test_shared_delivery_cache(self):
+        with patch('build_pipeline.dedup.DEDUP_REDIS_URL', None):
+            self.assertRaises(ValueError, check_prefork)
+        with patch('build_pipeline.dedup.DEDUP_REDIS_URL', 'redis://localhost:6379/0'):
+            check_prefork()
+
+    @patch('build_pipeline.dedup.DEDUP_ENABLED', False)
+    @patch('build_pipeline.dedup.DEDUP_REDIS_URL', None)
+    def test_without_delivery_cache(self):
+        check_prefork()
@@ -0,0 +1,423 @@
+"""
+Tests for the HTTP server implementations
+"""
+from BaseHTTPServer import HTTPServer
+import httplib
+import json
+import socket
+import threading
+import time
+from unittest import TestCase
+
+from mock import ANY, Mock, patch
+import requests
+
+from ..build_pipeline import PipelineHttpRequestHandler
+from ..dedup import DeliveryCache
+from ..metrics import WEBHOOKS
+from ..pool import PoolFullError
+from ..servers import (
+    AsyncHTTPServer, PooledHTTPServer, RequestFramer, create_listener, get_server_class, listening_server
+)
+from .utils import sign_payload
+
+
+class PooledHTTPServerTestCase(TestCase):
+    """TestCase class for verifying the thread pool server."""
+
+    def setUp(self):
+        super(PooledHTTPServerTestCase, self).setUp()
+        self.server = PooledHTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler, threads=4, queue_size=8)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+
+    def _post(self, responses):
+        """ Post a GitHub event to the server. """
+        contents = json.dumps({'repository': {'full_name': 'foo/bar'}, 'deployment': {}})
+        headers = {
+            'X-GitHub-Event': 'deployment',
+            'X-Hub-Signature': sign_payload(contents, 'my_token'),
+            'content-type': 'application/json'
+        }
+        response = requests.post(self.url, headers=headers, data=contents)
+        responses.append(response.status_code)
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'foo/bar')
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.parse_webhook_payload')
+    def test_concurrent_requests(self, mock_downstream):
+        # Each event is slow to publish, but the pool works on them in parallel
+        mock_downstream.side_effect = lambda event, data, on_failure=None: time.sleep(0.5)
+        responses = []
+        clients = [threading.Thread(target=self._post, args=(responses,)) for _ in range(4)]
+
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+        self.assertEqual(responses, [200] * 4)
+        # The responses go out before the events are published
+        self.server.pool.shutdown()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(mock_downstream.call_count, 4)
+
+
+class ServerClassTestCase(TestCase):
+    """TestCase class for verifying the selection of the serving mode."""
+
+    def test_modes(self):
+        self.assertIs(get_server_class('single'), HTTPServer)
+        self.assertIs(get_server_class('threaded'), PooledHTTPServer)
+        self.assertIs(get_server_class('async'), AsyncHTTPServer)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, get_server_class, 'bogus')
+
+    def test_listening_server(self):
+        # As used by the worker processes, which share the listening socket
+        listener = create_listener(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        for server_class in (HTTPServer, PooledHTTPServer, AsyncHTTPServer):
+            server = listening_server(server_class, listener, PipelineHttpRequestHandler)
+            self.assertEqual(server.server_port, listener.getsockname()[1])
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+
+            response = requests.get('http://127.0.0.1:{}/metrics'.format(server.server_port))
+            self.assertEqual(response.status_code, 200)
+            server.shutdown()
+
+
+@patch('build_pipeline.helpers.HANDLED_REPO', 'foo/bar')
+class DispatchingServerTestMixin(object):
+    """Tests that the handler queues events on the dispatcher, whichever server_class serves them."""
+
+    def setUp(self):
+        super(DispatchingServerTestMixin, self).setUp()
+        self.payload = {
+            'repository': {'full_name': 'foo/bar', 'description': 'a' * 100},
+            'deployment': {'id': 1, 'sha': 'abc', 'creator': {'login': 'someone'}},
+            'sender': {'login': 'someone'}
+        }
+        self.server = self.server_class(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        self.dispatcher = Mock()
+        self.server.dispatcher = self.dispatcher
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+
+    def _post(self, contents, secret='my_token', digest_name='sha256', event='deployment'):
+        """ Post a signed GitHub event to the server. """
+        signature = sign_payload(contents, secret, digest_name)
+        headers = {
+            'X-GitHub-Event': event,
+            'X-Hub-Signature-256' if digest_name == 'sha256' else 'X-Hub-Signature': signature,
+            'content-type': 'application/json'
+        }
+        return requests.post(self.url, headers=headers, data=contents)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.parse_webhook_payload')
+    def test_event_is_queued(self, mock_downstream):
+        self.payload['deployment']['created_at'] = '2015-10-01T12:00:00Z'
+        response = self._post(json.dumps(self.payload))
+        self.assertEqual(response.status_code, 200)
+        self.dispatcher.submit.assert_called_once_with('deployment', ANY, on_failure=None)
+        self.assertFalse(mock_downstream.called)
+
+        # Along with the trace of the delivery
+        data = self.dispatcher.submit.call_args[0][1]
+        trace = data.pop('trace')
+        self.assertEqual(data, {
+            'repository': {'full_name': 'foo/bar'},
+            'deployment': {'id': 1, 'sha': 'abc', 'created_at': '2015-10-01T12:00:00Z'}
+        })
+        self.assertEqual(trace['created_at'], 1443700800)
+        self.assertTrue(trace['trace_id'].startswith('1-'))
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_redelivery_is_ignored(self):
+        self.server.delivery_cache = DeliveryCache(10, 60)
+        contents = json.dumps(self.payload)
+        for delivery_id in ('first', 'first', 'second'):
+            headers = {
+                'X-GitHub-Event': 'deployment',
+                'X-GitHub-Delivery': delivery_id,
+                'X-Hub-Signature': sign_payload(contents, 'my_token'),
+            }
+            requests.post(self.url, headers=headers, data=contents)
+
+        self.assertEqual(self.dispatcher.submit.call_count, 2)
+        self.assertEqual(self.server.delivery_cache.hits, 1)
+
+        # A redelivery is handled when the original delivery failed
+        on_failure = self.dispatcher.submit.call_args[1]['on_failure']
+        on_failure()
+        self.assertFalse(self.server.delivery_cache.seen('delivery:second'))
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_delivery_is_captured(self):
+        recorded = threading.Event()
+        self.server.capture = Mock()
+        self.server.capture.record.side_effect = lambda *args: recorded.set()
+        contents = json.dumps(self.payload)
+        self._post(contents)
+
+        self.assertTrue(recorded.wait(5))
+        headers, captured, _received_at, outcome = self.server.capture.record.call_args[0]
+        self.assertEqual(headers['X-GitHub-Event'], 'deployment')
+        self.assertEqual(captured, contents)
+        self.assertEqual(outcome, 'queued')
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.json.loads')
+    def test_bad_signature_is_not_decoded(self, mock_loads):
+        self._post(json.dumps(self.payload), secret='forged')
+        self.assertFalse(mock_loads.called)
+        self.assertFalse(self.dispatcher.submit.called)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.helpers.MAX_PAYLOAD_SIZE', 10)
+    def test_payload_too_large(self):
+        self._post(json.dumps(self.payload))
+        self.assertFalse(self.dispatcher.submit.called)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.json.loads')
+    def test_unhandled_event_is_not_decoded(self, mock_loads):
+        response = self._post(json.dumps(self.payload), event='push')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(mock_loads.called)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.json.loads')
+    def test_unhandled_repo_is_not_decoded(self, mock_loads):
+        self.payload['repository']['full_name'] = 'foo/other'
+        self._post(json.dumps(self.payload))
+        self.assertFalse(mock_loads.called)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_metrics(self):
+        before = WEBHOOKS.value('deployment', 'invalid_signature')
+        self._post(json.dumps(self.payload), secret='forged')
+        self.assertEqual(WEBHOOKS.value('deployment', 'invalid_signature'), before + 1)
+
+        response = requests.get(self.url + '/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('build_pipeline_webhooks_total{event="deployment",outcome="invalid_signature"}', response.text)
+        self.assertIn('build_pipeline_stage_seconds_count{stage="verify",event="deployment"}', response.text)
+
+    def test_other_get_requests(self):
+        response = requests.get(self.url + '/foo')
+        self.assertEqual(response.status_code, 501)
+
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    def test_chunked_payload(self):
+        contents = json.dumps(self.payload)
+        headers = {'X-GitHub-Event': 'deployment', 'X-Hub-Signature-256': sign_payload(contents, 'my_token', 'sha256')}
+        chunks = (contents[start:start + 50] for start in range(0, len(contents), 50))
+        response = requests.post(self.url, headers=headers, data=chunks)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.dispatcher.submit.call_count, 1)
+
+    def test_length_required(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        self.addCleanup(conn.close)
+        conn.putrequest('POST', '/')
+        conn.putheader('X-GitHub-Event', 'deployment')
+        conn.endheaders()
+        response = conn.getresponse()
+        self.assertEqual(response.status, 411)
+        self.assertEqual(response.getheader('connection'), 'close')
+
+
+@patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+class KeepAliveTestMixin(object):
+    """Tests of persistent connections, whichever server_class serves them."""
+
+    def setUp(self):
+        super(KeepAliveTestMixin, self).setUp()
+        self.server = self.server_class(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.conn = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        self.addCleanup(self.conn.close)
+
+    def _post(self, event='push'):
+        """ Post an event on the persistent connection. """
+        contents = json.dumps({'repository': {'full_name': 'foo/bar'}})
+        headers = {'X-GitHub-Event': event, 'X-Hub-Signature': sign_payload(contents, 'my_token')}
+        self.conn.request('POST', '/', contents, headers)
+        response = self.conn.getresponse()
+        self.assertEqual(response.read(), '')
+        return response
+
+    def test_connection_is_reused(self):
+        self.assertEqual(self._post().status, 200)
+        sock = self.conn.sock
+        self.assertIsNotNone(sock)
+        self.assertEqual(self._post('deployment').status, 200)
+        self.assertIs(self.conn.sock, sock)
+
+    @patch('build_pipeline.build_pipeline.KEEPALIVE_MAX_REQUESTS', 2)
+    def test_request_cap(self):
+        self.assertIsNone(self._post().getheader('connection'))
+        self.assertEqual(self._post().getheader('connection'), 'close')
+        self.assertIsNone(self.conn.sock)
+
+    @patch.object(PipelineHttpRequestHandler, 'timeout', 0.1)
+    def test_idle_timeout(self):
+        self._post()
+        time.sleep(0.3)
+        # The server has closed the idle connection
+        self.assertEqual(self.conn.sock.recv(1), '')  # pylint: disable=no-member
+
+
+class DispatchingServerTestCase(DispatchingServerTestMixin, TestCase):
+    """TestCase class for verifying that the handler queues events on the dispatcher."""
+    server_class = HTTPServer
+
+
+class AsyncDispatchingServerTestCase(DispatchingServerTestMixin, TestCase):
+    """TestCase class for verifying that the async server handles webhooks the same way."""
+    server_class = AsyncHTTPServer
+
+
+class KeepAliveTestCase(KeepAliveTestMixin, TestCase):
+    """TestCase class for verifying persistent connections."""
+    server_class = HTTPServer
+
+
+class AsyncKeepAliveTestCase(KeepAliveTestMixin, TestCase):
+    """TestCase class for verifying persistent connections to the async server."""
+    server_class = AsyncHTTPServer
+
+    def test_pipelined_requests(self):
+        contents = json.dumps({'repository': {'full_name': 'foo/bar'}})
+        request = 'POST / HTTP/1.1\r\nX-GitHub-Event: push\r\nContent-Length: {}\r\n\r\n{}'.format(
+            len(contents), contents
+        )
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(request * 3)  # pylint: disable=no-member
+        received = ''
+        while received.count('HTTP/1.1 200') < 3:
+            data = sock.recv(4096)  # pylint: disable=no-member
+            self.assertTrue(data)
+            received += data
+
+    @patch('build_pipeline.servers.WorkerPool.submit')
+    def test_no_free_worker(self, mock_submit):
+        mock_submit.side_effect = PoolFullError
+        self.assertEqual(self._post().status, 503)
+
+    @patch('build_pipeline.helpers.HANDLED_REPO', 'foo/bar')
+    @patch('build_pipeline.helpers.WEBHOOK_SECRET_TOKEN', 'my_token')
+    @patch('build_pipeline.build_pipeline.parse_webhook_payload')
+    def test_overloaded_connection_is_closed(self, mock_downstream):
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+        mock_downstream.side_effect = lambda event, data, on_failure=None: started.set() or release.wait(5)
+        server = AsyncHTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler, threads=1, queue_size=1)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        contents = json.dumps({'repository': {'full_name': 'foo/bar'}, 'deployment': {}})
+        request = (
+            'POST / HTTP/1.1\r\nX-GitHub-Event: deployment\r\nX-Hub-Signature: {}\r\nContent-Length: {}\r\n\r\n{}'
+        ).format(sign_payload(contents, 'my_token'), len(contents), contents)
+        connections = []
+        for _ in range(3):
+            sock = socket.create_connection(server.server_address, timeout=5)
+            self.addCleanup(sock.close)
+            sock.sendall(request)  # pylint: disable=no-member
+            connections.append(sock)
+            # The first request keeps the one worker busy, the second fills the queue
+            started.wait(5)
+            time.sleep(0.1)
+
+        # The third is turned away, and its connection is closed once the 503 is sent
+        received = ''
+        while True:
+            data = connections[2].recv(4096)  # pylint: disable=no-member
+            if not data:
+                break
+            received += data
+        self.assertTrue(received.startswith('HTTP/1.1 503'))
+
+
+class AsyncPipelineServerTestCase(TestCase):
+    """TestCase class for verifying that the async server services the webhooks from GitHub."""
+
+    def setUp(self):
+        super(AsyncPipelineServerTestCase, self).setUp()
+        self.server = AsyncHTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+
+    @patch('build_pipeline.build_pipeline.parse_webhook_payload')
+    def test_github_event(self, mock_downstream):
+        mock_downstream.return_value = 'foo'
+        headers = {'X-GitHub-Event': 'foo', 'content-type': 'application/json'}
+        response = requests.post(self.url, headers=headers, data=json.dumps({'repository': 'bar'}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_request(self):
+        """ Test that GET requests are not implemented, only POSTs are. """
+        response = requests.get(self.url, data={})
+        self.assertEqual(response.status_code, 501)
+
+
+class RequestFramerTestCase(TestCase):
+    """TestCase class for verifying how the async server finds the end of each request."""
+
+    def test_content_length(self):
+        framer = RequestFramer()
+        self.assertIsNone(framer.feed('POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n01'))
+        self.assertTrue(framer.pending)
+        self.assertEqual(
+            framer.feed('234GET /metrics HTTP/1.1\r\n\r\n'), 'POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n01234'
+        )
+        self.assertEqual(framer.feed(''), 'GET /metrics HTTP/1.1\r\n\r\n')
+        self.assertIsNone(framer.feed(''))
+        self.assertFalse(framer.pending)
+
+    def test_chunked(self):
+        framer = RequestFramer()
+        request = 'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n2;x=y\r\nde\r\n0\r\nA: b\r\n\r\n'
+        for char in request[:-1]:
+            self.assertIsNone(framer.feed(char))
+        self.assertEqual(framer.feed(request[-1]), request)
+
+    def test_too_large(self):
+        framer = RequestFramer(max_size=4)
+        # Handed over without the body, which the handler refuses to read
+        head = 'POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n'
+        self.assertEqual(framer.feed(head + '01234'), head)
+        request = 'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n2\r\n'
+        self.assertEqual(RequestFramer(max_size=4).feed(request + 'de\r\n0\r\n\r\n'), request)
+
+    def test_malformed(self):
+        request = 'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n'
+        self.assertEqual(RequestFramer().feed(request), request)
+        self.assertEqual(RequestFramer().feed('x' * 70000), 'x' * 70000)
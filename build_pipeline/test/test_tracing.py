@@ -0,0 +1,57 @@
+"""
+Tests for the tracing of the pipeline runs
+"""
+from unittest import TestCase
+
+from ..metrics import LEAD_TIME_SECONDS
+from ..tracing import format_time, new_trace, parse_github_time, record_lead_times, trace_id
+
+
+class TraceTestCase(TestCase):
+    """TestCase class for verifying the traces of the deliveries."""
+
+    def test_trace_id(self):
+        self.assertEqual(trace_id('72d3162e', 1234), '1234-72d3162e')
+        # Deliveries without an id still get traces of their own
+        self.assertNotEqual(trace_id(None, 1234), trace_id(None, 1234))
+
+    def test_deployment(self):
+        data = {'deployment': {'id': 1, 'created_at': '2015-10-01T12:00:00Z'}}
+        trace = new_trace('abc', data, 1443700805.5)
+        self.assertEqual(trace, {
+            'trace_id': '1-abc', 'delivery_id': 'abc', 'created_at': 1443700800.0, 'received_at': 1443700805.5
+        })
+
+    def test_deployment_status(self):
+        # Created by the job that reported the state, well after the deployment
+        data = {
+            'deployment': {'id': 1, 'created_at': '2015-10-01T12:00:00Z'},
+            'deployment_status': {'state': 'success', 'created_at': '2015-10-01T12:30:00Z'},
+        }
+        self.assertEqual(new_trace('abc', data, 1443702605)['created_at'], 1443702600)
+
+    def test_unknown_created_at(self):
+        self.assertIsNone(new_trace('abc', {'deployment': {'id': 1, 'created_at': 'yesterday'}}, 0)['created_at'])
+        self.assertIsNone(new_trace('abc', {}, 0)['created_at'])
+
+    def test_times(self):
+        self.assertEqual(parse_github_time('2015-10-01T12:00:00Z'), 1443700800)
+        self.assertEqual(format_time(1443700800.25), '2015-10-01T12:00:00.250Z')
+        self.assertRaises(ValueError, parse_github_time, '2015-10-01')
+
+
+class LeadTimeTestCase(TestCase):
+    """TestCase class for verifying the lead times of the traces."""
+
+    def test_hops(self):
+        hops = ('created_to_received', 'received_to_published', 'created_to_published')
+        before = dict((hop, LEAD_TIME_SECONDS.count(hop, 'test_event')) for hop in hops)
+        record_lead_times({'trace_id': 't', 'created_at': 1000, 'received_at': 1002}, 'test_event', 1002.5)
+        for hop in hops:
+            self.assertEqual(LEAD_TIME_SECONDS.count(hop, 'test_event'), before[hop] + 1)
+
+    def test_without_created_at(self):
+        before = LEAD_TIME_SECONDS.count('created_to_received', 'other_test_event')
+        record_lead_times({'trace_id': 't', 'created_at': None, 'received_at': 1002}, 'other_test_event', 1003)
+        self.assertEqual(LEAD_TIME_SECONDS.count('created_to_received', 'other_test_event'), before)
+        self.assertEqual(LEAD_TIME_SECONDS.count('received_to_published', 'other_test_event'), 1)
@@ -0,0 +1,165 @@
+"""
+Tests for the transports that messages are published with
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from boto.exception import BotoServerError
+from mock import Mock, patch
+
+from .. import helpers
+from ..helpers import SnsError, publish_sns_messsage
+from ..transports import (
+    FileTransport, MemoryTransport, SqsTransport, parse_queue_urls, transport_from_env
+)
+
+
+def _batch_results(messages, failing=()):
+    """ A response to SendMessageBatch, failing the entries with the given bodies. """
+    results = Mock(results=[], errors=[])
+    for entry_id, body, _ in messages:
+        if body in failing:
+            results.errors.append({'id': entry_id, 'error_code': 'InvalidMessageContents', 'error_message': 'bad'})
+        else:
+            results.results.append({'id': entry_id, 'message_id': 'sqs-' + body})
+    return results
+
+
+class SqsTransportTestCase(TestCase):
+    """TestCase class for verifying the batching SQS transport."""
+
+    def setUp(self):
+        super(SqsTransportTestCase, self).setUp()
+        self.conn = Mock()
+        self.conn.send_message_batch.side_effect = lambda queue, messages: _batch_results(messages)
+        self.transport = SqsTransport({'arn': 'https://queue.amazonaws.com/123/jenkins'}, window=0.2, raw=True)
+        patcher = patch.object(self.transport, '_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish_concurrently(self, count):
+        """ Publish a number of messages from separate threads and collect the outcomes by message. """
+        outcomes = {}
+
+        def publish(message):
+            """ Publish a message, recording what it returned or raised. """
+            try:
+                outcomes[message] = self.transport.publish('arn', message)
+            except Exception as err:  # pylint: disable=broad-except
+                outcomes[message] = err
+
+        threads = [threading.Thread(target=publish, args=('msg{}'.format(index),)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_coalesced_into_batches(self):
+        outcomes = self.publish_concurrently(25)
+        self.assertEqual(outcomes, dict(('msg{}'.format(index), 'sqs-msg{}'.format(index)) for index in range(25)))
+        batch_sizes = [len(call[0][1]) for call in self.conn.send_message_batch.call_args_list]
+        self.assertEqual(sum(batch_sizes), 25)
+        self.assertLessEqual(max(batch_sizes), 10)
+        self.assertEqual(self.transport.batches_sent, 3)
+        self.assertEqual(self.conn.send_message_batch.call_args[0][0].url, 'https://queue.amazonaws.com/123/jenkins')
+
+    def test_failed_entries(self):
+        self.conn.send_message_batch.side_effect = lambda queue, messages: _batch_results(messages, ['msg1'])
+        outcomes = self.publish_concurrently(3)
+        self.assertEqual(outcomes['msg0'], 'sqs-msg0')
+        self.assertIsInstance(outcomes['msg1'], SnsError)
+        self.assertIn('InvalidMessageContents', str(outcomes['msg1']))
+
+    def test_failed_batch(self):
+        send_message_batch = self.conn.send_message_batch.side_effect
+        self.conn.send_message_batch.side_effect = [BotoServerError(500, 'Internal Error')] * 3
+        outcomes = self.publish_concurrently(3)
+        self.assertTrue(all(isinstance(outcome, SnsError) for outcome in outcomes.values()))
+
+        # The next batch goes through
+        self.conn.send_message_batch.side_effect = send_message_batch
+        self.assertEqual(self.transport.publish('arn', 'again'), 'sqs-again')
+
+    def test_malformed_response(self):
+        self.conn.send_message_batch.side_effect = lambda queue, messages: Mock(results=[{'id': 'bogus'}], errors=[])
+        start = time.time()
+        outcomes = self.publish_concurrently(3)
+        # The publishers that joined the batch aren't left waiting for it
+        self.assertLess(time.time() - start, 5)
+        errors = sorted(type(outcome).__name__ for outcome in outcomes.values())
+        self.assertEqual(errors, ['KeyError', 'SnsError', 'SnsError'])
+
+    @patch('build_pipeline.transports.SQS_MAX_RETRIES', 3)
+    @patch('build_pipeline.transports.SQS_TIMEOUT', 2.5)
+    @patch('boto.sqs.connect_to_region')
+    def test_connection_settings(self, mock_connect):
+        mock_connect.return_value = Mock(http_connection_kwargs={})
+        transport = SqsTransport({None: 'https://queue.amazonaws.com/123/jenkins'}, region='us-east-1')
+        conn = transport._connection()  # pylint: disable=protected-access
+        self.assertEqual(conn.http_connection_kwargs['timeout'], 2.5)
+        self.assertEqual(conn.num_retries, 3)
+
+    def test_no_queue(self):
+        self.assertRaises(SnsError, self.transport.publish, 'other-arn', 'msg')
+        self.assertFalse(self.conn.send_message_batch.called)
+
+    def test_sns_notification(self):
+        self.transport.raw = False
+        self.transport.window = 0
+        message_id = self.transport.publish('arn', '{"job": "foo"}')
+        body = json.loads(self.conn.send_message_batch.call_args[0][1][0][1])
+        self.assertEqual(body['Type'], 'Notification')
+        self.assertEqual(body['TopicArn'], 'arn')
+        self.assertEqual(json.loads(body['Message']), {'job': 'foo'})
+        self.assertEqual(message_id, 'sqs-' + self.conn.send_message_batch.call_args[0][1][0][1])
+
+    def test_parse_queue_urls(self):
+        self.assertEqual(parse_queue_urls('https://queue/1'), {None: 'https://queue/1'})
+        self.assertEqual(parse_queue_urls('{"arn": "https://queue/1"}'), {'arn': 'https://queue/1'})
+        self.assertRaises(ValueError, parse_queue_urls, '')
+
+
+class LocalTransportTestCase(TestCase):
+    """TestCase class for verifying the memory and file transports."""
+
+    def test_publish_through_transport(self):
+        transport = MemoryTransport()
+        with patch('build_pipeline.helpers.TRANSPORT', transport), \
+                patch('build_pipeline.helpers.get_sns_connection') as mock_connection:
+            message_id = publish_sns_messsage('arn', {'job': 'foo'})
+        self.assertFalse(mock_connection.called)
+        self.assertEqual(transport.messages, [('arn', message_id, '{"job": "foo"}')])
+
+    def test_file_transport(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'messages.jsonl')
+        transport = FileTransport(path)
+        first = transport.publish('arn', 'one')
+        transport.publish('arn', 'two')
+
+        with open(path) as messages_file:
+            lines = [json.loads(line) for line in messages_file]
+        self.assertEqual(
+            [(line['message_id'], line['message']) for line in lines], [(first, 'one'), (lines[1]['message_id'], 'two')]
+        )
+
+        transport.path = os.path.join(tmp_dir, 'missing', 'messages.jsonl')
+        self.assertRaises(SnsError, transport.publish, 'arn', 'three')
+
+    def test_from_env(self):
+        self.assertIsNone(transport_from_env())
+        with patch('build_pipeline.transports.PUBLISH_TRANSPORT', 'memory'):
+            self.assertIsInstance(transport_from_env(), MemoryTransport)
+        with patch('build_pipeline.transports.PUBLISH_TRANSPORT', 'sqs'), \
+                patch('build_pipeline.transports.SQS_QUEUE_URLS', 'https://queue/1'):
+            self.assertEqual(transport_from_env().queue_urls, {None: 'https://queue/1'})
+        with patch('build_pipeline.transports.PUBLISH_TRANSPORT', 'carrier-pigeon'):
+            self.assertRaises(ValueError, transport_from_env)
+        self.assertIsNone(helpers.TRANSPORT)
@@ -0,0 +1,94 @@
+"""
+Tests for the warm-up of the server process
+"""
+from BaseHTTPServer import HTTPServer
+import threading
+from unittest import TestCase
+
+from mock import patch
+import requests
+
+from ..build_pipeline import PipelineHttpRequestHandler
+from ..metrics import BOOT_SECONDS
+from ..warmup import DONE, FAILED, PENDING, Warmup
+
+
+class WarmupTestCase(TestCase):
+    """TestCase class for verifying the warm-up and the start-up timings."""
+
+    def test_without_prewarm(self):
+        warmup = Warmup(started_at=1000)
+        warmup.start(imported_at=1000.25)
+        self.assertEqual(warmup.state, DONE)
+        self.assertTrue(warmup.ready)
+        self.assertEqual(warmup.timings['imported'], 0.25)
+        self.assertIn('listening', warmup.timings)
+        self.assertEqual(BOOT_SECONDS.value('imported'), 0.25)
+
+    @patch('build_pipeline.helpers.TRANSPORT', None)
+    @patch('build_pipeline.helpers.prewarm_sns_connections')
+    def test_prewarm(self, mock_prewarm):
+        started = threading.Event()
+        mock_prewarm.side_effect = lambda count: started.wait(5)
+        warmup = Warmup(prewarm=True, connections=3)
+        warmup.start()
+        # Not ready until the connections are open
+        self.assertEqual(warmup.describe()['state'], PENDING)
+        self.assertFalse(warmup.ready)
+
+        started.set()
+        warmup.join(5)
+        self.assertEqual(warmup.state, DONE)
+        mock_prewarm.assert_called_once_with(3)
+        self.assertIn('warmed_up', warmup.describe()['timings'])
+
+    @patch('build_pipeline.helpers.TRANSPORT', None)
+    @patch('build_pipeline.helpers.prewarm_sns_connections')
+    def test_failed_prewarm(self, mock_prewarm):
+        mock_prewarm.side_effect = IOError('no route to host')
+        warmup = Warmup(prewarm=True)
+        warmup.start()
+        warmup.join(5)
+        # The connections get opened on demand instead
+        self.assertEqual(warmup.state, FAILED)
+        self.assertTrue(warmup.ready)
+        self.assertEqual(warmup.describe()['error'], 'no route to host')
+
+    def test_first_request(self):
+        warmup = Warmup(started_at=1000)
+        with patch('build_pipeline.warmup.time.time', return_value=1002.0):
+            warmup.request_done(1001.5)
+        warmup.request_done(1003)
+        self.assertEqual(warmup.timings['first_request'], 2)
+        self.assertEqual(warmup.timings['first_request_latency'], 0.5)
+
+
+class HealthEndpointsTestCase(TestCase):
+    """TestCase class for verifying the health and readiness endpoints."""
+
+    def setUp(self):
+        super(HealthEndpointsTestCase, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), PipelineHttpRequestHandler)
+        self.server.warmup = Warmup(prewarm=True)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+
+    def test_ready(self):
+        response = requests.get(self.url + '/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['state'], PENDING)
+
+        self.server.warmup.state = DONE
+        response = requests.get(self.url + '/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['ready'])
+
+    def test_healthz(self):
+        # Healthy while warming up
+        response = requests.get(self.url + '/healthz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], PENDING)
@@ -1,4 +1,7 @@
 """ Utility methods for tests. """
+import hashlib
+import hmac
+
 from boto import connect_sns
 
 
@@ -9,3 +12,9 @@ def create_topic():
     topics_json = conn.get_all_topics()
     topic_arn = topics_json["ListTopicsResponse"]["ListTopicsResult"]["Topics"][0]['TopicArn']
     return topic_arn
+
+
+def sign_payload(contents, secret, digest_name='sha1'):
+    """ Compute the signature header value that GitHub would send with the contents. """
+    digestmod = getattr(hashlib, digest_name)
+    return '{}={}'.format(digest_name, hmac.new(secret, msg=contents, digestmod=digestmod).hexdigest())
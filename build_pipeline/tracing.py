@@ -0,0 +1,101 @@
+"""
+Tracing of the pipeline runs, from GitHub creating a deployment or deployment status to the job being triggered
+
+Every delivery gets a trace: a trace id derived from the delivery id and the
+deployment id, along with the time it was received. The trace is passed to
+the jobs as parameters, so that the runs of the jobs can be traced back to
+the delivery, and the time between each hop is recorded in the lead time
+metrics when the message is published:
+
+    created (by GitHub) -> received (by the service) -> published (to the job)
+
+For deployment events the deployment is created by GitHub, and for deployment
+status events the status is, so the lead time of a deployment status event
+is the time from a job reporting success to the next job being triggered.
+"""
+import calendar
+from datetime import datetime
+import uuid
+
+from .metrics import LEAD_TIME_SECONDS  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Format of the timestamps that GitHub sends
+GITHUB_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def trace_id(delivery_id, deployment_id):
+    """ The id of a trace, made from the id of the delivery and of the deployment it is about.
+
+    Deliveries without an id, as when they are replayed from old archives, get a random one.
+    """
+    return '{}-{}'.format(deployment_id if deployment_id is not None else 'none', delivery_id or uuid.uuid4().hex)
+
+
+def new_trace(delivery_id, data, received_at):
+    """ The trace of a delivery.
+
+    Args:
+        delivery_id (string): GUID of the delivery, from the X-GitHub-Delivery request header
+        data (dict): payload from the webhook, as returned by extract_webhook_fields
+        received_at (float): time the delivery was received
+
+    Returns:
+        dict: with the trace_id, the delivery_id, and the created_at and received_at times
+            in seconds since the epoch. created_at is None when GitHub didn't send it.
+    """
+    deployment = data.get('deployment') or {}
+    # A deployment status is created well after its deployment
+    created_by_github = (data.get('deployment_status') or deployment).get('created_at')
+    try:
+        created_at = parse_github_time(created_by_github) if created_by_github else None
+    except ValueError:
+        created_at = None
+    return {
+        'trace_id': trace_id(delivery_id, deployment.get('id')),
+        'delivery_id': delivery_id,
+        'created_at': created_at,
+        'received_at': received_at,
+    }
+
+
+def parse_github_time(value):
+    """ Seconds since the epoch from a GitHub timestamp.
+
+    Raises:
+        ValueError if the timestamp can't be interpreted
+    """
+    return float(calendar.timegm(datetime.strptime(value, GITHUB_TIME_FORMAT).timetuple()))
+
+
+def format_time(seconds):
+    """ A time in seconds since the epoch as a UTC timestamp with milliseconds. """
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def record_lead_times(trace, event, published_at):
+    """ Record the time between the hops of a trace whose message has been published.
+
+    Clocks differ between GitHub and the service, so the times are never taken as negative.
+
+    Args:
+        trace (dict): as returned by new_trace
+        event (string): GitHub event
+        published_at (float): time the message was published
+    """
+    received_at = trace['received_at']
+    created_at = trace.get('created_at')
+    LEAD_TIME_SECONDS.observe(max(0.0, published_at - received_at), 'received_to_published', event)
+    if created_at is None:
+        LOGGER.info(
+            'Trace %s: published %.3f s after it was received', trace['trace_id'], published_at - received_at
+        )
+        return
+    LEAD_TIME_SECONDS.observe(max(0.0, received_at - created_at), 'created_to_received', event)
+    LEAD_TIME_SECONDS.observe(max(0.0, published_at - created_at), 'created_to_published', event)
+    LOGGER.info(
+        'Trace %s: received %.3f s after it was created, published %.3f s after it was received',
+        trace['trace_id'], received_at - created_at, published_at - received_at
+    )
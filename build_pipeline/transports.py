@@ -0,0 +1,301 @@
+"""
+Transports that the messages for the CI jobs are published with
+
+By default every message is published to its SNS topic, which delivers it to
+the SQS queue that the Jenkins SQS plugin reads. The sqs transport sends the
+messages to the queues directly instead, coalescing the messages published
+within a short window into SendMessageBatch calls of up to 10 entries. The
+memory and file transports keep the messages locally, for development and tests.
+"""
+from datetime import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+from .helpers import SnsError, SNS_MAX_RETRIES, SNS_REGION, SNS_TIMEOUT, boto_errors  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# The transport that messages are published with: sns, sqs, memory or file
+PUBLISH_TRANSPORT = os.environ.get('PUBLISH_TRANSPORT', 'sns').lower()
+
+# The queues of the sqs transport: a JSON object mapping the SNS topic ARNs
+# to the URLs of the SQS queues subscribed to them, or one queue URL for all topics
+SQS_QUEUE_URLS = os.environ.get('SQS_QUEUE_URLS', '')
+
+# The AWS region of the SQS queues, defaults to the SNS_REGION
+SQS_REGION = os.environ.get('SQS_REGION') or SNS_REGION
+
+# Seconds that connecting to SQS, and each read of its response, may take, defaults to the SNS_TIMEOUT
+SQS_TIMEOUT = float(os.environ.get('SQS_TIMEOUT') or SNS_TIMEOUT)
+
+# Number of times that boto retries a failed batch, defaults to the SNS_MAX_RETRIES
+SQS_MAX_RETRIES = int(os.environ.get('SQS_MAX_RETRIES') or SNS_MAX_RETRIES)
+
+# Seconds that the sqs transport collects messages for before sending them in one batch
+SQS_BATCH_WINDOW = float(os.environ.get('SQS_BATCH_WINDOW', '0.05'))
+
+# Set to 'true' to send the bare messages to SQS. By default they are wrapped in the
+# notification that SNS would have delivered, so the consumers see the same bodies.
+SQS_RAW_MESSAGES = os.environ.get('SQS_RAW_MESSAGES', 'false').lower() == 'true'
+
+# Path of the file that the file transport appends the messages to, one JSON object per line
+TRANSPORT_FILE_PATH = os.environ.get('TRANSPORT_FILE_PATH', 'published_messages.jsonl')
+
+# The most entries that SQS accepts in one SendMessageBatch call
+SQS_MAX_BATCH = 10
+
+# Seconds that a publisher waits for the batch it joined to be sent
+_BATCH_TIMEOUT = 60
+
+
+def transport_from_env():
+    """ Create the transport selected by PUBLISH_TRANSPORT, None to publish to SNS.
+
+    Raises:
+        ValueError if the transport is unknown or not configured
+    """
+    if PUBLISH_TRANSPORT == 'sns':
+        return None
+    if PUBLISH_TRANSPORT == 'sqs':
+        return SqsTransport(parse_queue_urls(SQS_QUEUE_URLS))
+    if PUBLISH_TRANSPORT == 'memory':
+        return MemoryTransport()
+    if PUBLISH_TRANSPORT == 'file':
+        return FileTransport(TRANSPORT_FILE_PATH)
+    raise ValueError('Unknown PUBLISH_TRANSPORT: {}'.format(PUBLISH_TRANSPORT))
+
+
+def parse_queue_urls(config):
+    """ Parse SQS_QUEUE_URLS into a dict of queue URLs by topic ARN, with the default queue under None. """
+    config = config.strip()
+    if not config:
+        raise ValueError('SQS_QUEUE_URLS must be set for the sqs transport')
+    if not config.startswith('{'):
+        return {None: config}
+    urls = json.loads(config)
+    if not isinstance(urls, dict):
+        raise ValueError('SQS_QUEUE_URLS must map topic ARNs to queue URLs')
+    return urls
+
+
+def sns_notification(topic_arn, message, message_id):
+    """ Wrap a message in the notification that SNS delivers to the queues subscribed to a topic. """
+    return json.dumps({
+        'Type': 'Notification',
+        'MessageId': message_id,
+        'TopicArn': topic_arn,
+        'Message': message,
+        'Timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+    })
+
+
+class MemoryTransport(object):
+    """ Keeps the published messages in a list, as (topic_arn, message_id, message) tuples. """
+
+    def __init__(self):
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic_arn, message):
+        """ Record a message and return its id. """
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self.messages.append((topic_arn, message_id, message))
+        return message_id
+
+
+class FileTransport(object):
+    """ Appends the published messages to a file, one JSON object per line.
+
+    Args:
+        path (string): path of the file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def publish(self, topic_arn, message):
+        """ Append a message to the file and return its id.
+
+        Raises:
+            SnsError if the file can't be written
+        """
+        message_id = str(uuid.uuid4())
+        line = json.dumps({
+            'topic_arn': topic_arn, 'message_id': message_id, 'message': message, 'published_at': time.time()
+        })
+        try:
+            with self._lock:
+                with open(self.path, 'a') as messages_file:
+                    messages_file.write(line + '\n')
+        except IOError as err:
+            raise SnsError(err)
+        return message_id
+
+
+class _Entry(object):
+    """ A message waiting in a batch for the outcome of sending it.
+
+    The message id identifies the entry within its batch, and the SQS
+    message id is the MessageId that SQS gave the message once sent.
+    """
+
+    def __init__(self, message_id, body):
+        self.message_id = message_id
+        self.body = body
+        self.sqs_message_id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch(object):
+    """ The messages collected for one queue within a window. """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.entries = []
+        self.closed = False
+
+
+class SqsTransport(object):
+    """ Sends the messages to the SQS queues of their topics, in batches.
+
+    The first message published to a queue opens a batch and its publisher
+    waits for the window to pass, or for the batch to fill up, before sending
+    the batch. Messages published to the queue meanwhile join the batch, and
+    their publishers wait for it to be sent. So there is no background thread,
+    and every publisher still learns whether its own message was sent.
+
+    Args:
+        queue_urls (dict): queue URLs by topic ARN, with the queue for any other topic under None
+        window (float): seconds to collect the messages of a batch for, defaults to SQS_BATCH_WINDOW
+        region (string): AWS region of the queues, defaults to SQS_REGION
+        raw (bool): send the bare messages instead of SNS notifications, defaults to SQS_RAW_MESSAGES
+    """
+    def __init__(self, queue_urls, window=None, region=None, raw=None):
+        self.queue_urls = queue_urls
+        self.window = SQS_BATCH_WINDOW if window is None else window
+        self.region = SQS_REGION if region is None else region
+        self.raw = SQS_RAW_MESSAGES if raw is None else raw
+        self.batches_sent = 0
+        self._pending = {}
+        self._lock = threading.Condition()
+        self._connections = threading.local()
+
+    def publish(self, topic_arn, message):
+        """ Send a message with the next batch for the queue of its topic.
+
+        Returns:
+            string: the SQS MessageId of the message
+
+        Raises:
+            SnsError when sending was unsuccessful
+        """
+        queue_url = self.queue_urls.get(topic_arn) or self.queue_urls.get(None)
+        if not queue_url:
+            raise SnsError('No SQS queue for topic {}'.format(topic_arn))
+
+        entry_id = uuid.uuid4().hex
+        body = message if self.raw else sns_notification(topic_arn, message, str(uuid.UUID(entry_id)))
+        entry = _Entry(entry_id, body)
+
+        with self._lock:
+            batch = self._pending.get(queue_url)
+            leader = batch is None
+            if leader:
+                batch = self._pending[queue_url] = _Batch(queue_url)
+            batch.entries.append(entry)
+            if len(batch.entries) >= SQS_MAX_BATCH:
+                self._close(batch)
+
+            if leader:
+                deadline = time.time() + self.window
+                while not batch.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._close(batch)
+                        break
+                    self._lock.wait(remaining)
+
+        if leader:
+            self._send(batch)
+        elif not entry.done.wait(_BATCH_TIMEOUT):
+            raise SnsError('Timed out waiting for the batch to be sent to {}'.format(queue_url))
+
+        if entry.error is not None:
+            raise SnsError(entry.error)
+        return entry.sqs_message_id
+
+    def _close(self, batch):
+        """ Stop a batch from taking more messages, and wake up its leader. Called with the lock held. """
+        batch.closed = True
+        if self._pending.get(batch.queue_url) is batch:
+            del self._pending[batch.queue_url]
+        self._lock.notify_all()
+
+    def _send(self, batch):
+        """ Send a batch and hand every entry its outcome.
+
+        The publishers waiting on the batch are released whatever happens, with an error
+        for the entries that the response doesn't answer. An unexpected error is raised
+        to the leader.
+        """
+        entries = dict((entry.message_id, entry) for entry in batch.entries)
+        try:
+            self._send_entries(batch, entries)
+        finally:
+            for entry in batch.entries:
+                if entry.sqs_message_id is None and entry.error is None:
+                    entry.error = 'Not in the response to SendMessageBatch'
+                entry.done.set()
+
+    def _send_entries(self, batch, entries):
+        """ Make the SendMessageBatch call of a batch, and record the outcome of each of its entries. """
+        try:
+            from boto.sqs.queue import Queue
+            conn = self._connection()
+            results = conn.send_message_batch(
+                Queue(conn, batch.queue_url), [(entry.message_id, entry.body, 0) for entry in batch.entries]
+            )
+        except SnsError as err:
+            self._fail(batch, err)
+            return
+        except boto_errors() as err:
+            self._fail(batch, err)
+            return
+
+        self.batches_sent += 1
+        LOGGER.debug('Sent a batch of %s messages to %s', len(batch.entries), batch.queue_url)
+        for result in results.results:
+            entries[result['id']].sqs_message_id = result.get('message_id')
+        for result in results.errors:
+            entries[result['id']].error = '{}: {}'.format(result.get('error_code'), result.get('error_message'))
+
+    def _fail(self, batch, err):
+        """ Hand every entry of a batch that could not be sent the error. """
+        # Don't reuse a connection that may be in a bad state
+        self._connections.conn = None
+        for entry in batch.entries:
+            entry.error = err
+
+    def _connection(self):
+        """ The SQS connection of the current thread, opened when first needed. """
+        conn = getattr(self._connections, 'conn', None)
+        if conn is None:
+            # Imported when first needed, like the rest of boto
+            import boto.sqs
+            if self.region:
+                conn = boto.sqs.connect_to_region(self.region)
+                if conn is None:
+                    raise SnsError('Unknown SQS region: {}'.format(self.region))
+            else:
+                conn = boto.connect_sqs()
+            # Keep a slow SQS from holding up the publishers of the batch for long, as with SNS
+            conn.http_connection_kwargs['timeout'] = SQS_TIMEOUT
+            conn.num_retries = SQS_MAX_RETRIES
+            self._connections.conn = conn
+        return conn
@@ -0,0 +1,135 @@
+"""
+Warming up a server process, and timing how long it takes to start
+
+boto is only imported when the first message is published, so that a dyno
+that was idled out starts accepting connections sooner. With SNS_PREWARM
+the SNS connections are opened in the background instead, as soon as the
+server is listening, so that the first delivery doesn't wait for them either.
+GET /ready answers 503 until the warm-up is over, and GET /healthz answers
+200 as long as the process serves requests at all.
+"""
+import os
+import threading
+import time
+
+from . import IMPORT_STARTED_AT  # pylint: disable=relative-import
+from . import helpers  # pylint: disable=relative-import
+from .metrics import BOOT_SECONDS  # pylint: disable=relative-import
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Set to 'true' to open the SNS connections in the background as soon as the server is listening
+SNS_PREWARM = os.environ.get('SNS_PREWARM', 'false').lower() == 'true'
+
+# Number of SNS connections opened ahead of time, for the first threads that publish to take
+SNS_PREWARM_CONNECTIONS = int(os.environ.get('SNS_PREWARM_CONNECTIONS', '1'))
+
+# The states of the warm-up
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Warmup(object):
+    """ Warms up a server process in the background, and reports the timings of starting it.
+
+    The timings are in seconds since the package started to be imported, and
+    are logged and kept in the boot metrics as each step is reached: imported,
+    listening, warmed_up and first_request, which is when the response to the
+    first request went out. The time that the first request itself took is
+    kept as first_request_latency.
+
+    Args:
+        prewarm (bool): open SNS connections ahead of the first publish
+        connections (int): number of SNS connections to open
+        started_at (float): time the package started to be imported
+    """
+    def __init__(self, prewarm=False, connections=1, started_at=None):
+        self.prewarm = prewarm
+        self.connections = connections
+        self.started_at = IMPORT_STARTED_AT if started_at is None else started_at
+        self.state = PENDING if prewarm else DONE
+        self.error = None
+        self.timings = {}
+        self._first_request = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        """ Create a warm-up from the environment settings. """
+        return cls(SNS_PREWARM, SNS_PREWARM_CONNECTIONS)
+
+    @property
+    def ready(self):
+        """ Whether the warm-up is over, whether or not it succeeded. Otherwise connections are opened on demand. """
+        return self.state != PENDING
+
+    def mark(self, step, now=None):
+        """ Record and log the time that a step of starting up was reached. """
+        seconds = (now or time.time()) - self.started_at
+        with self._lock:
+            self.timings[step] = seconds
+        BOOT_SECONDS.set(seconds, step)
+        LOGGER.info('Start-up: %s after %.0f ms', step.replace('_', ' '), seconds * 1000)
+
+    def start(self, imported_at=None):
+        """ Record that the server is listening, and start warming up in the background.
+
+        Args:
+            imported_at (float): time that the service finished importing
+        """
+        if imported_at is not None:
+            self.mark('imported', imported_at)
+        self.mark('listening')
+        if not self.prewarm:
+            return
+        self._thread = threading.Thread(target=self._warm_up, name='warmup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """ Wait for the warm-up to be over. """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def request_done(self, received_at):
+        """ Record the first response that went out, and how long its request took. Later calls do nothing.
+
+        Args:
+            received_at (float): time the request was received
+        """
+        if self._first_request:
+            return
+        with self._lock:
+            if self._first_request:
+                return
+            self._first_request = True
+            self.timings['first_request_latency'] = time.time() - received_at
+        LOGGER.info('Start-up: the first request took %.0f ms', self.timings['first_request_latency'] * 1000)
+        self.mark('first_request')
+
+    def describe(self):
+        """ The state and timings of the warm-up, as served by GET /ready and /healthz. """
+        with self._lock:
+            timings = dict((step, round(seconds, 3)) for step, seconds in self.timings.items())
+        description = {'state': self.state, 'ready': self.ready, 'timings': timings}
+        if self.error is not None:
+            description['error'] = self.error
+        return description
+
+    def _warm_up(self):
+        """ Open the SNS connections. A failure only means that they get opened on demand. """
+        state = DONE
+        try:
+            # Other transports don't publish to SNS
+            if helpers.TRANSPORT is None:
+                helpers.prewarm_sns_connections(self.connections)
+        except Exception as err:  # pylint: disable=broad-except
+            # Missing credentials among them, which boto only notices when connecting
+            LOGGER.warning('Could not warm up the SNS connections: %s', err)
+            self.error = str(err)
+            state = FAILED
+        self.mark('warmed_up')
+        self.state = state